@@ -0,0 +1,120 @@
+import os
+import json
+import glob
+import threading
+import logging
+from datetime import datetime
+
+script_dir = os.path.dirname(__file__)
+
+# Registro de adjuntos procesados: un JSON por línea, solo se agrega al final
+ATTACHMENT_LOG_PATH = os.path.join(script_dir, "..", "logs", "attachment_log.jsonl")
+LEGACY_ATTACHMENT_LOG_PATH = os.path.join(script_dir, "..", "logs", "attachment_log.json")  # Formato anterior (arreglo JSON)
+ATTACHMENT_LOG_MAX_BYTES = int(os.getenv("ATTACHMENT_LOG_MAX_BYTES", 10 * 1024 * 1024))  # Tamaño que dispara la rotación
+ATTACHMENT_LOG_MAX_SEGMENTS = int(os.getenv("ATTACHMENT_LOG_MAX_SEGMENTS", 0))  # Segmentos rotados a conservar (0 = todos)
+
+
+class AttachmentJournal:
+    def __init__(self, log_path=ATTACHMENT_LOG_PATH, max_bytes: int = ATTACHMENT_LOG_MAX_BYTES,
+                 max_segments: int = ATTACHMENT_LOG_MAX_SEGMENTS, legacy_path=LEGACY_ATTACHMENT_LOG_PATH):
+        """
+        Append-only attachment log (JSON Lines). Each run only appends its own records and fsyncs them,
+        so saving costs O(new records) and a crash can at most leave a torn last line, which the reader
+        skips. When the file reaches `max_bytes` it is rotated to `<name>.<timestamp>.jsonl`.
+
+        Args:
+            log_path (str): Current segment. Defaults to ATTACHMENT_LOG_PATH (logs/attachment_log.jsonl).
+            max_bytes (int): Size that triggers a rotation (0 disables it).
+            max_segments (int): Rotated segments to keep; older ones are deleted (0 keeps all of them).
+            legacy_path (str): Old JSON array log, imported once if the JSONL log does not exist yet.
+        """
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        if legacy_path and os.path.exists(legacy_path) and not self.segments():
+            self._import_legacy(legacy_path)
+
+    def _import_legacy(self, legacy_path: str):
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as file:
+                records = json.load(file)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f" No se pudo importar el log anterior '{legacy_path}': {e}")
+            return
+        self.append(records)
+        logging.info(f" Log anterior importado al formato JSONL ({len(records)} registros)")
+
+    def segments(self) -> list[str]:
+        """Files of the log from oldest to newest (rotated segments, then the current one)."""
+        root, extension = os.path.splitext(self.log_path)
+        rotated = sorted(glob.glob(f"{glob.escape(root)}.*{extension}"))
+        return rotated + ([self.log_path] if os.path.exists(self.log_path) else [])
+
+    def _rotate(self):
+        root, extension = os.path.splitext(self.log_path)
+        os.replace(self.log_path, f"{root}.{datetime.now().strftime('%Y%m%d%H%M%S%f')}{extension}")
+        if self.max_segments > 0:
+            for old_segment in self.segments()[:-self.max_segments]:
+                os.remove(old_segment)
+
+    def append(self, records) -> int:
+        """
+        Appends records (dicts) as one write followed by fsync.
+
+        Returns:
+            int: Number of records written.
+        """
+        lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in records]
+        written = len(lines)
+        if not written:
+            return 0
+        with self._lock:
+            if self.max_bytes and os.path.exists(self.log_path) and os.path.getsize(self.log_path) >= self.max_bytes:
+                self._rotate()
+            if self._ends_with_torn_line():
+                lines.insert(0, "\n")  # Para no pegar el primer registro nuevo a una línea cortada por un corte abrupto
+            with open(self.log_path, "a", encoding="utf-8") as file:
+                file.write("".join(lines))
+                file.flush()
+                os.fsync(file.fileno())
+        return written
+
+    def _ends_with_torn_line(self) -> bool:
+        if not os.path.exists(self.log_path) or os.path.getsize(self.log_path) == 0:
+            return False
+        with open(self.log_path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) != b"\n"
+
+    def __iter__(self):
+        """Yields the records of every segment lazily, oldest first."""
+        for segment in self.segments():
+            with open(segment, "r", encoding="utf-8") as file:
+                for line_number, line in enumerate(file, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f" Línea {line_number} de '{segment}' incompleta o dañada; se omite")
+
+    def to_json_array(self, output_path=LEGACY_ATTACHMENT_LOG_PATH) -> int:
+        """
+        Writes the whole log as the old JSON array (indent=2), streaming record by record.
+
+        Returns:
+            int: Number of records exported.
+        """
+        count = 0
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write("[")
+            for record in self:
+                file.write(",\n  " if count else "\n  ")
+                file.write(json.dumps(record, indent=2, ensure_ascii=False).replace("\n", "\n  "))
+                count += 1
+            file.write("\n]" if count else "]")
+        os.replace(tmp_path, output_path)
+        return count
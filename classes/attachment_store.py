@@ -0,0 +1,177 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+
+script_dir = os.path.dirname(__file__)
+
+# Variables globales
+DOWNLOAD_PATH = os.path.join(script_dir, "..", "descargas")  # Carpeta de descargas
+STORE_PATH = os.path.join(DOWNLOAD_PATH, "store")  # Almacén de adjuntos direccionado por contenido (SHA-256)
+MANIFEST_NAME = "manifest.json"  # Origen de los adjuntos de cada correo (DOWNLOAD_PATH/<UID>/manifest.json)
+STORE_RETENTION_DAYS = int(os.getenv("ATTACHMENT_STORE_RETENTION_DAYS", 30))  # Días sin uso antes de borrar un objeto (0 = nunca)
+STORE_TMP_MAX_AGE = 24 * 60 * 60  # Temporales de descargas interrumpidas que se borran al abrir el almacén
+
+
+class HashingWriter:
+    def __init__(self, file, name: str):
+        """
+        Binary file wrapper that computes the SHA-256 and size of everything written to it.
+
+        Args:
+            file: Binary file opened for writing.
+            name (str): Path of the file.
+        """
+        self.file = file
+        self.name = name
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self._sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+
+class AttachmentStore:
+    def __init__(self, root=STORE_PATH, retention_days: int = STORE_RETENTION_DAYS):
+        """
+        Content-addressed store for downloaded attachments. Every payload is hashed while it is
+        written and kept once under `objects/<sha[:2]>/<sha>`; identical payloads received in the
+        same session (e.g. the same ficha re-sent in several emails) are only materialized once.
+        In a later run (e.g. a rerun after a crash) a staged file that already holds the content is
+        left as is: nothing is rewritten. Objects unused for `retention_days` are deleted by `prune`,
+        which the caller runs explicitly (once per run, see scripts/main.py).
+
+        Args:
+            root (str): Folder of the store. Defaults to STORE_PATH (descargas/store).
+            retention_days (int): Days an unused object is kept. Defaults to STORE_RETENTION_DAYS (0 keeps them forever).
+        """
+        self.root = root
+        self.objects_path = os.path.join(root, "objects")
+        self.tmp_path = os.path.join(root, "tmp")
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self.retention_days = retention_days
+        self._materialized = {}  # sha256 -> ruta del archivo materializado en esta sesión
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_path, sha256[:2], sha256)
+
+    def open_temp(self) -> HashingWriter:
+        """Opens a temporary file inside the store that hashes its content while it is written."""
+        fd, tmp_file = tempfile.mkstemp(dir=self.tmp_path)
+        return HashingWriter(os.fdopen(fd, "wb"), tmp_file)
+
+    def discard(self, writer: HashingWriter):
+        """Closes and removes a temporary file that will not be committed."""
+        writer.close()
+        if os.path.exists(writer.name):
+            os.remove(writer.name)
+
+    def commit(self, writer: HashingWriter, target_path: str) -> tuple[str, bool]:
+        """
+        Moves a finished temporary file into the store and materializes it at `target_path`,
+        unless the same content was already materialized in this session. If `target_path` already
+        holds that content (hard link to the object, or a copy with the same SHA-256) it is not rewritten.
+
+        Returns:
+            tuple: (sha256, is_duplicate). If `is_duplicate` is True nothing was written to `target_path`;
+                `materialized_path(sha256)` gives the file that holds that content.
+        """
+        writer.close()
+        sha256 = writer.hexdigest
+        blob = self.blob_path(sha256)
+
+        with self._lock:
+            if os.path.exists(blob):
+                os.remove(writer.name)  # El contenido ya está en el almacén
+                os.utime(blob)  # Cuenta como uso para la retención (ver prune)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(writer.name, blob)
+
+            # Si el archivo materializado ya no está (p.ej. fue renombrado), se vuelve a materializar
+            if sha256 in self._materialized and os.path.exists(self._materialized[sha256]):
+                logging.info(f" Adjunto duplicado ({sha256[:12]}): se reutiliza '{self._materialized[sha256]}'")
+                return sha256, True
+            self._materialized[sha256] = target_path
+
+        if self._holds(target_path, blob, sha256):
+            logging.info(f" '{target_path}' ya tiene el contenido {sha256[:12]}: no se vuelve a escribir")
+        else:
+            self._materialize(blob, target_path)
+        return sha256, False
+
+    def prune(self, retention_days: int = None) -> int:
+        """
+        Deletes the objects not used (written or received again) in the last `retention_days` days, and
+        temporary files left by interrupted downloads. Staged copies of the attachments are hard links or
+        copies, so they are not affected.
+
+        Args:
+            retention_days (int, optional): Defaults to the `retention_days` of the store (0 keeps the objects forever).
+
+        Returns:
+            int: Number of files deleted.
+        """
+        retention_days = self.retention_days if retention_days is None else retention_days
+        now = time.time()
+        expired = [(self.tmp_path, now - STORE_TMP_MAX_AGE)]
+        if retention_days > 0:
+            expired.append((self.objects_path, now - retention_days * 24 * 60 * 60))
+        deleted = 0
+        with self._lock:
+            for folder, cutoff in expired:
+                for directory, _, files in os.walk(folder):
+                    for name in files:
+                        path = os.path.join(directory, name)
+                        try:
+                            if os.path.getmtime(path) < cutoff:
+                                os.remove(path)
+                                deleted += 1
+                        except OSError as e:
+                            logging.warning(f" No se pudo borrar '{path}' del almacén de adjuntos: {e}")
+        if deleted:
+            logging.info(f" {deleted} archivos sin uso borrados del almacén de adjuntos")
+        return deleted
+
+    def materialized_path(self, sha256: str):
+        """Returns the path where the content with this hash was materialized in this session, if any."""
+        return self._materialized.get(sha256)
+
+    @staticmethod
+    def _holds(target_path: str, blob: str, sha256: str) -> bool:
+        """True if `target_path` already holds the content of `blob`: same file (hard link) or a copy with the same hash."""
+        if not os.path.isfile(target_path):
+            return False
+        if os.path.samefile(target_path, blob):
+            return True
+        if os.path.getsize(target_path) != os.path.getsize(blob):
+            return False
+        digest = hashlib.sha256()
+        with open(target_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest() == sha256
+
+    @staticmethod
+    def _materialize(blob: str, target_path: str):
+        # Hard link cuando es posible (no ocupa espacio extra); si no, copia
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(blob, target_path)
+        except OSError:
+            shutil.copyfile(blob, target_path)
@@ -7,6 +7,7 @@ from dataclasses import dataclass
 from typing import List
 import logging
 from pprint import pprint
+from correos_automaticos.classes.attachment_store import MANIFEST_NAME
 
 script_dir = os.path.dirname(__file__)
 
@@ -99,7 +100,7 @@ class FileManager():
             diccionario (dict): Diccionario para buscar los nombres en los keys y cambiarlos por sus values.
             lowercase (bool): Si es true, antes de renombrar según el dict, se convierte a minúsculas
         Returns: 
-            renamed_files_map (list): List of dicts containing new_name and original_name as keys for every file.
+            renamed_files_map (list): List of dicts containing new_name, original_name and new_path as keys for every file.
         """
         renamed_files_map = []
 
@@ -113,9 +114,10 @@ class FileManager():
         for archivo in os.listdir(self.search_directory):
             archivo_path = os.path.join(self.search_directory, archivo)
 
-            # Asegurar que es un archivo y no una carpeta
-            if not os.path.isfile(archivo_path):
+            # Asegurar que es un archivo y no una carpeta (ni el manifest de la carpeta de un correo)
+            if not os.path.isfile(archivo_path) or archivo == MANIFEST_NAME:
                 continue
+            nuevo_nombre = None
 
             # Extraer patron del nombre del archivo (si está presente)
             nombre_original, extension = os.path.splitext(archivo)
@@ -147,13 +149,14 @@ class FileManager():
             logging.debug(f" Archivo '{archivo}' -> movido a: {clasificacion}")
 
             # Agregar el mapeo de archivos renombrados
-            try:
-                renamed_files_map.append({
-                    "original_name" : archivo,
-                    "new_name" : nuevo_nombre
-                })
-            except UnboundLocalError:
+            if nuevo_nombre is None:
                 logging.error(f" Código del archivo '{archivo} no se encontró en info_obs'")
+                continue
+            renamed_files_map.append({
+                "original_name" : archivo,
+                "new_name" : nuevo_nombre,
+                "new_path" : nuevo_path
+            })
 
         return renamed_files_map
 
@@ -163,6 +166,112 @@ class FileManager():
     #     """
     #     self.search_directory
 
+
+class RubroClassifier():
+    def __init__(self, regex_dict: dict, known_codes=None):
+        """
+        Índice de clasificación construido una sola vez a partir de rubros_subrubros: todos los patrones
+        se precompilan y se combinan en una sola alternancia con grupos con nombre, de modo que un código
+        se resuelve con un solo `match` (y luego desde caché) en lugar de probar patrón por patrón.
+
+        Args:
+            regex_dict (dict): {rubro: {subrubro: regex}} o {rubro: {subrubro: {departamento: regex}}} si es territorial.
+            known_codes (iterable, optional): Códigos de fichas conocidos (p.ej. las llaves de info_obs) con los
+                que se reportan patrones superpuestos o inalcanzables al cargar.
+        """
+        self.paths = []     # Ruta 'rubro/subrubro[/departamento]' de cada patrón, en orden de prioridad
+        self.patterns = []  # Patrones compilados, en el mismo orden
+        self._cache = {}    # código -> ruta
+
+        for rubro, subdict in regex_dict.items():
+            for subrubro, regex in subdict.items():
+                # Caso 1: nivel simple (nacional, global)
+                if isinstance(regex, str):
+                    self._add(f'{rubro}/{subrubro}', regex)
+                # Caso 2: nivel complejo (es territorial)
+                elif isinstance(regex, dict):
+                    for departamento, true_regex in regex.items():
+                        if isinstance(true_regex, str):
+                            self._add(f'{rubro}/{subrubro}/{departamento}', true_regex)
+
+        self._combined = self._combine()
+        self.report(known_codes)
+
+    def _add(self, path: str, regex: str):
+        try:
+            self.patterns.append(re.compile(regex, re.IGNORECASE))
+            self.paths.append(path)
+        except re.error as e:
+            logging.error(f" Patrón inválido para '{path}' ({regex}): {e}")
+
+    def _combine(self):
+        # Las referencias numeradas o grupos con nombre propios no sobreviven a la combinación: en ese caso
+        # se prueban los patrones compilados uno por uno (mismo resultado, sin la alternancia)
+        if any(re.search(r"\\\d|\(\?P[<=]", pattern.pattern) for pattern in self.patterns):
+            return None
+        try:
+            return re.compile(
+                "|".join(f"(?P<p{index}>{pattern.pattern})" for index, pattern in enumerate(self.patterns)),
+                re.IGNORECASE,
+            )
+        except re.error:
+            return None
+
+    def classify(self, code: str) -> str:
+        """
+        Resuelve el código de una ficha (p.ej. 't80' o 'r23_madre') a su ruta de clasificación.
+
+        Returns:
+            str: 'rubro/subrubro' o 'rubro/subrubro/departamento'; "" si ningún patrón coincide.
+        """
+        key = code.lower()
+        if key not in self._cache:
+            self._cache[key] = self._match(code)
+        return self._cache[key]
+
+    def _match(self, code: str) -> str:
+        if self._combined is not None:
+            match = self._combined.match(code)
+            return self.paths[int(match.lastgroup[1:])] if match else ""
+        for path, pattern in zip(self.paths, self.patterns):
+            if pattern.match(code):
+                return path
+        return ""
+
+    def report(self, known_codes=None) -> dict:
+        """
+        Reporta en el log los patrones repetidos y, si se pasan códigos conocidos, los códigos que coinciden
+        con más de un patrón (gana el primero) y los patrones con los que no coincide ningún código.
+
+        Returns:
+            dict: {"duplicados": [...], "superpuestos": {código: [rutas]}, "inalcanzables": [rutas]}
+        """
+        report = {"duplicados": [], "superpuestos": {}, "inalcanzables": []}
+
+        seen = {}
+        for path, pattern in zip(self.paths, self.patterns):
+            if pattern.pattern in seen:
+                report["duplicados"].append(path)
+                logging.warning(f" Patrón de '{path}' repetido (ya se usa en '{seen[pattern.pattern]}'): nunca se alcanzará")
+            else:
+                seen[pattern.pattern] = path
+
+        if known_codes is not None:
+            reached = set()
+            for code in known_codes:
+                matches = [path for path, pattern in zip(self.paths, self.patterns) if pattern.match(code)]
+                reached.update(matches)
+                if len(matches) > 1:
+                    report["superpuestos"][code] = matches
+                    logging.warning(f" El código '{code}' coincide con varios patrones {matches}: se usará '{matches[0]}'")
+            for path in self.paths:
+                if path not in reached and path not in report["duplicados"]:
+                    report["inalcanzables"].append(path)
+                    logging.warning(f" Ningún código conocido coincide con el patrón de '{path}'")
+
+        return report
+
+
 # @dataclass
 # class EmailMetadata:
 #     id: str
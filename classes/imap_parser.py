@@ -0,0 +1,256 @@
+import re
+import base64
+import quopri
+from email.utils import decode_rfc2231
+from urllib.parse import unquote
+
+# Marcador `{123}` con el que imaplib deja indicado un literal al final de cada cabecera
+_LITERAL_MARKER = re.compile(rb"\{\d+\}$")
+
+
+class _Literal(bytes):
+    """Bytes received as an IMAP literal (`{n}` + raw data)."""
+
+
+def _tokenize_bytes(data: bytes):
+    """
+    Splits a chunk of an IMAP response into tokens:
+        - "(" and ")" for lists
+        - str for atoms (numbers, flags, keys such as "BODY[1.2]<0>")
+        - bytes for quoted strings
+        - None for NIL
+    """
+    i = 0
+    n = len(data)
+    while i < n:
+        char = data[i:i + 1]
+        if char in (b" ", b"\r", b"\n"):
+            i += 1
+        elif char in (b"(", b")"):
+            yield char.decode()
+            i += 1
+        elif char == b'"':
+            i += 1
+            value = bytearray()
+            while i < n and data[i:i + 1] != b'"':
+                if data[i:i + 1] == b"\\":
+                    i += 1
+                value += data[i:i + 1]
+                i += 1
+            i += 1  # Saltar la comilla de cierre
+            yield bytes(value)
+        else:
+            start = i
+            while i < n and data[i:i + 1] not in (b" ", b"(", b")", b"\r", b"\n"):
+                if data[i:i + 1] == b"[":
+                    # Las secciones como BODY[HEADER.FIELDS (SUBJECT)] pueden tener espacios y paréntesis
+                    closing = data.find(b"]", i)
+                    i = n if closing == -1 else closing
+                i += 1
+            atom = data[start:i].decode("ascii", errors="replace")
+            yield None if atom.upper() == "NIL" else atom
+
+
+def _tokenize(msg_data):
+    """Yields the tokens of the raw data returned by `imaplib.IMAP4.fetch` / `uid('FETCH', ...)`."""
+    for item in msg_data:
+        if isinstance(item, tuple):
+            head, literal = item
+            yield from _tokenize_bytes(_LITERAL_MARKER.sub(b"", head))
+            yield _Literal(literal)
+        elif isinstance(item, bytes):
+            yield from _tokenize_bytes(item)
+
+
+def _build_list(tokens):
+    """Consumes tokens until the closing parenthesis and returns the nested list."""
+    result = []
+    for token in tokens:
+        if token == ")":
+            return result
+        if token == "(":
+            result.append(_build_list(tokens))
+        else:
+            result.append(token)
+    return result
+
+
+def iter_fetch_response(msg_data):
+    """
+    Parses the response of a FETCH command lazily, one message at a time.
+
+    Args:
+        msg_data (list): Data as returned by imaplib (mix of bytes and (header, literal) tuples).
+
+    Yields:
+        dict: e.g. {"SEQ": "12", "UID": "1001", "ENVELOPE": [...], "BODYSTRUCTURE": [...]}
+    """
+    seq = None
+    tokens = _tokenize(msg_data)
+    for token in tokens:
+        if token == "(":
+            items = _build_list(tokens)
+            message = {"SEQ": seq} if seq is not None else {}
+            for key, value in zip(items[::2], items[1::2]):
+                message[key.upper() if isinstance(key, str) else key] = value
+            yield message
+            seq = None
+        else:
+            seq = token
+
+
+def parse_fetch_response(msg_data) -> list[dict]:
+    """Parses the response of a FETCH command into one dict per message (see `iter_fetch_response`)."""
+    return list(iter_fetch_response(msg_data))
+
+
+def _to_str(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def parse_envelope(envelope: list) -> dict:
+    """
+    Converts an ENVELOPE structure into a dict with raw (still MIME encoded) header values.
+
+    Returns:
+        dict: keys date, subject, from_name, from_email, to
+    """
+    def addresses(value):
+        result = []
+        for name, _adl, mailbox, host in value or []:
+            result.append((_to_str(name), f"{_to_str(mailbox)}@{_to_str(host)}"))
+        return result
+
+    date, subject, from_ = envelope[0], envelope[1], addresses(envelope[2])
+    to = addresses(envelope[5])
+    from_name, from_email = from_[0] if from_ else ("", "")
+    return {
+        "date": _to_str(date),
+        "subject": _to_str(subject),
+        "from_name": from_name,
+        "from_email": from_email,
+        "to": ", ".join(f"{name} <{address}>" if name else address for name, address in to),
+    }
+
+
+def _params_to_dict(params) -> dict:
+    if not isinstance(params, list):
+        return {}
+    return {_to_str(key).lower(): _to_str(value) for key, value in zip(params[::2], params[1::2])}
+
+
+def _filename_from_params(params: dict) -> str:
+    """Gets a file name from disposition/type parameters, including RFC 2231 (filename*) values."""
+    for key in ("filename", "name"):
+        if params.get(key):
+            return params[key]
+        # filename* o filename*0*, filename*1*, ... (RFC 2231)
+        continuations = sorted(
+            (k for k in params if k.startswith(f"{key}*")),
+            key=lambda k: int(re.sub(r"\D", "", k) or 0),
+        )
+        if continuations:
+            raw = "".join(params[k] for k in continuations)
+            if any(k.endswith("*") for k in continuations):
+                charset, _language, value = decode_rfc2231(raw) if raw.count("'") >= 2 else (None, None, raw)
+                return unquote(value, encoding=charset or "utf-8", errors="replace")
+            return raw
+    return ""
+
+
+def find_attachment_parts(bodystructure: list, prefix: str = "") -> list[dict]:
+    """
+    Walks a BODYSTRUCTURE and returns the parts whose disposition is "attachment".
+
+    Returns:
+        list[dict]: One dict per attachment with the keys part (e.g. "2" or "1.3"),
+            filename (still MIME encoded), encoding and size.
+    """
+    attachments = []
+    if not isinstance(bodystructure, list) or not bodystructure:
+        return attachments
+
+    # Multipart: partes hijas seguidas del subtipo
+    if isinstance(bodystructure[0], list):
+        for index, child in enumerate(bodystructure, start=1):
+            if not isinstance(child, list):
+                break
+            attachments.extend(find_attachment_parts(child, f"{prefix}{index}."))
+        return attachments
+
+    part = prefix.rstrip(".") or "1"
+    body_type = _to_str(bodystructure[0]).lower()
+    body_subtype = _to_str(bodystructure[1]).lower()
+
+    # Campos básicos (7) + campos extra según el tipo, luego md5 y disposición
+    extension_index = 7
+    if body_type == "text":
+        extension_index = 8
+    elif body_type == "message" and body_subtype == "rfc822":
+        extension_index = 10
+    disposition_index = extension_index + 1
+
+    disposition = bodystructure[disposition_index] if len(bodystructure) > disposition_index else None
+    if not isinstance(disposition, list) or _to_str(disposition[0]).lower() != "attachment":
+        return attachments
+
+    filename = _filename_from_params(_params_to_dict(disposition[1] if len(disposition) > 1 else None))
+    if not filename:
+        filename = _filename_from_params(_params_to_dict(bodystructure[2]))
+
+    attachments.append({
+        "part": part,
+        "filename": filename,
+        "encoding": _to_str(bodystructure[5]).lower(),
+        "size": int(bodystructure[6]) if str(bodystructure[6]).isdigit() else None,
+    })
+    return attachments
+
+
+class PartDecoder:
+    def __init__(self, encoding: str, output):
+        """
+        Incremental Content-Transfer-Encoding decoder: receives the encoded content of a body part
+        in chunks of any size and writes the decoded bytes to `output` as they arrive, so memory
+        use does not depend on the size of the attachment.
+
+        Args:
+            encoding (str): Content-Transfer-Encoding of the part (base64, quoted-printable, 7bit...).
+            output: Binary file-like object with a `write` method.
+        """
+        self.encoding = (encoding or "").lower()
+        self.output = output
+        self._pending = b""
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        if self.encoding == "base64":
+            data = self._pending + re.sub(rb"[^A-Za-z0-9+/=]", b"", chunk)
+            complete = len(data) - len(data) % 4  # Solo se decodifican grupos completos de 4 caracteres
+            self._pending = data[complete:]
+            if complete:
+                self.output.write(base64.b64decode(data[:complete]))
+        elif self.encoding == "quoted-printable":
+            data = self._pending + chunk
+            last_newline = data.rfind(b"\n")  # Las secuencias =XX y los saltos suaves no cruzan líneas
+            if last_newline == -1:
+                self._pending = data
+                return
+            self._pending = data[last_newline + 1:]
+            self.output.write(quopri.decodestring(data[:last_newline + 1]))
+        else:
+            self.output.write(chunk)
+
+    def close(self):
+        """Flushes the remaining buffered data."""
+        if self._pending:
+            if self.encoding == "base64":
+                self.output.write(base64.b64decode(self._pending + b"=" * (-len(self._pending) % 4)))
+            else:
+                self.output.write(quopri.decodestring(self._pending))
+            self._pending = b""
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from correos_automaticos.classes.models import EmailData, AttachmentLog
+
+script_dir = os.path.dirname(__file__)
+
+# Registro consultable de lo ya procesado (correos, adjuntos renombrados y subidas a SharePoint)
+LEDGER_DB_PATH = os.path.join(script_dir, "..", "logs", "processing_ledger.sqlite3")
+LEDGER_LOOKUP_CHUNK = 500  # Parámetros por consulta IN (SQLite admite 999 en versiones antiguas)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    msg_id TEXT PRIMARY KEY,          -- UID del correo
+    from_email TEXT NOT NULL,
+    from_name TEXT,
+    subject TEXT,
+    sent TEXT,
+    to_address TEXT,
+    attachments TEXT,                 -- JSON: nombres de los adjuntos
+    attachment_hashes TEXT,           -- JSON: nombre -> SHA-256
+    status TEXT NOT NULL,             -- renamed | processed (todos sus adjuntos subidos)
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_emails_sender ON emails (from_email);
+CREATE INDEX IF NOT EXISTS idx_emails_status ON emails (status);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    msg_id TEXT NOT NULL,
+    original_name TEXT NOT NULL,
+    new_name TEXT NOT NULL,
+    author TEXT NOT NULL,
+    path TEXT,                        -- Clasificación rubro/subrubro[/departamento]
+    content_hash TEXT,
+    local_path TEXT,
+    sharepoint_path TEXT,             -- Carpeta/nombre en SharePoint, una vez que se intentó subir
+    status TEXT NOT NULL,             -- renamed | uploaded | upload_failed
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (msg_id, original_name)
+);
+CREATE INDEX IF NOT EXISTS idx_attachments_author ON attachments (author);
+CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments (content_hash, sharepoint_path);
+CREATE INDEX IF NOT EXISTS idx_attachments_sharepoint_path ON attachments (sharepoint_path, status);
+CREATE INDEX IF NOT EXISTS idx_attachments_status ON attachments (status);
+"""
+
+
+class ProcessingLedger:
+    def __init__(self, db_path=LEDGER_DB_PATH):
+        """
+        SQLite ledger (WAL mode) of processed emails and attachments, indexed by UID, sender, content
+        hash, SharePoint path and status, so the retriever, the renamer and the uploader can check
+        in O(log n) whether a step was already done. Writes are batched in one transaction per call.
+        Each thread uses its own connection.
+
+        Args:
+            db_path (str): SQLite file. Defaults to LEDGER_DB_PATH (logs/processing_ledger.sqlite3).
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "connection"):
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # Suficiente con WAL: no se corrompe ante un corte
+            self._local.connection = connection
+        return self._local.connection
+
+    def _lookup(self, query: str, values: list) -> list[sqlite3.Row]:
+        """Runs `query` (with a `{placeholders}` IN list) over `values` in chunks."""
+        rows = []
+        for start in range(0, len(values), LEDGER_LOOKUP_CHUNK):
+            chunk = values[start:start + LEDGER_LOOKUP_CHUNK]
+            rows.extend(self._connection().execute(query.format(placeholders=", ".join("?" * len(chunk))), chunk).fetchall())
+        return rows
+
+    # --- Escritura ---
+    def record_processed(self, emails_data: list[EmailData], user_attachments_log: dict[str, list[AttachmentLog]]):
+        """
+        Stores the emails and their renamed attachments (status 'renamed') in a single transaction. An email
+        is only 'processed' once its uploads are done (see mark_processed); until then it is fetched again.
+        """
+        now = time.time()
+        email_rows = [(
+            email_data.msg_id, email_data.from_email, email_data.from_name, email_data.subject, email_data.sent,
+            email_data.to, json.dumps(email_data.attachments, ensure_ascii=False),
+            json.dumps(email_data.attachment_hashes), "renamed", now,
+        ) for email_data in emails_data]
+        attachment_rows = [(
+            log.msg_id, log.original_name, log.new_name, log.author, log.path, log.content_hash, log.local_path, "renamed", now,
+        ) for logs in user_attachments_log.values() for log in logs if log.msg_id is not None]
+
+        with self._connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", email_rows)
+            # Si el adjunto ya estaba registrado se conserva su estado de subida
+            connection.executemany("""
+                INSERT INTO attachments (msg_id, original_name, new_name, author, path, content_hash, local_path, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (msg_id, original_name) DO UPDATE SET
+                    new_name = excluded.new_name, path = excluded.path, content_hash = excluded.content_hash,
+                    local_path = excluded.local_path, updated_at = excluded.updated_at""", attachment_rows)
+
+    def record_uploads(self, uploads: list[tuple[AttachmentLog, str]]):
+        """
+        Stores the result of uploads: (AttachmentLog, sharepoint_path) pairs, where `sharepoint_path`
+        is 'folder/file name' and `sharepoint_uploaded` tells the outcome.
+        """
+        now = time.time()
+        rows = [(
+            log.msg_id, log.original_name, log.new_name, log.author, log.path, log.content_hash, log.local_path,
+            sharepoint_path, "uploaded" if log.sharepoint_uploaded else "upload_failed", now,
+        ) for log, sharepoint_path in uploads if log.msg_id is not None]
+        with self._connection() as connection:
+            connection.executemany("""
+                INSERT INTO attachments (msg_id, original_name, new_name, author, path, content_hash, local_path,
+                                         sharepoint_path, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (msg_id, original_name) DO UPDATE SET
+                    sharepoint_path = excluded.sharepoint_path, status = excluded.status, updated_at = excluded.updated_at""", rows)
+
+    def mark_processed(self, msg_ids):
+        """Marks emails as processed (all their attachments were uploaded), so they are not fetched again."""
+        now = time.time()
+        with self._connection() as connection:
+            connection.executemany("UPDATE emails SET status = 'processed', updated_at = ? WHERE msg_id = ?",
+                                   [(now, str(msg_id)) for msg_id in msg_ids])
+
+    # --- Consultas ---
+    def processed_emails(self, msg_ids) -> set[str]:
+        """UIDs (of `msg_ids`) whose emails were already processed."""
+        rows = self._lookup("SELECT msg_id FROM emails WHERE status = 'processed' AND msg_id IN ({placeholders})",
+                            [str(msg_id) for msg_id in msg_ids])
+        return {row["msg_id"] for row in rows}
+
+    def renamed_files(self, msg_id: str) -> list[dict]:
+        """Attachments of an email that were already renamed, in the format of rename_files (plus msg_id and content_hash)."""
+        rows = self._connection().execute(
+            "SELECT original_name, new_name, local_path, content_hash FROM attachments WHERE msg_id = ?", (str(msg_id),)
+        ).fetchall()
+        return [{"original_name": row["original_name"], "new_name": row["new_name"], "new_path": row["local_path"],
+                 "msg_id": str(msg_id), "content_hash": row["content_hash"]} for row in rows]
+
+    def uploaded(self, content_hash: str, sharepoint_path: str) -> bool:
+        """Whether this content was already uploaded to this SharePoint path."""
+        return bool(self.uploaded_files([(content_hash, sharepoint_path)]))
+
+    def uploaded_files(self, files: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        """Subset of (content_hash, sharepoint_path) pairs that were already uploaded."""
+        files = [(content_hash, path) for content_hash, path in files if content_hash]
+        rows = self._lookup(
+            "SELECT DISTINCT content_hash, sharepoint_path FROM attachments "
+            "WHERE status = 'uploaded' AND sharepoint_path IN ({placeholders})",
+            list({path for _content_hash, path in files}),
+        )
+        found = {(row["content_hash"], row["sharepoint_path"]) for row in rows}
+        return {file for file in files if file in found}
+
+    def attachments_by_sender(self, sender: str, status: str = None) -> list[dict]:
+        """Attachments sent by `sender`, optionally filtered by status."""
+        query = "SELECT * FROM attachments WHERE author = ?" + (" AND status = ?" if status else "")
+        return [dict(row) for row in self._connection().execute(query, (sender, status) if status else (sender,))]
+
+    def close(self):
+        if hasattr(self._local, "connection"):
+            self._local.connection.close()
+            del self._local.connection
@@ -10,6 +10,7 @@ class EmailData(BaseModel):
     subject: str
     body: str
     attachments: list[str]
+    attachment_hashes: dict[str, str] = {}  # nombre del adjunto -> SHA-256 del contenido
 
 
 class AttachmentLog(BaseModel):
@@ -17,6 +18,9 @@ class AttachmentLog(BaseModel):
     original_name: str
     path: str
     author: EmailStr
+    msg_id: Optional[str] = None
+    content_hash: Optional[str] = None
+    local_path: Optional[str] = None
     sharepoint_uploaded: Optional[bool] = None
 
 
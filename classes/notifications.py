@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import threading
+import logging
+from contextlib import closing
+from datetime import datetime, timedelta
+from correos_automaticos.classes.models import AttachmentLog
+
+script_dir = os.path.dirname(__file__)
+
+# Modo resumen: los archivos de cada remitente se acumulan entre ejecuciones y se notifican en un solo correo
+DIGEST_OUTBOX_PATH = os.path.join(script_dir, "..", "logs", "notification_digest.json")
+DIGEST_INTERVAL_MINUTES = int(os.getenv("NOTIFICATION_DIGEST_INTERVAL_MINUTES", 24 * 60))  # Antigüedad máxima del resumen
+DIGEST_MAX_FILES = int(os.getenv("NOTIFICATION_DIGEST_MAX_FILES", 20))  # Se envía antes si acumula estos archivos
+DIGEST_TEMPLATE = "sharepoint_success.html"
+
+# Bandeja de salida transaccional: todo mensaje generado se guarda antes de enviarse y se reintenta con espera exponencial
+OUTBOX_DB_PATH = os.path.join(script_dir, "..", "logs", "notification_outbox.sqlite3")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF_BASE = int(os.getenv("NOTIFICATION_OUTBOX_BACKOFF_BASE", 60))  # Segundos antes del primer reintento
+OUTBOX_BACKOFF_MAX = 6 * 60 * 60  # Espera máxima entre reintentos
+OUTBOX_BATCH_SIZE = 50  # Mensajes que se toman de la bandeja por lote de envío
+# Un mensaje tomado para enviar (status 'sending') pertenece a su instancia durante este plazo; pasado el plazo
+# se da por interrumpido. Debe superar lo que tarda un lote completo, con el límite por minuto y los reintentos SMTP
+OUTBOX_CLAIM_LEASE = int(os.getenv("NOTIFICATION_OUTBOX_CLAIM_LEASE", 30 * 60))
+
+
+class DigestOutbox:
+    def __init__(self, outbox_path=DIGEST_OUTBOX_PATH, interval_minutes: int = DIGEST_INTERVAL_MINUTES,
+                 max_files: int = DIGEST_MAX_FILES):
+        """
+        Local outbox of pending upload notifications, one digest per recipient. Entries survive between
+        runs (the file is rewritten atomically after every change) and a recipient's digest is sent when
+        its oldest entry is `interval_minutes` old or when it holds `max_files` files.
+
+        Args:
+            outbox_path (str): JSON file of the outbox. Defaults to DIGEST_OUTBOX_PATH (logs/).
+            interval_minutes (int): Maximum age of a digest before it is sent.
+            max_files (int): Number of files that triggers sending a digest right away.
+        """
+        self.outbox_path = outbox_path
+        self.interval = timedelta(minutes=interval_minutes)
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._pending = self._load()  # destinatario -> {"since": ISO, "entries": [AttachmentLog como dict]}
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.outbox_path):
+            return {}
+        try:
+            with open(self.outbox_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f" No se pudo leer la bandeja de resúmenes ({e}); se empieza con una vacía")
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.outbox_path), exist_ok=True)
+        tmp_path = f"{self.outbox_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._pending, file, indent=2, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.outbox_path)
+
+    @staticmethod
+    def _entry_key(entry: dict) -> tuple:
+        return entry.get("path"), entry.get("new_name"), entry.get("original_name"), entry.get("content_hash")
+
+    def add(self, user_attachments_log: dict[str, list[AttachmentLog]]) -> int:
+        """
+        Queues the files of each recipient (the same file is not queued twice in a digest).
+
+        Returns:
+            int: Number of entries added.
+        """
+        added = 0
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            for recipient, logs in user_attachments_log.items():
+                digest = self._pending.setdefault(recipient, {"since": now, "entries": []})
+                queued = {self._entry_key(entry) for entry in digest["entries"]}
+                for log in logs:
+                    entry = log if isinstance(log, dict) else log.model_dump()
+                    if self._entry_key(entry) not in queued:
+                        digest["entries"].append(entry)
+                        queued.add(self._entry_key(entry))
+                        added += 1
+                if not digest["entries"]:
+                    del self._pending[recipient]
+            self._save()
+        return added
+
+    def due(self, now: datetime = None, force = False) -> dict[str, list[dict]]:
+        """Digests that must be sent now: {recipient: entries}. With force=True, all of them."""
+        now = now or datetime.now()
+        with self._lock:
+            return {
+                recipient: list(digest["entries"])
+                for recipient, digest in self._pending.items()
+                if force or len(digest["entries"]) >= self.max_files
+                or now - datetime.fromisoformat(digest["since"]) >= self.interval
+            }
+
+    def remove(self, sent: dict[str, list[dict]]):
+        """Drops the entries that were sent ({recipient: entries}); entries queued meanwhile are kept."""
+        with self._lock:
+            for recipient, entries in sent.items():
+                digest = self._pending.get(recipient)
+                if digest is None:
+                    continue
+                sent_keys = {self._entry_key(entry) for entry in entries}
+                digest["entries"] = [entry for entry in digest["entries"] if self._entry_key(entry) not in sent_keys]
+                if not digest["entries"]:
+                    del self._pending[recipient]
+            self._save()
+
+    def flush(self, outlook_sender, force = False, template_name: str = DIGEST_TEMPLATE, message_outbox = None) -> list[dict]:
+        """
+        Renders the due digests, hands them over to the message outbox (MessageOutbox) and then drains it.
+        A digest leaves this outbox only once its message is stored in the message outbox, which takes
+        care of delivery and retries from then on.
+
+        Returns:
+            list[dict]: Result per message sent in this run (see MessageOutbox.drain).
+        """
+        message_outbox = message_outbox or MessageOutbox()
+        due = self.due(force=force)
+        if due:
+            stored = message_outbox.enqueue_notifications(outlook_sender, due, template_name)
+            self.remove({recipient: due[recipient] for recipient in stored})
+        else:
+            print("- No hay resúmenes de notificación pendientes de envío.")
+        return message_outbox.drain(outlook_sender)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class MessageOutbox:
+    def __init__(self, db_path=OUTBOX_DB_PATH, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 claim_lease: int = OUTBOX_CLAIM_LEASE):
+        """
+        Transactional outbox (SQLite) of rendered notification emails. Every message is stored with an
+        idempotency key (recipient + set of files) before it is sent, so a failed delivery is retried with
+        exponential backoff instead of being lost, the same notification is never queued twice, and a
+        restart resumes delivery from the stored message without rendering it again.
+        Claimed messages ('sending') carry the id of the instance that took them and the time of the claim,
+        and belong to it for `claim_lease` seconds, so other instances (in this run or in a concurrent process)
+        leave them alone. A message whose lease expired may or may not have been accepted by the SMTP server,
+        which does not deduplicate resends: it is marked 'unknown' instead of being sent again, and only goes
+        back to the queue through requeue_unknown (e.g. after checking Sent Items).
+
+        Args:
+            db_path (str): SQLite file. Defaults to OUTBOX_DB_PATH (logs/).
+            max_attempts (int): Attempts before a message is marked as failed. Defaults to OUTBOX_MAX_ATTEMPTS.
+            claim_lease (int): Seconds a claimed message belongs to its instance. Defaults to OUTBOX_CLAIM_LEASE.
+        """
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.claim_lease = claim_lease
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    recipient TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    body_type TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | sent | failed | unknown
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    sent_at REAL,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )""")
+            # Bandejas creadas antes de que existiera el plazo de los mensajes tomados
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(messages)")}
+            for column, column_type in (("claimed_by", "TEXT"), ("claimed_at", "REAL")):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_due ON messages (status, next_attempt_at)")
+        self._recover_expired()
+
+    def _recover_expired(self) -> int:
+        """
+        Marks as 'unknown' the messages whose claim expired (their process died or hung mid-send). Messages
+        claimed within the lease belong to a live instance and are left alone.
+
+        Returns:
+            int: Number of messages marked as 'unknown'.
+        """
+        # No se sabe si el servidor los aceptó, así que no se reenvían solos (se duplicarían)
+        with closing(self._connect()) as connection, connection:
+            interrupted = connection.execute(
+                """UPDATE messages SET status = 'unknown', last_error = ?
+                   WHERE status = 'sending' AND (claimed_at IS NULL OR claimed_at <= ?)""",
+                ("Envío interrumpido: no se sabe si el servidor aceptó el mensaje", time.time() - self.claim_lease),
+            ).rowcount
+        if interrupted:
+            logging.warning(f" {interrupted} notificaciones quedaron a medio enviar (venció su plazo); "
+                            "no se reenvían automáticamente (ver MessageOutbox.requeue_unknown)")
+        return interrupted
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    @staticmethod
+    def idempotency_key(recipient: str, entries: list) -> str:
+        """SHA-256 of the recipient and the set of files (content hash, or folder and name) of a notification."""
+        files = sorted(
+            entry.get("content_hash") or f'{entry.get("path")}/{entry.get("new_name")}'
+            for entry in (log if isinstance(log, dict) else log.model_dump() for log in entries)
+        )
+        return hashlib.sha256(json.dumps([recipient.lower(), files]).encode("utf-8")).hexdigest()
+
+    def enqueue(self, messages: list[dict]) -> list[str]:
+        """
+        Stores rendered messages (recipient, subject, body, body_type, idempotency_key) in one transaction.
+        Messages whose key is already in the outbox are ignored.
+
+        Returns:
+            list[str]: Recipients whose message is now in the outbox (new or already stored).
+        """
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                """INSERT OR IGNORE INTO messages
+                   (idempotency_key, recipient, subject, body, body_type, next_attempt_at, created_at)
+                   VALUES (:idempotency_key, :recipient, :subject, :body, :body_type, :now, :now)""",
+                [{"body_type": "plain", **message, "now": now} for message in messages],
+            )
+        return [message["recipient"] for message in messages]
+
+    def enqueue_notifications(self, outlook_sender, user_attachments_log: dict, template_name: str) -> list[str]:
+        """Renders the notification of each recipient (OutlookSender.render_notifications) and stores it."""
+        messages = outlook_sender.render_notifications(user_attachments_log, template_name)
+        for message in messages:
+            message["idempotency_key"] = self.idempotency_key(message["recipient"], user_attachments_log[message["recipient"]])
+        return self.enqueue(messages)
+
+    def _claim_due(self, limit: int) -> list[sqlite3.Row]:
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT * FROM messages WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE messages SET status = 'sending', attempts = attempts + 1, claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(self.owner_id, now, row["id"]) for row in rows],
+            )
+        return rows
+
+    def _record(self, rows: list[sqlite3.Row], results: list[dict]) -> list[dict]:
+        now = time.time()
+        records = []
+        with closing(self._connect()) as connection, connection:
+            for row, result in zip(rows, results):
+                attempts = row["attempts"] + 1
+                if result["sent"]:
+                    status, next_attempt_at = "sent", row["next_attempt_at"]
+                elif attempts >= self.max_attempts:
+                    status, next_attempt_at = "failed", row["next_attempt_at"]
+                else:
+                    status = "pending"
+                    next_attempt_at = now + min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                # Solo si el mensaje sigue siendo de esta instancia (otra pudo reencolarlo y tomarlo tras vencer el plazo)
+                connection.execute(
+                    "UPDATE messages SET status = ?, next_attempt_at = ?, last_error = ?, sent_at = ? WHERE id = ? AND claimed_by = ?",
+                    (status, next_attempt_at, result["error"], now if result["sent"] else None, row["id"], self.owner_id),
+                )
+                if status == "failed":
+                    logging.error(f" La notificación para {row['recipient']} falló {attempts} veces; no se reintentará: {result['error']}")
+                records.append({**result, "attempts": attempts, "status": status})
+        return records
+
+    def drain(self, outlook_sender, wait = False, batch_size: int = OUTBOX_BATCH_SIZE, sender_name="Outlook Bot") -> list[dict]:
+        """
+        Sends the pending messages whose retry time has come, in batches over one SMTP connection
+        (OutlookSender.send_batch). Failed messages are rescheduled with exponential backoff.
+
+        Args:
+            outlook_sender (OutlookSender): Sender used for the deliveries.
+            wait (bool, optional): Keep waiting for the scheduled retries until the outbox is empty. Defaults to False.
+            batch_size (int, optional): Messages taken from the outbox per batch. Defaults to OUTBOX_BATCH_SIZE.
+            sender_name (str, optional): Sender display name. Defaults to "Outlook Bot".
+
+        Returns:
+            list[dict]: Per message: recipient, sent, attempts (total), error and status (sent | pending | failed).
+        """
+        self._recover_expired()
+        records = []
+        while True:
+            rows = self._claim_due(batch_size)
+            if rows:
+                results = outlook_sender.send_batch([
+                    {"recipient": row["recipient"], "subject": row["subject"], "body": row["body"],
+                     "body_type": row["body_type"], "message_id": f"<{row['idempotency_key']}@correos-automaticos>"}
+                    for row in rows
+                ], sender_name=sender_name)
+                records.extend(self._record(rows, results))
+                continue
+            next_attempt_at = self.next_attempt_at()
+            if not wait or next_attempt_at is None:
+                return records
+            time.sleep(max(0, next_attempt_at - time.time()))
+
+    def requeue_unknown(self, recipients: list[str] = None) -> int:
+        """
+        Puts messages whose delivery was interrupted ('unknown') back in the queue, e.g. after checking that
+        they are not in Sent Items. Attempts are kept.
+
+        Args:
+            recipients (list[str], optional): Only the messages for these recipients. Defaults to all of them.
+
+        Returns:
+            int: Number of messages requeued.
+        """
+        query = "UPDATE messages SET status = 'pending', next_attempt_at = ? WHERE status = 'unknown'"
+        params = [time.time()]
+        if recipients is not None:
+            query += f" AND recipient IN ({', '.join('?' * len(recipients))})"
+            params += list(recipients)
+        with closing(self._connect()) as connection, connection:
+            return connection.execute(query, params).rowcount
+
+    def next_attempt_at(self):
+        """Time (epoch) of the next scheduled delivery, or None if nothing is pending."""
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT MIN(next_attempt_at) FROM messages WHERE status = 'pending'").fetchone()[0]
+
+    def counts(self) -> dict:
+        """Number of messages per status."""
+        with closing(self._connect()) as connection:
+            return dict(connection.execute("SELECT status, COUNT(*) FROM messages GROUP BY status").fetchall())
@@ -9,11 +9,21 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import date, datetime, timedelta
 import re
+import json
 from collections import defaultdict
 import imaplib
 import socket
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from tenacity import retry, stop_after_attempt, wait_fixed
 from correos_automaticos.classes.models import EmailData
+from correos_automaticos.classes.attachment_store import AttachmentStore, MANIFEST_NAME
+from correos_automaticos.classes.imap_parser import iter_fetch_response, parse_envelope, find_attachment_parts, PartDecoder
+from correos_automaticos.classes.template_engine import CompiledTemplate, Markup, load_template
+from correos_automaticos.classes.notifications import MessageOutbox
 
 script_dir = os.path.dirname(__file__)
 
@@ -35,21 +45,223 @@ OUTLOOK_PASSWORD = os.getenv("OUTLOOK_PASSWORD")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = os.getenv("SMTP_PORT")
 
+# Número de UIDs que se piden en cada UID FETCH
+FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH_SIZE", 200))
+
+# Tamaño (en bytes codificados) de cada trozo de adjunto pedido al servidor
+IMAP_CHUNK_SIZE = int(os.getenv("IMAP_CHUNK_SIZE", 1024 * 1024))
+
+# Máximo de conexiones IMAP simultáneas para descargar adjuntos
+IMAP_MAX_CONNECTIONS = int(os.getenv("IMAP_MAX_CONNECTIONS", 4))
+
+# Estado de sincronización (UIDVALIDITY / último UID procesado) por buzón y carpeta
+SYNC_STATE_PATH = os.path.join(script_dir, "..", "logs", "imap_sync_state.json")
+
+# Envío por lotes: límite de mensajes por minuto (Exchange Online permite 30) y reintentos ante desconexiones
+SMTP_MAX_PER_MINUTE = int(os.getenv("SMTP_MAX_PER_MINUTE", 30))
+SMTP_MAX_RETRIES = int(os.getenv("SMTP_MAX_RETRIES", 3))
+
+# Detalle de cada archivo en las notificaciones (los valores se escapan como HTML)
+ATTACHMENT_DETAILS_TEMPLATE = CompiledTemplate(
+    "<li><strong>{original_name}</strong><ul><li>Nuevo nombre: {new_name}</li><li>Ubicación: {path}</li></ul></li>"
+)
+
+
+class IMAPConnectionPool:
+    def __init__(self, connect, size=IMAP_MAX_CONNECTIONS, folder="INBOX"):
+        """
+        Bounded pool of authenticated IMAP connections to share between worker threads.
+        Connections are opened lazily (at most `size`) and each one selects `folder` in read-only mode.
+
+        Args:
+            connect (callable): Returns a new authenticated connection (e.g. OutlookRetriever._connect).
+            size (int): Maximum number of simultaneous connections (keep it under the Exchange limits).
+            folder (str): Folder selected on every connection. Defaults to "INBOX".
+        """
+        self._connect = connect
+        self.size = size
+        self.folder = folder
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._connections = []
+        self._closed = False
+
+    def _open(self):
+        connection = self._connect()
+        connection.select(self.folder, readonly=True)
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        try:
+            connection.logout()
+        except Exception:
+            pass
+
+    def _release(self, connection):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(connection)
+                return
+        self._discard(connection)  # El pool se cerró mientras estaba prestada
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool (blocks while `size` connections are in use).
+        Connections that fail with a connection error are discarded instead of returned.
+        """
+        with self._slots:
+            if self._closed:
+                raise ValueError("- El pool de conexiones IMAP ya está cerrado")
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._open()
+            try:
+                yield connection
+            except (imaplib.IMAP4.abort, OSError):
+                self._discard(connection)
+                raise
+            except BaseException:
+                self._release(connection)
+                raise
+            else:
+                self._release(connection)
+
+    def close(self):
+        """
+        Logs out the idle connections. Connections still borrowed are logged out when they are
+        returned; after closing, the pool does not lend connections anymore.
+        """
+        idle = []
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    idle.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+        for connection in idle:
+            self._discard(connection)
+
+
+class SyncCheckpoint:
+    def __init__(self, folder="INBOX", state_path=SYNC_STATE_PATH):
+        """
+        UID checkpoint of a mailbox folder for incremental syncs (see OutlookRetriever.iter_emails).
+        It only moves over the contiguous prefix of UIDs marked as done, so an email that failed, or
+        whose processing did not finish (e.g. a crash between the download and the upload), is
+        searched again in the next run. Thread-safe: the stages of a pipeline can mark UIDs as done
+        while another one saves.
+
+        Args:
+            folder (str): Mailbox folder. Defaults to "INBOX".
+            state_path (str): JSON file of the sync state. Defaults to SYNC_STATE_PATH (logs/).
+        """
+        self.folder = folder
+        self.state_path = state_path
+        self.folder_status = None
+        self.last_uid = 0     # Todos los UIDs buscados hasta este ya se procesaron
+        self._uids = []       # UIDs encontrados en esta ejecución, en orden ascendente
+        self._position = 0    # Cuántos de `_uids` ya quedaron cubiertos por last_uid
+        self._done = set()
+        self._saved_uid = None  # Último valor escrito en disco
+        self._lock = threading.Lock()
+
+    def start(self, folder_status: dict) -> int:
+        """
+        Loads the persisted checkpoint of the selected folder.
+
+        Returns:
+            int: Last processed UID, or 0 if there is no checkpoint or the folder UIDVALIDITY changed (full resync).
+        """
+        sync_state = OutlookRetriever.load_sync_state(self.folder, self.state_path)
+        with self._lock:
+            self.folder_status = folder_status
+            self.last_uid = 0
+            if sync_state and sync_state.get("uidvalidity") == folder_status["uidvalidity"]:
+                self.last_uid = sync_state.get("last_uid", 0)
+            self._uids, self._position, self._done = [], 0, set()
+            self._saved_uid = self.last_uid or None
+            return self.last_uid
+
+    def track(self, uids):
+        """Registers the UIDs found by the search: the checkpoint does not move past any of them until it is done."""
+        with self._lock:
+            self._uids = sorted(int(uid) for uid in uids if int(uid) > self.last_uid)
+            self._position = 0
+
+    def done(self, *uids):
+        """Marks UIDs as fully processed."""
+        with self._lock:
+            self._done.update(int(uid) for uid in uids)
+
+    @property
+    def pending(self) -> list[int]:
+        """UIDs found in this run that are not done yet."""
+        with self._lock:
+            return [uid for uid in self._uids if uid not in self._done]
+
+    def _advance(self) -> int:
+        while self._position < len(self._uids) and self._uids[self._position] in self._done:
+            self._position += 1
+        if self._position < len(self._uids):
+            return max(self.last_uid, self._uids[self._position] - 1)  # Justo antes del primer UID pendiente
+        # Todo lo encontrado está hecho: se avanza hasta el último UID de la carpeta
+        uidnext = self.folder_status.get("uidnext")
+        return max(self.last_uid, self._uids[-1] if self._uids else 0, uidnext - 1 if uidnext else 0)
+
+    def save(self) -> int:
+        """
+        Persists the checkpoint, moved over the contiguous prefix of UIDs that are done. The file is
+        only rewritten when the checkpoint moved (iter_emails calls this once per batch).
+
+        Returns:
+            int: Last UID saved.
+        """
+        with self._lock:
+            if self.folder_status is None:
+                return 0  # Todavía no se seleccionó la carpeta (ver start)
+            self.last_uid = self._advance()
+            if self.last_uid == self._saved_uid:
+                return self.last_uid
+            self._saved_uid = self.last_uid
+            OutlookRetriever.save_sync_state({
+                "uidvalidity": self.folder_status["uidvalidity"],
+                "last_uid": self.last_uid,
+                "highestmodseq": self.folder_status["highestmodseq"],
+                "updated": datetime.now().isoformat(timespec="seconds"),
+            }, self.folder, self.state_path)
+            return self.last_uid
+
 
 class OutlookRetriever:
-    def __init__(self):
+    def __init__(self, attachment_store: AttachmentStore = None):
         self.mail = None
+        self.attachment_store = attachment_store or AttachmentStore()
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1))    
     def _auth(self):
+        self.mail = self._connect()
+
+    @staticmethod
+    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1))    
+    def _connect() -> imaplib.IMAP4_SSL:
+        """Opens and authenticates a new IMAP connection (used by `_auth` and by IMAPConnectionPool)."""
         print("- Intentando establecer conexión con Outlook...")
         try:
             # Verify the server is reachable first
             socket.gethostbyname(IMAP_SERVER)
             
-            self.mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            self.mail.login(OUTLOOK_EMAIL, OUTLOOK_PASSWORD)
+            mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+            mail.login(OUTLOOK_EMAIL, OUTLOOK_PASSWORD)
             print(f'- Conexión IMAP exitosa para el correo {OUTLOOK_EMAIL}')
+            return mail
             
         except socket.gaierror as e:
             raise ValueError(f"- Error de resolución DNS: No se puede conectar a {IMAP_SERVER}. "
@@ -84,10 +296,11 @@ class OutlookRetriever:
         
         return decoded_value
         
-    def decode_text(self, text):
+    def decode_text(self, text, strict=False):
         """
         Decodifica un texto codificado en formato MIME usando safe_decode.
-        Maneja tanto asuntos como nombres de archivos.
+        Maneja tanto asuntos como nombres de archivos. Con strict=True un error de
+        decodificación se propaga (ValueError) en lugar de devolver el texto sin decodificar.
         """
         if not text:
             return ""
@@ -107,162 +320,504 @@ class OutlookRetriever:
             return result.strip()
             
         except Exception as e:
+            if strict:
+                raise ValueError(f"Error decoding MIME text '{text}': {e}") from e
             print(f"Error decoding MIME text: {e}")
             # Si falla la decodificación MIME, intentar safe_decode directamente
             return self.safe_decode(text)
                 
-    def get_emails(self, start_date=None, subject_filter=SUBJECT_FILTER, parameter="ALL") -> list[EmailData]:
+    def _clean_attachment_name(self, attachment_name, msg_id) -> str:
         """
-        Filters emails by date or subject (optional). If no date is provided, retrieves all emails.
+        Decodes a (MIME encoded) attachment name and removes characters not valid in file names.
+        Raises ValueError if the name cannot be decoded (the email is skipped instead of losing the attachment).
+        """
+        if not attachment_name:
+            return ""
+        try:
+            attachment_name = self.decode_text(attachment_name, strict=True)
+        except ValueError as decode_err:
+            raise ValueError(f"Error decoding the attachment name '{attachment_name}' from email with ID {msg_id}: {decode_err}") from decode_err
+        # Limpiar caracteres no válidos en el nombre del archivo
+        return re.sub(r'[<>:"/\\|?*\r\n]', '', attachment_name)
 
-        Args:
-            start_date (str): Date from which to retrieve emails in the format 'DD-Mon-YYYY' (e.g., "01-Jan-2023").
-            subject_filter (str): Text that must be present in the email subject.
-            limit (int): Maximum number of emails to retrieve.
-            parameter (str): Additional search parameter (e.g., 'ALL', 'RECENT'). 
+    def _uid_fetch(self, msg_id, items: str, connection_pool=None):
+        """Runs UID FETCH on a pool connection if a pool is given, otherwise on `self.mail`."""
+        if connection_pool:
+            with connection_pool.connection() as connection:
+                return connection.uid("FETCH", msg_id, items)
+        return self.mail.uid("FETCH", msg_id, items)
+
+    def _build_search_criteria(self, start_date=None, subject_filter=None, parameter="ALL"):
+        """
+        Builds the arguments for IMAP SEARCH, pushing the subject filter to the server.
+        Non ASCII subjects are sent as an UTF-8 literal (CHARSET UTF-8).
+
+        Returns:
+            tuple: (charset, criteria, literal) or (None, None, None) if the date format is invalid. `literal`
+                (bytes or None) is the subject that _search_uids hands to imaplib for that SEARCH only.
+        """
+        charset = None
+        literal = None
+        if start_date:
+            try:
+                datetime.strptime(start_date, "%d-%b-%Y")  # Validate the date format
+                criteria = ["SINCE", start_date.upper()]
+            except ValueError:
+                print("The date format is incorrect. It should be 'DD-Mon-YYYY' (e.g., 01-Jan-2023).")
+                return None, None, None
+        else:
+            criteria = [parameter]
+
+        if subject_filter:
+            if subject_filter.isascii():
+                escaped_subject = subject_filter.replace("\\", "\\\\").replace('"', '\\"')
+                criteria += ["SUBJECT", f'"{escaped_subject}"']
+            else:
+                charset = "UTF-8"
+                literal = subject_filter.encode("utf-8")  # imaplib lo envía al final del comando
+                criteria += ["SUBJECT"]
+        return charset, criteria, literal
+
+    @staticmethod
+    def compress_uids(uids) -> str:
+        """
+        Compresses a list of UIDs into an IMAP message set with ranges.
+
+        Example:
+            [1001, 1002, 1003, 1010] -> "1001:1003,1010"
+        """
+        ranges = []
+        for uid in sorted(set(int(uid) for uid in uids)):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in ranges)
+
+    def _search_uids(self, charset, search_criteria, literal: bytes = None) -> list[int]:
+        """Runs UID SEARCH and returns the matching UIDs in ascending order."""
+        if charset:
+            search_criteria = ["CHARSET", charset, *search_criteria]
+        # imaplib envía (y descarta) el literal con el siguiente comando: se fija justo antes del SEARCH
+        self.mail.literal = literal
+        status, messages = self.mail.uid("SEARCH", *search_criteria)
+        if status != "OK":
+            raise ValueError("Failed to retrieve emails from the inbox.")
+        return sorted(int(uid) for uid in messages[0].split())
+
+    def _download_attachment_parts(self, msg_id, attachment_parts: list[dict], connection_pool=None, chunk_size=IMAP_CHUNK_SIZE) -> dict:
+        """
+        Streams the given attachment parts of one email to its staging folder (DOWNLOAD_PATH/<UID>). Every round trip asks for the
+        next `chunk_size` encoded bytes of all the pending parts (BODY.PEEK[<part>]<offset.size>) and the
+        chunks are decoded straight into files of the attachment store, so memory use stays flat
+        regardless of the attachment size.
+
+        The content is hashed while it is written: a payload already downloaded in this session
+        (same SHA-256) is not written again (the manifest of the email points to the stored copy).
+
+        Returns:
+            dict: name -> SHA-256 of the attachments saved (or deduplicated), in the same order as `attachment_parts`.
+
+        Raises:
+            Exception: If any part cannot be fetched or saved. Nothing is returned partially (the temporary
+                files are discarded), so the caller never mistakes a failed download for an email without attachments.
+        """
+        outputs = {}
+        saved = {}  # parte -> SHA-256
+        try:
+            for attachment_part in attachment_parts:
+                writer = self.attachment_store.open_temp()
+                outputs[attachment_part["part"]] = (attachment_part, writer, PartDecoder(attachment_part["encoding"], writer))
+
+            pending = set(outputs)
+            offset = 0
+            while pending:
+                sections = " ".join(f"BODY.PEEK[{part}]<{offset}.{chunk_size}>" for part in sorted(pending))
+                status, msg_data = self._uid_fetch(msg_id, f"({sections})", connection_pool)
+                if status != "OK":
+                    raise ValueError(f"Error retrieving the attachments of email with ID {msg_id}.")
+
+                chunks = {}
+                for message in iter_fetch_response(msg_data):
+                    for key, value in message.items():
+                        # Ej. "BODY[2]<1048576>" -> "2"
+                        if key.startswith("BODY[") and "]" in key:
+                            chunks[key[len("BODY["):key.index("]")]] = value or b""
+
+                for part in sorted(pending):
+                    if part not in chunks:
+                        raise ValueError(f"Part {part} of email with ID {msg_id} came back empty.")
+                    _, _, decoder = outputs[part]
+                    decoder.write(chunks[part])
+                    if len(chunks[part]) < chunk_size:
+                        decoder.close()
+                        pending.discard(part)
+                offset += chunk_size
+
+            staging_dir = self.message_dir(msg_id)
+            for part, (attachment_part, writer, _) in outputs.items():
+                sha256, _ = self.attachment_store.commit(writer, os.path.join(staging_dir, attachment_part["name"]))
+                saved[part] = sha256
+        finally:
+            for part, (_, writer, _) in outputs.items():
+                if part not in saved:
+                    self.attachment_store.discard(writer)  # No dejar archivos incompletos
+        return {attachment_part["name"]: saved[attachment_part["part"]] for attachment_part in attachment_parts}
+
+    @staticmethod
+    def message_dir(msg_id, create=True) -> str:
+        """Staging folder of the attachments of one email: DOWNLOAD_PATH/<UID>."""
+        staging_dir = os.path.join(DOWNLOAD_PATH, str(msg_id))
+        if create:
+            os.makedirs(staging_dir, exist_ok=True)
+        return staging_dir
+
+    def _write_manifest(self, email_data: EmailData):
+        """
+        Writes DOWNLOAD_PATH/<UID>/manifest.json with the origin of every attachment of the email.
+        Attachments deduplicated by the store point (`duplicate_of`) to the staged copy they share.
+        """
+        staging_dir = self.message_dir(email_data.msg_id)
+        attachments = []
+        for name, sha256 in email_data.attachment_hashes.items():
+            stored_path = self.attachment_store.materialized_path(sha256)
+            own_path = os.path.join(staging_dir, name)
+            duplicate_of = None
+            if stored_path and os.path.abspath(stored_path) != os.path.abspath(own_path):
+                duplicate_of = os.path.relpath(stored_path, DOWNLOAD_PATH).replace(os.sep, "/")
+            attachments.append({"name": name, "sha256": sha256, "duplicate_of": duplicate_of})
+
+        manifest = {
+            "msg_id": email_data.msg_id,
+            "from_name": email_data.from_name,
+            "from_email": email_data.from_email,
+            "subject": email_data.subject,
+            "sent": email_data.sent,
+            "attachments": attachments,
+        }
+        with open(os.path.join(staging_dir, MANIFEST_NAME), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2, ensure_ascii=False)
+
+    def _get_attachment_parts(self, msg_id, bodystructure) -> list[dict]:
+        """
+        Returns the attachment parts of a BODYSTRUCTURE with their cleaned file `name`. Names are unique
+        within the email (case-insensitive): a repeated name gets a suffix, e.g. "T1.xlsx", "T1 (2).xlsx",
+        so two attachments with the same file name do not overwrite each other in the staging folder.
+        """
+        attachment_parts = []
+        used_names = set()
+        for attachment_part in find_attachment_parts(bodystructure):
+            name = self._clean_attachment_name(attachment_part["filename"], msg_id)
+            if not name:
+                continue
+            stem, extension = os.path.splitext(name)
+            copy = 1
+            while name.lower() in used_names:
+                copy += 1
+                name = f"{stem} ({copy}){extension}"
+            used_names.add(name.lower())
+            attachment_part["name"] = name
+            attachment_parts.append(attachment_part)
+        return attachment_parts
+
+    def _build_email_data(self, message: dict, subject_filter=None, download=False, connection_pool=None):
+        """
+        Builds the EmailData of one parsed FETCH response (ENVELOPE + BODYSTRUCTURE),
+        downloading its attachments if requested (through `connection_pool` if given).
+
+        Returns:
+            EmailData or None if the subject does not match.
+        """
+        msg_id = message["UID"]
+        envelope = parse_envelope(message["ENVELOPE"])
+
+        # Extract details
+        subject = self.decode_text(envelope["subject"], strict=True)
+        if subject_filter and subject_filter.lower() not in subject.lower():
+            return None # El servidor ya filtra por asunto; se mantiene por seguridad
+
+        attachment_parts = self._get_attachment_parts(msg_id, message["BODYSTRUCTURE"])
+
+        # Extract attachments (and save them in the same pass if requested)
+        attachment_hashes = {}
+        if download and attachment_parts:
+            attachment_hashes = self._download_attachment_parts(msg_id, attachment_parts, connection_pool)
+            attachments = list(attachment_hashes)
+        else:
+            attachments = [attachment_part["name"] for attachment_part in attachment_parts]
+
+        email_data = EmailData(
+            msg_id = msg_id,
+            from_name= self.decode_text(envelope["from_name"], strict=True),
+            from_email = envelope["from_email"],
+            sent = envelope["date"],
+            to = self.decode_text(envelope["to"], strict=True),
+            subject = subject,
+            body = "",
+            attachments = attachments,
+            attachment_hashes = attachment_hashes
+        )
+        if download and attachment_hashes:
+            self._write_manifest(email_data)
+        return email_data
+
+    def _process_message(self, message: dict, subject_filter=None, download=False, connection_pool=None) -> tuple:
+        """
+        `_build_email_data` that reports errors instead of raising (safe for worker threads).
 
         Returns:
-            dictionary: a dict containing relevant data of every email fetched
+            tuple: (UID, EmailData or None if the subject does not match, ok). `ok` is False if the email
+                could not be parsed or its attachments could not be downloaded.
+        """
+        msg_id = message.get("UID")
+        try:
+            return msg_id, self._build_email_data(message, subject_filter, download, connection_pool), True
+        except Exception as e:
+            print(f"Error processing email with ID {msg_id} ({e}); se omite y se volverá a intentar en la siguiente ejecución")
+            return msg_id, None, False
+
+    def _select_folder(self, folder="INBOX") -> dict:
+        """
+        Selects a folder and returns its UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ (if the server reports it).
+        """
+        status, _ = self.mail.select(folder)
+        if status != "OK":
+            raise ValueError(f"No se pudo seleccionar la carpeta {folder}.")
+        folder_status = {}
+        for key in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            _, values = self.mail.response(key)
+            value = values[-1] if values and values[-1] is not None else None
+            folder_status[key.lower()] = int(value) if value is not None else None
+        return folder_status
+
+    @staticmethod
+    def _sync_key(folder) -> str:
+        return f"{OUTLOOK_EMAIL}/{folder}"
+
+    @classmethod
+    def load_sync_state(cls, folder="INBOX", state_path=SYNC_STATE_PATH) -> dict:
+        """
+        Returns the persisted sync state of a mailbox folder:
+        {"uidvalidity": int, "last_uid": int, "highestmodseq": int | None} or {} if there is none.
+        """
+        if not os.path.exists(state_path):
+            return {}
+        try:
+            with open(state_path, "r", encoding="utf-8") as file:
+                return json.load(file).get(cls._sync_key(folder), {})
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"- No se pudo leer el estado de sincronización ({e}); se hará una sincronización completa")
+            return {}
+
+    @classmethod
+    def save_sync_state(cls, sync_state: dict, folder="INBOX", state_path=SYNC_STATE_PATH):
+        """Persists the sync state of a mailbox folder (written to a temp file and then replaced)."""
+        all_states = {}
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as file:
+                    all_states = json.load(file)
+            except (json.JSONDecodeError, OSError):
+                all_states = {}
+        all_states[cls._sync_key(folder)] = sync_state
+
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(all_states, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, state_path)
+
+    def iter_emails(self, start_date=None, subject_filter=SUBJECT_FILTER, parameter="ALL", download=False, batch_size=FETCH_BATCH_SIZE, incremental=False, folder="INBOX", max_workers=IMAP_MAX_CONNECTIONS, ledger=None, checkpoint: SyncCheckpoint = None):
+        """
+        Generator version of `get_emails`. UIDs are fetched in batches of `batch_size` with a single
+        UID FETCH over a compressed message set (e.g. "1001:1200"), and every batch is parsed and
+        yielded before requesting the next one, so memory stays bounded by the batch size.
+
+        With `incremental=True` only emails newer than the persisted checkpoint are searched
+        (UID <last_uid + 1>:*). If there is no checkpoint or the folder UIDVALIDITY changed, a full
+        resync is done with the usual criteria (`start_date`/`parameter`). The checkpoint only moves
+        over the contiguous prefix of UIDs that are done (see SyncCheckpoint) and is saved after every
+        batch. Emails that fail are not yielded and stay pending, so they are searched again in the next run.
+
+        Without a `checkpoint`, an email counts as done once the consumer asks for the next one. A caller
+        that processes the emails further (rename, upload) should pass its own SyncCheckpoint (this
+        implies `incremental=True`), mark each UID with `checkpoint.done(uid)` once its processing
+        finished, and call `checkpoint.save()` at the end.
+
+        With `download=True` and `max_workers > 1` the attachments of each batch are fetched in
+        parallel over an IMAPConnectionPool of at most `max_workers` connections; results are still
+        yielded in UID order.
+
+        With a `ledger` (ProcessingLedger), emails it already lists as processed are skipped before
+        any FETCH.
+
+        Yields:
+            EmailData: one per matching email, in ascending UID order.
         """
         if not self.mail:
             raise ValueError("Debes autenticarte usando el método `_auth`")
-        emails_data = []
-        try:
-            self.mail.select("INBOX")
+        folder_status = self._select_folder(folder)
 
-            if start_date:
-                try:
-                    datetime.strptime(start_date, "%d-%b-%Y")  # Validate the date format
-                    search_criteria = f"SINCE {start_date.upper()}"
-                except ValueError:
-                    print("The date format is incorrect. It should be 'DD-Mon-YYYY' (e.g., 01-Jan-2023).")
-                    return {}
-            else:
-                search_criteria = parameter
+        owns_checkpoint = checkpoint is None
+        if checkpoint is None and incremental:
+            checkpoint = SyncCheckpoint(folder)
+        last_uid = checkpoint.start(folder_status) if checkpoint else 0
+        if last_uid:
+            # El rango de UIDs reemplaza al criterio de fecha/parámetro (start_date no se usa ni se valida)
+            charset, search_criteria, literal = self._build_search_criteria(None, subject_filter, f"UID {last_uid + 1}:*")
+            print(f"- Sincronización incremental de {folder} desde el UID {last_uid + 1}")
+        else:
+            if checkpoint:
+                print(f"- Sin estado previo o UIDVALIDITY distinto para {folder}: sincronización completa")
+            charset, search_criteria, literal = self._build_search_criteria(start_date, subject_filter, parameter)
+            if not search_criteria:
+                return
 
-            # Retrieving emails
-            status, messages = self.mail.search(None, search_criteria)
-            if status != "OK":
-                print("Failed to retrieve emails from the inbox.")
-                return {}
+        # Retrieving emails ("n:*" siempre devuelve al menos el último UID, por eso se filtra)
+        uids = [uid for uid in self._search_uids(charset, search_criteria, literal) if uid > last_uid]
+        print(f'- Se han obtenido {len(uids)} IDs de correos luego de aplicar el filtro')
+        if checkpoint:
+            checkpoint.track(uids)
+        if ledger is not None and uids:
+            processed = ledger.processed_emails(uids)
+            if processed:
+                uids = [uid for uid in uids if str(uid) not in processed]
+                if checkpoint:
+                    checkpoint.done(*processed)
+                print(f"- {len(processed)} correos ya estaban procesados según el registro; se omiten")
 
-            message_ids = messages[0].split()
+        connection_pool = None
+        executor = None
+        if download and max_workers > 1 and uids:
+            connection_pool = IMAPConnectionPool(self._connect, size=max_workers, folder=folder)
+            executor = ThreadPoolExecutor(max_workers=max_workers)
 
-            # Obtain filtered emails by id
-            for msg_id in message_ids:
-                try:
-                    status, msg_data = self.mail.fetch(msg_id, "(RFC822)")
-                    if status != "OK":
-                        print(f"Error retrieving the info of email with ID {msg_id}.")
+        try:
+            # Obtain filtered emails by batches of UIDs (solo cabeceras y estructura)
+            for start in range(0, len(uids), batch_size):
+                batch = uids[start:start + batch_size]
+                message_set = self.compress_uids(batch)
+                status, msg_data = self.mail.uid("FETCH", message_set, "(UID ENVELOPE BODYSTRUCTURE)")
+                if status != "OK":
+                    print(f"Error retrieving the info of emails {message_set}.")
+                    continue  # Quedan pendientes: el checkpoint no los pasa
+
+                messages = iter_fetch_response(msg_data)
+                if executor:
+                    # map conserva el orden de los UIDs aunque las descargas terminen en otro orden
+                    results = executor.map(lambda message: self._process_message(message, subject_filter, download, connection_pool), messages)
+                else:
+                    results = (self._process_message(message, subject_filter, download) for message in messages)
+
+                received = set()
+                for msg_id, email_data, ok in results:
+                    received.add(str(msg_id))
+                    if not ok:
+                        continue  # El correo fallido queda pendiente y se vuelve a buscar en la siguiente ejecución
+                    if email_data is None:
+                        if checkpoint:
+                            checkpoint.done(msg_id)  # No coincide con el asunto: no hay nada más que hacer
                         continue
+                    yield email_data
+                    if checkpoint and owns_checkpoint:
+                        checkpoint.done(msg_id)
+                missing = {str(uid) for uid in batch} - received
+                if missing:
+                    print(f"- El servidor no devolvió {len(missing)} correos del lote {message_set}")
 
-                    for response_part in msg_data:
-                        if isinstance(response_part, tuple):
-                            msg = email.message_from_bytes(response_part[1]) # contains all email parts in binary
-
-                            # Extract details
-                            subject = self.decode_text(msg.get("Subject", ""))
-                            if subject_filter and subject_filter.lower() not in subject.lower():
-                                    continue # Skip emails that don't match subject filter before continuing
-                            sender = self.decode_text(msg.get("From", ""))  # Use safe_decode to decode the sender
-                            recipient = self.decode_text(msg.get("To", ""))
-                            date = self.decode_text(msg.get("Sent", ""))
-                            body = self.decode_text(msg.get("Body", ""))   
-                            attachments = []
-
-                            # Extract attachments
-                            for part in msg.walk():  # part meansemail part; walk() iterates over multiple attachments as well
-                                if part.get_content_disposition() == "attachment":
-                                    attachment_name = part.get_filename()
-                                    if attachment_name:
-                                        # Decode file name
-                                        try:
-                                            attachment_name = self.decode_text(attachment_name)
-                                            # Limpiar caracteres no válidos en el nombre del archivo
-                                            attachment_name = re.sub(r'[<>:"/\\|?*\r\n]', '', attachment_name)
-                                        except Exception as decode_err:
-                                            print(f"Error decoding the attachment name '{attachment_name}' from email with ID {msg_id}: {decode_err}")
-                                            continue  # Saltar este archivo si hay un error en el nombre
-
-                                        attachments.append(attachment_name)
-
-                            # Extract name and email from "From" field
-                            sender_match = re.match(r"([a-zA-Z\s]+) <(.+)>", sender)
-                            if sender_match:
-                                from_name = sender_match.group(1).strip()  # Extract name before <email>
-                                from_email = sender_match.group(2)  # Extract the email inside <>
-
-                            # Store in a list with updated format
-                            emails_data.append(EmailData(
-                                msg_id = msg_id.decode(),
-                                from_name= from_name,
-                                from_email = from_email,
-                                sent = date,
-                                to = recipient,
-                                subject = subject,
-                                body = body,
-                                attachments = attachments        
-                            ))
-                        
-                                      
-                except Exception as e:
-                    print(f"Error processing email with ID {msg_id}: {e}")
+                if checkpoint:
+                    checkpoint.save()
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+            if connection_pool:
+                connection_pool.close()
+            if checkpoint:
+                checkpoint.save()
+
+    def get_emails(self, start_date=None, subject_filter=SUBJECT_FILTER, parameter="ALL", download=False, batch_size=FETCH_BATCH_SIZE, incremental=False, folder="INBOX", max_workers=IMAP_MAX_CONNECTIONS, ledger=None, checkpoint: SyncCheckpoint = None) -> list[EmailData]:
+        """
+        Filters emails by date or subject (optional). If no date is provided, retrieves all emails.
+        The fetch is staged: the subject filter is part of the IMAP SEARCH, then only ENVELOPE and
+        BODYSTRUCTURE are fetched (in batches of UIDs) and, with `download=True`, only the attachment
+        parts are fetched (BODY.PEEK[<part>]) and written to DOWNLOAD_PATH. The full RFC822 is never downloaded.
 
-            print(f'- Se han obtenido {len(message_ids)} IDs de correos luego de aplicar el filtro')
-            return emails_data
+        Args:
+            start_date (str): Date from which to retrieve emails in the format 'DD-Mon-YYYY' (e.g., "01-Jan-2023").
+            subject_filter (str): Text that must be present in the email subject.
+            parameter (str): Additional search parameter (e.g., 'ALL', 'RECENT'). 
+            download (bool): If True, saves the attachments of every matching email in the same pass.
+            batch_size (int): Number of UIDs requested per UID FETCH. Defaults to IMAP_FETCH_BATCH_SIZE.
+            incremental (bool): If True, only emails newer than the persisted UID checkpoint are fetched
+                (`start_date` is only used for the first, full sync or after a UIDVALIDITY change).
+            folder (str): Mailbox folder to read. Defaults to "INBOX".
+            max_workers (int): Maximum number of parallel IMAP connections used to download attachments.
+                Defaults to IMAP_MAX_CONNECTIONS; 1 downloads everything over `self.mail`.
+            ledger (ProcessingLedger, optional): Skip the emails already processed according to this ledger.
+            checkpoint (SyncCheckpoint, optional): Checkpoint owned by the caller, which marks every email as done
+                once it finished processing it (see iter_emails). Without it, the emails returned count as done.
 
+        Returns:
+            list[EmailData]: relevant data of every email fetched. `msg_id` holds the UID of the email.
+        """
+        if not self.mail:
+            raise ValueError("Debes autenticarte usando el método `_auth`")
+        start_time = time.perf_counter()
+        try:
+            emails_data = list(self.iter_emails(start_date, subject_filter, parameter, download, batch_size, incremental, folder, max_workers, ledger, checkpoint))
         except Exception as e:
             print(f"Error retrieving emails: {e}")
             return []
 
+        elapsed = time.perf_counter() - start_time
+        rate = len(emails_data) / elapsed if elapsed else 0
+        print(f"- {len(emails_data)} correos procesados en {elapsed:.2f}s ({rate:.1f} correos/s)")
+        return emails_data
+
 
-    def download_attachments(self, emails_data: list[EmailData])-> list:
+    def download_attachments(self, emails_data: list[EmailData], max_workers=IMAP_MAX_CONNECTIONS)-> list:
         """
-        Downloads attachments from email data dictionary
+        Downloads attachments from email data dictionary. The emails are processed in parallel over
+        an IMAPConnectionPool of at most `max_workers` connections; for each one only its BODYSTRUCTURE
+        is fetched and the attachment parts are streamed to disk in chunks (no full RFC822 in memory).
 
         Args:
             email_data (dict)
+            max_workers (int): Maximum number of parallel IMAP connections. Defaults to IMAP_MAX_CONNECTIONS.
 
         Returns:
-            None 
+            list: names of the downloaded attachments, in the same order as `emails_data`.
         """
-        attachment_names = []
-        for email_data in emails_data:
+        def download_email(connection_pool, email_data: EmailData) -> list:
             msg_id = email_data.msg_id
             try:
-                self.mail.select("INBOX")
-                status, msg_data = self.mail.fetch(msg_id.encode(), "(RFC822)")
+                status, msg_data = self._uid_fetch(msg_id, "(UID BODYSTRUCTURE)", connection_pool)
                 if status != "OK":
                     print(f"Error retrieving email with ID {msg_id}.")
-                    continue
-
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        for part in msg.walk():   # part means email part; walk() iterates over multiple attachments as well
-                            if part.get_content_disposition() == "attachment":
-                                attachment_name = part.get_filename()
-                                if attachment_name:
-                                    # Decodificar el nombre del archivo
-                                    attachment_name = self.decode_text(attachment_name)
-                                    # Limpiar caracteres no válidos en el nombre del archivo
-                                    attachment_name = re.sub(r'[<>:"/\\|?*\r\n]', '', attachment_name)
-                                    
-                                    try:
-                                        # Crear el path y guardar el archivo
-                                        file_path = os.path.join(DOWNLOAD_PATH, attachment_name)
-                                        with open(file_path, "wb") as f:
-                                            f.write(part.get_payload(decode=True))
-
-                                        # Añadir el nombre del archivo original a la lista
-                                        attachment_names.append(attachment_name)
-                                        
-                                    except Exception as e:
-                                        print(f"Error saving attachment '{attachment_name}' from email {msg_id}: {e}")
+                    return []
+
+                attachment_parts = []
+                for message in iter_fetch_response(msg_data):
+                    attachment_parts.extend(self._get_attachment_parts(msg_id, message["BODYSTRUCTURE"]))
+                email_data.attachment_hashes = self._download_attachment_parts(msg_id, attachment_parts, connection_pool)
+                if email_data.attachment_hashes:
+                    self._write_manifest(email_data)
+                return list(email_data.attachment_hashes)
 
             except Exception as e:
                 print(f"Error processing email with ID {msg_id} when downloading: {e}")
+                return []
+
+        attachment_names = []
+        connection_pool = IMAPConnectionPool(self._connect, size=max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for names in executor.map(lambda email_data: download_email(connection_pool, email_data), emails_data):
+                    attachment_names.extend(names)
+        finally:
+            connection_pool.close()
         
         print(f"- Total files downloaded: {len(attachment_names)}")
         return attachment_names
@@ -287,9 +842,34 @@ class OutlookRetriever:
 
 
    
+class RateLimiter:
+    def __init__(self, per_minute: int):
+        """
+        Spaces out calls so that at most `per_minute` happen in any minute (0 or less disables it).
+        Thread-safe: every caller waits for its own turn.
+
+        Args:
+            per_minute (int): Maximum number of calls per minute.
+        """
+        self.interval = 60 / per_minute if per_minute > 0 else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class OutlookSender:
-    def __init__(self):
+    def __init__(self, max_per_minute: int = SMTP_MAX_PER_MINUTE):
         self.smtp_server = None
+        self.rate_limiter = RateLimiter(max_per_minute)
 
     def _auth(self):
         try:
@@ -305,71 +885,166 @@ class OutlookSender:
                 raise ValueError(f"- Error de autenticación SMTP: {e}")
         except Exception as e:
             raise ValueError(f"- Error inesperado al autenticar: {e}")
-    
 
-    def send_email(self, recipient, subject, body, sender_name="Outlook Bot", body_type = "plain"):
-        """Enviar un correo. Requiere que el usuario esté autenticado."""
-        if not self.smtp_server:
-            raise ValueError("Debes autenticarte antes de enviar correos usando el método `auth`.")
+    def _reconnect(self):
+        """Drops the current SMTP connection (if any) and authenticates again."""
+        if self.smtp_server:
+            try:
+                self.smtp_server.close()
+            except Exception:
+                pass
+            self.smtp_server = None
+        self._auth()
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """Dropped connections and 4xx replies (e.g. 421 or 432 when the submission rate is exceeded) are retried."""
+        if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)):
+            return True
+        return isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500
 
-        try:
-            # Crear el mensaje
-            msg = MIMEMultipart()
-            msg["From"] = f"{sender_name} <{OUTLOOK_SENDER_EMAIL}>"
-            msg["To"] = recipient
-            msg["Subject"] = subject
-            msg.attach(MIMEText(body, body_type))
-
-            # Enviar el correo
-            self.smtp_server.send_message(msg)
-            print(f"- Correo enviado a {recipient}.")
-        except Exception as e:
-            print(f"- Error al enviar el correo: {e}")
+    @staticmethod
+    def _build_message(recipient, subject, body, sender_name="Outlook Bot", body_type="plain") -> MIMEText:
+        msg = MIMEText(body, body_type, "utf-8")
+        msg["From"] = f"{sender_name} <{OUTLOOK_SENDER_EMAIL}>"
+        msg["To"] = recipient
+        msg["Subject"] = subject
+        return msg
+
+    def send_batch(self, messages: list[dict], sender_name="Outlook Bot", body_type="plain", max_retries: int = SMTP_MAX_RETRIES) -> list[dict]:
+        """
+        Envía varios correos por una sola conexión SMTP autenticada (se conecta si hace falta), respetando
+        el límite de mensajes por minuto. Si el servidor corta la conexión o responde con un error temporal
+        (4xx), se reconecta y se reintenta ese mensaje; los demás errores solo afectan a su destinatario.
+
+        Args:
+            messages (list[dict]): Un dict por correo con recipient, subject, body y, opcionalmente, body_type
+                y message_id.
+            sender_name (str, optional): Nombre del remitente. Defaults to "Outlook Bot".
+            body_type (str, optional): "plain" o "html" para los mensajes que no lo indican. Defaults to "plain".
+            max_retries (int, optional): Reintentos por mensaje ante errores temporales. Defaults to SMTP_MAX_RETRIES.
+
+        Returns:
+            list[dict]: Por cada mensaje, en el mismo orden: recipient, sent (bool), attempts y error (str o None).
+        """
+        results = []
+        for message in messages:
+            recipient = message["recipient"]
+            result = {"recipient": recipient, "sent": False, "attempts": 0, "error": None}
+            msg = self._build_message(recipient, message["subject"], message["body"], sender_name,
+                                      message.get("body_type", body_type))
+            if message.get("message_id"):
+                msg["Message-ID"] = message["message_id"]  # Fijo por mensaje, para reconocer reenvíos (el servidor no los descarta)
+            for attempt in range(max_retries + 1):
+                result["attempts"] = attempt + 1
+                try:
+                    if not self.smtp_server:
+                        self._auth()
+                    self.rate_limiter.wait()
+                    refused = self.smtp_server.send_message(msg)
+                    if refused:
+                        result["error"] = f"Destinatarios rechazados: {refused}"
+                    else:
+                        result["sent"] = True
+                        result["error"] = None
+                    break
+                except Exception as e:
+                    result["error"] = str(e)
+                    if not self._is_transient(e) or attempt == max_retries:
+                        break
+                    wait = 2 ** attempt
+                    print(f"- Error temporal de SMTP al enviar a {recipient} ({e}); reconectando en {wait}s...")
+                    time.sleep(wait)
+                    try:
+                        self._reconnect()
+                    except ValueError as auth_error:
+                        result["error"] = str(auth_error)
+                        self.smtp_server = None
+
+            if result["sent"]:
+                print(f"- Correo enviado a {recipient}.")
+            else:
+                print(f"- Error al enviar el correo a {recipient}: {result['error']}")
+            results.append(result)
+        return results
+
+    def send_email(self, recipient, subject, body, sender_name="Outlook Bot", body_type = "plain") -> dict:
+        """Enviar un correo (ver send_batch). Returns: dict con el resultado del envío."""
+        return self.send_batch([{"recipient": recipient, "subject": subject, "body": body}], sender_name, body_type)[0]
+
+    def send_emails_with_template(self, user_attachments_log: dict, template_name: str, templates_path=TEMPLATES_PATH, sender_name= "Outlook Bot",
+                                  message_outbox: MessageOutbox = None) -> list[dict]:
+        """
+        Envía a cada remitente la notificación de sus archivos subidos. Los mensajes pasan por la bandeja de
+        salida (MessageOutbox): se guardan antes de enviarse, no se repiten si ya se notificaron esos archivos
+        y los fallidos quedan programados para reintentarse.
+
+        Args:
+            message_outbox (MessageOutbox, optional): Bandeja de salida. Defaults to MessageOutbox() (logs/).
+
+        Returns:
+            list[dict]: Resultado por mensaje enviado en esta llamada (ver MessageOutbox.drain).
+        """
+        message_outbox = message_outbox or MessageOutbox()
+        messages = self.render_notifications(user_attachments_log, template_name, templates_path)
+        for message in messages:
+            message["idempotency_key"] = MessageOutbox.idempotency_key(message["recipient"], user_attachments_log[message["recipient"]])
+        message_outbox.enqueue(messages)
+        return message_outbox.drain(self, sender_name=sender_name)
+
+    def render_notifications(self, user_attachments_log: dict, template_name: str, templates_path=TEMPLATES_PATH) -> list[dict]:
+        """
+        Genera (sin enviar) la notificación de archivos subidos de cada remitente.
 
-    def send_emails_with_template(self, user_attachments_log: dict, template_name: str, templates_path=TEMPLATES_PATH, sender_name= "Outlook Bot"):
-        if not self.smtp_server:
-            raise ValueError("Debes autenticarte antes de enviar correos usando el método `auth`.")
+        Returns:
+            list[dict]: Un mensaje por remitente con recipient, subject, body y body_type (ver send_batch).
+        """
         if template_name.endswith(".html") or template_name.endswith(".htm"):
             body_type = "html"
         else:
-            body_type = "txt"
+            body_type = "plain"
         template_full_path= os.path.join(templates_path, template_name)
 
         if not os.path.exists(template_full_path):
             raise FileNotFoundError(f"La plantilla {template_full_path} no existe.")
 
-        
-        with open(template_full_path, "r", encoding= 'utf-8') as template_file:
-            template = ' '.join(template_file.read().split())
-            
+        # Compilada una sola vez (se recarga solo si el archivo cambia); los nombres de archivo se escapan
+        template = load_template(template_full_path, autoescape=True, collapse_whitespace=True)
+
+        messages = []
         try:
             for sender, file_list in user_attachments_log.items():
                 try:
                     attachments_body_details = []
                     for attachments_details in file_list:
-                        original_name = attachments_details.get("original_name")
-                        new_name = attachments_details.get("new_name")
-                        path = attachments_details.get("path")
+                        # Los logs pueden ser dicts o AttachmentLog
+                        if not isinstance(attachments_details, dict):
+                            attachments_details = attachments_details.model_dump()
 
                         # Agregar detalles del archivo a la lista
-                        attachments_body_details.append(
-                            f'<li><strong>{original_name}</strong><ul><li>Nuevo nombre: {new_name}</li><li>Ubicación: {path}</li></ul></li>'
-                        )
+                        attachments_body_details.append(ATTACHMENT_DETAILS_TEMPLATE.render(
+                            original_name=attachments_details.get("original_name"),
+                            new_name=attachments_details.get("new_name"),
+                            path=attachments_details.get("path"),
+                        ))
                     # Generar el cuerpo del correo uniendo los detalles
-                    attachments_body_details_str = "".join(attachments_body_details)
-                    body = template.format(attachments_details_body=attachments_body_details_str)
-                    body = body.replace("\n", "").replace("\r", "")
-                    self.send_email(sender, "Notificación de archivos subidos", body, body_type=body_type)
+                    body = template.render(attachments_details_body=Markup("".join(attachments_body_details)))
+                    messages.append({"recipient": sender, "subject": "Notificación de archivos subidos", "body": body, "body_type": body_type})
                 except Exception as e:
-                    print(f"No se pudo enviar un correo automático para {sender}: {e}")        
+                    print(f"No se pudo preparar el correo automático para {sender}: {e}")
         except Exception as e:
             print(f"Hubo un error al leer el diccionario user_attachments_log: {e}")
-        # Crear la lista de detalles de los archivos
-                
+
+        return messages
+
     def logout(self):
         """Cerrar la conexión SMTP."""
         if self.smtp_server:
-            self.smtp_server.quit()
+            try:
+                self.smtp_server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.smtp_server = None
             print("- Conexión SMTP cerrada.")
     
 
@@ -378,7 +1053,8 @@ class OutlookSender:
 class EmailTemplate:
     def __init__(self, template_name, template_folder="templates"):
         """
-        Inicializa la plantilla cargándola desde un archivo.
+        Inicializa la plantilla a partir de un archivo. El archivo se compila una sola vez (ver
+        load_template) y se vuelve a leer solo si cambia; en las plantillas HTML los valores se escapan.
 
         :param template_name: Nombre del archivo de la plantilla (ejemplo: 'ficha_subida.txt')
         :param template_folder: Carpeta donde se almacenan las plantillas
@@ -386,10 +1062,11 @@ class EmailTemplate:
         self.template_path = os.path.join(template_folder, template_name)
         if not os.path.exists(self.template_path):
             raise FileNotFoundError(f"La plantilla '{template_name}' no existe en '{template_folder}'.")
-        
-        with open(self.template_path, "r", encoding="utf-8") as f:
-            self.template = f.read()
-    
+
+    @property
+    def compiled(self) -> CompiledTemplate:
+        return load_template(self.template_path)
+
     def render(self, **kwargs):
         """
         Rellena la plantilla con los valores dinámicos.
@@ -397,7 +1074,7 @@ class EmailTemplate:
         :param kwargs: Diccionario con valores a reemplazar (placeholders)
         :return: Texto final con los marcadores reemplazados
         """
-        return self.template.format(**kwargs)
+        return self.compiled.render(**kwargs)
     
     def get_placeholders(self):
         """
@@ -405,7 +1082,7 @@ class EmailTemplate:
 
         :return: Lista de marcadores encontrados en la plantilla
         """
-        return re.findall(r"{(.*?)}", self.template)
+        return self.compiled.placeholders
 
 
 
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+from xml.etree import ElementTree
+from office365.runtime.auth.authentication_context import AuthenticationContext
+from office365.runtime.auth.providers.saml_token_provider import SamlTokenProvider, resolve_base_url
+from office365.runtime.auth.sts_profile import STSProfile
+
+script_dir = os.path.dirname(__file__)
+
+# Cookies de autenticación (FedAuth/rtFa) guardadas entre ejecuciones para no volver a autenticar en cada arranque
+SHAREPOINT_TOKEN_CACHE_PATH = os.path.join(script_dir, "..", "logs", "sharepoint_token_cache.json")
+SHAREPOINT_TOKEN_TTL = int(os.getenv("SHAREPOINT_TOKEN_TTL", 3600))  # Vigencia (s) si la respuesta del STS no trae su vencimiento
+SHAREPOINT_TOKEN_REFRESH_MARGIN = 300  # Se renueva un poco antes de que venza para no fallar a mitad de una carga
+
+# Vencimiento del token en la respuesta del STS: <wst:Lifetime><wsu:Expires>2024-12-09T16:00:00Z</wsu:Expires></wst:Lifetime>
+_TOKEN_EXPIRES_PATH = (
+    ".//{http://schemas.xmlsoap.org/ws/2005/02/trust}Lifetime"
+    "/{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Expires"
+)
+
+
+def token_expires_at(content: bytes):
+    """
+    Reads the expiry of the security token from the STS response (RequestSecurityTokenResponse).
+
+    Args:
+        content (bytes): Body of the STS response.
+
+    Returns:
+        float | None: Expiry as a Unix timestamp, or None if the response does not state it.
+    """
+    try:
+        node = ElementTree.fromstring(content).find(_TOKEN_EXPIRES_PATH)
+        if node is None or not node.text:
+            return None
+        # El STS responde en UTC con fracción de 7 dígitos (2024-12-09T16:00:00.0000000Z), que strptime no admite
+        expires = datetime.strptime(node.text.strip()[:19], "%Y-%m-%dT%H:%M:%S")
+        return expires.replace(tzinfo=timezone.utc).timestamp()
+    except (ElementTree.ParseError, ValueError):
+        return None
+
+
+class TokenCache:
+    def __init__(self, cache_path=SHAREPOINT_TOKEN_CACHE_PATH):
+        """
+        On-disk cache of SharePoint authentication cookies, one entry per account and tenant.
+        The file holds credentials: it is written atomically and only readable by its owner.
+
+        Args:
+            cache_path (str): JSON file of the cache. Defaults to SHAREPOINT_TOKEN_CACHE_PATH (logs/).
+        """
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f" No se pudo leer la caché de tokens de SharePoint ({e}); se autenticará de nuevo")
+            return {}
+
+    def get(self, key: str):
+        """Returns the cached entry {"cookies", "expires_at"} if it is still valid, otherwise None."""
+        with self._lock:
+            entry = self._read().get(key)
+        if not entry or entry.get("expires_at", 0) - SHAREPOINT_TOKEN_REFRESH_MARGIN <= time.time():
+            return None
+        return entry
+
+    def set(self, key: str, cookies: dict, expires_at: float):
+        self._update(key, {"cookies": cookies, "expires_at": expires_at})
+
+    def delete(self, key: str):
+        self._update(key, None)
+
+    def _update(self, key: str, entry):
+        with self._lock:
+            data = self._read()
+            if entry is None:
+                if data.pop(key, None) is None:
+                    return
+            else:
+                data[key] = entry
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf-8") as file:
+                    json.dump(data, file, indent=2)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                logging.warning(f" No se pudo guardar la caché de tokens de SharePoint: {e}")
+
+
+class CachedSamlTokenProvider(SamlTokenProvider):
+    def __init__(self, url: str, username: str, password: str, cache: TokenCache = None):
+        """
+        SAML provider (the one used by AuthenticationContext.acquire_token_for_user) that reuses the
+        authentication cookies while they are valid: first from memory, then from the disk cache, and
+        only goes through the STS round trips (user realm, security token, sign-in) when both are expired.
+        Safe to share between threads and between ClientContexts of the same tenant.
+
+        Args:
+            url (str): Site URL.
+            username (str): Account (email).
+            password (str): Password.
+            cache (TokenCache, optional): Disk cache. Defaults to a TokenCache on SHAREPOINT_TOKEN_CACHE_PATH.
+        """
+        super().__init__(url, username, password, browser_mode=False)
+        self.cache = cache or TokenCache()
+        self.cache_key = f"{username}@{self._sts_profile.tenant}".lower()
+        self._expires_at = 0
+        self._token_expires_at = None
+        self._lock = threading.Lock()
+
+    def authenticate_request(self, request):
+        """
+        Sets the Cookie header of a request. The base implementation reads the cookies after releasing the
+        lock, so a concurrent invalidate() could leave it with None; here they are taken in the same locked step.
+        """
+        cookies = self._valid_cookies()
+        request.set_header("Cookie", "; ".join(f"{key}={value}" for key, value in cookies.items()))
+
+    def ensure_authentication_cookie(self):
+        self._valid_cookies()
+        return True
+
+    def _process_service_token_response(self, response):
+        """Extracts the security token as the base class does, keeping the expiry the STS states for it."""
+        self._token_expires_at = token_expires_at(response.content)
+        return super()._process_service_token_response(response)
+
+    def _valid_cookies(self) -> dict:
+        """Returns valid authentication cookies, authenticating again if needed (under the lock)."""
+        with self._lock:
+            if self._cached_auth_cookies is not None and self._expires_at - SHAREPOINT_TOKEN_REFRESH_MARGIN > time.time():
+                return self._cached_auth_cookies
+
+            entry = self.cache.get(self.cache_key)
+            if entry is not None:
+                self._cached_auth_cookies, self._expires_at = entry["cookies"], entry["expires_at"]
+                logging.info(f" Se reutiliza la sesión de SharePoint guardada para {self._sts_profile.tenant}")
+                return self._cached_auth_cookies
+
+            # El perfil STS fija la ventana created/expires de la solicitud al crearse: se renueva en cada autenticación
+            self._sts_profile = STSProfile(resolve_base_url(self._sts_profile.authorityUrl), self._environment)
+            self._token_expires_at = None
+            self._cached_auth_cookies = self.get_authentication_cookie()
+            # Las cookies FedAuth/rtFa duran lo que el token del que salen; sin vencimiento en la respuesta se usa el TTL
+            self._expires_at = self._token_expires_at or time.time() + SHAREPOINT_TOKEN_TTL
+            self.cache.set(self.cache_key, self._cached_auth_cookies, self._expires_at)
+            logging.info(f" Autenticación con SharePoint renovada para {self._sts_profile.tenant}")
+            return self._cached_auth_cookies
+
+    def invalidate(self):
+        """Discards the cookies (memory and disk) so the next request authenticates again, e.g. after a 401."""
+        with self._lock:
+            self._cached_auth_cookies = None
+            self._expires_at = 0
+            self.cache.delete(self.cache_key)
+
+
+_auth_contexts = {}  # URL del sitio (en minúsculas) -> AuthenticationContext compartido
+_auth_contexts_lock = threading.Lock()
+
+
+def shared_auth_context(site_url: str, username: str, password: str) -> AuthenticationContext:
+    """
+    Returns the authentication context of a site, created once per process and shared by every
+    Sharepoint instance (and their worker ClientContexts) that points to the same site.
+
+    Args:
+        site_url (str): Site URL (e.g. https://tenant.sharepoint.com/sites/DNPE).
+        username (str): Account (email).
+        password (str): Password.
+
+    Returns:
+        AuthenticationContext: Context whose `token_provider` is a CachedSamlTokenProvider.
+    """
+    key = site_url.rstrip("/").lower()
+    with _auth_contexts_lock:
+        if key not in _auth_contexts:
+            provider = CachedSamlTokenProvider(site_url, username, password)
+            auth_context = AuthenticationContext(site_url)
+            # Equivalente a acquire_token_for_user, pero con el proveedor que reutiliza las cookies
+            auth_context._authenticate = provider.authenticate_request
+            auth_context.token_provider = provider
+            _auth_contexts[key] = auth_context
+        return _auth_contexts[key]
@@ -1,15 +1,24 @@
 from dotenv import load_dotenv
 import os
 import re
+import json
+import hashlib
 import pandas as pd
-from office365.runtime.auth.authentication_context import AuthenticationContext
 from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
 from office365.sharepoint.files.file import File
+from office365.runtime.queries.batch import BatchQuery
+from requests.exceptions import RequestException
 from email.header import decode_header
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import time
+import uuid
+import threading
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from correos_automaticos.classes.models import AttachmentLog
+from correos_automaticos.classes.sharepoint_auth import shared_auth_context
 
 script_dir = os.path.dirname(__file__)
 
@@ -33,6 +42,24 @@ DOWNLOAD_PATH = os.path.join(script_dir, "..", "descargas")  # Carpeta de descar
 UPLOAD_PATH = os.path.join(script_dir, "..", "descargas", "clasificados")  # Carpeta desde donde se subirán archivos
 TEMPLATES_PATH = os.path.join(script_dir, "..", "email_templates") # Carpeta desde la que se obtendrán los email templates
 
+# Subidas en paralelo y manejo de throttling (429/503 con Retry-After)
+SHAREPOINT_MAX_WORKERS = int(os.getenv("SHAREPOINT_MAX_WORKERS", 4))
+SHAREPOINT_MAX_RETRIES = int(os.getenv("SHAREPOINT_MAX_RETRIES", 5))
+SHAREPOINT_DEFAULT_RETRY_AFTER = 5  # Segundos de espera si el servidor no envía Retry-After
+
+# Archivos más grandes que el umbral se suben por partes (sesión de carga start/continue/finish)
+SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD = int(os.getenv("SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD", 10 * 1024 * 1024))
+SHAREPOINT_CHUNK_SIZE = int(os.getenv("SHAREPOINT_CHUNK_SIZE", 5 * 1024 * 1024))
+
+# Listados: archivos por página; los elementos de lista paginan con $skiptoken (nextLink en cada página)
+SHAREPOINT_PAGE_SIZE = int(os.getenv("SHAREPOINT_PAGE_SIZE", 500))
+
+# Descargas: tamaño de cada bloque que se escribe a disco
+SHAREPOINT_DOWNLOAD_CHUNK_SIZE = int(os.getenv("SHAREPOINT_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# Hash y ETag de lo último que se subió a cada archivo, para no volver a subir archivos sin cambios
+SHAREPOINT_SYNC_STATE_PATH = os.path.join(script_dir, "..", "logs", "sharepoint_sync_state.json")
+
 # Sharepoint credentials from env
 SHAREPOINT_EMAIL = os.getenv("SHAREPOINT_EMAIL")
 SHAREPOINT_PASSWORD = os.getenv("SHAREPOINT_PASSWORD")
@@ -62,16 +89,25 @@ class Sharepoint():
         self.SHAREPOINT_ROOT_FOLDER = self.SHAREPOINT_URL_SITE.split("/")[-2] # sites 
         self.SHAREPOINT_SITE_NAME = self.SHAREPOINT_URL_SITE.split("/")[-1] # DNPE
         self.conn = None
+        self._known_folders = set()  # Carpetas (server-relative, en minúsculas) que ya se sabe que existen
+        self._folders_in_flight = {}  # Carpeta -> threading.Event de la creación en curso (de otro worker)
+        self._folders_lock = threading.Lock()
+        self._sync_state = None  # URL server-relative (en minúsculas) -> {"sha256", "size", "etag"}; None fuera del modo sync
+        self._sync_lock = threading.Lock()
         if connect_on_creation:
             self.conn= self.auth()
 
     def auth(self):
+        """
+        Connects to the site through its shared authentication context (see shared_auth_context): every
+        Sharepoint of the same site reuses the same cookies, and a valid session saved on disk skips the login.
+        """
         try:
-            self.conn = AuthenticationContext(self.SHAREPOINT_URL_SITE)
-            if self.conn.acquire_token_for_user(SHAREPOINT_EMAIL, SHAREPOINT_PASSWORD):
-                self.conn = ClientContext(self.SHAREPOINT_URL_SITE, self.conn)
-                print(f"Autenticación exitosa. Conexión establecida con SharePoint para {self.SHAREPOINT_URL_SITE}")
-                return self.conn
+            auth_context = shared_auth_context(self.SHAREPOINT_URL_SITE, SHAREPOINT_EMAIL, SHAREPOINT_PASSWORD)
+            auth_context.token_provider.ensure_authentication_cookie()
+            self.conn = ClientContext(self.SHAREPOINT_URL_SITE, auth_context)
+            print(f"Autenticación exitosa. Conexión establecida con SharePoint para {self.SHAREPOINT_URL_SITE}")
+            return self.conn
         except Exception as e:
             print(f"Error al autenticar: {e}")
             return None
@@ -88,6 +124,75 @@ class Sharepoint():
         else:
             print("No hay conexión activa para cerrar sesión.")
     
+    @staticmethod
+    def _retry_after(error: Exception):
+        """Returns the seconds to wait if `error` is a throttling response (429/503), otherwise None."""
+        response = getattr(error, "response", None)
+        if response is None or response.status_code not in (429, 503):
+            return None
+        retry_after = response.headers.get("Retry-After", "")
+        return int(retry_after) if retry_after.strip().isdigit() else SHAREPOINT_DEFAULT_RETRY_AFTER
+
+    def _execute_query(self, max_retries: int = SHAREPOINT_MAX_RETRIES, batch = False):
+        """
+        Executes the pending queries of the connection, waiting and retrying the failed query
+        when SharePoint throttles the request (429 Too Many Requests / 503 Server Too Busy).
+
+        Args:
+            max_retries (int, optional): Maximum number of retries. Defaults to SHAREPOINT_MAX_RETRIES.
+            batch (bool, optional): Send all pending queries in a single $batch request. Defaults to False.
+        """
+        reauthenticated = False
+        for attempt in range(max_retries + 1):
+            try:
+                return self.conn.execute_batch() if batch else self.conn.execute_query()
+            except RequestException as e:
+                wait = self._retry_after(e)
+                expired = not reauthenticated and self._is_auth_expired(e)
+                if (wait is None and not expired) or attempt == max_retries:
+                    raise
+                # La consulta fallida ya salió de la cola: vuelve al principio, antes de las consultas que pueden depender de ella
+                failed = self.conn.current_query
+                self.conn._queries[:0] = failed.queries if isinstance(failed, BatchQuery) else [failed]
+                if expired:
+                    # La sesión guardada venció o fue revocada antes de tiempo: se autentica de nuevo una sola vez
+                    reauthenticated = True
+                    logging.warning(f" SharePoint rechazó la sesión ({e.response.status_code}); autenticando de nuevo")
+                    self.conn.authentication_context.token_provider.invalidate()
+                    continue
+                logging.warning(f" SharePoint limitó la solicitud ({e.response.status_code}); reintento en {wait}s")
+                time.sleep(wait)
+
+    def _is_auth_expired(self, error: Exception) -> bool:
+        response = getattr(error, "response", None)
+        return (response is not None and response.status_code in (401, 403)
+                and hasattr(self.conn.authentication_context, "token_provider"))
+
+    @staticmethod
+    def _is_not_found(error: Exception) -> bool:
+        response = getattr(error, "response", None)
+        if response is not None and response.status_code == 404:
+            return True
+        message = str(error).lower()
+        return "not found" in message or "-2147024894" in message  # Código de SharePoint para "archivo no encontrado"
+
+    def _thread_session(self, workers: threading.local):
+        """Returns the worker session of the current thread (see _worker_session), creating it on first use."""
+        if not hasattr(workers, "session"):
+            workers.session = self._worker_session()
+        return workers.session
+
+    def _worker_session(self):
+        """Session for a worker thread: its own ClientContext over the already authenticated context."""
+        session = Sharepoint(self.SHAREPOINT_URL_SITE, self.SHAREPOINT_FOLDER, connect_on_creation=False)
+        session.conn = ClientContext(self.SHAREPOINT_URL_SITE, self.conn.authentication_context)
+        session._known_folders = self._known_folders  # Caché de carpetas compartida con la sesión principal
+        session._folders_in_flight = self._folders_in_flight
+        session._folders_lock = self._folders_lock
+        session._sync_state = self._sync_state
+        session._sync_lock = self._sync_lock
+        return session
+
     def _select_folder(self, custom_folder_path = "", folder_name= ""):
         if not custom_folder_path:
            target_folder_url = f'/{self.SHAREPOINT_ROOT_FOLDER}/{self.SHAREPOINT_SITE_NAME}/{self.SHAREPOINT_FOLDER}'
@@ -98,14 +203,16 @@ class Sharepoint():
         return target_folder_url
     
     
-    def list_files(self, custom_folder_path="", folder_name="", author = False):
+    def list_files(self, custom_folder_path="", folder_name="", author = False, verbose = True):
         """
-        List files in a specified folder and retrieve metadata, including author information if required (slows down retrieval)
+        List files in a specified folder and retrieve metadata, including author information if required
+        (fetched in the same request as the folder, by expanding Files/Author and Files/ModifiedBy)
 
         Args:
             custom_folder_path (str, optional): Custom folder path relative to the root. Default is an empty string.
             folder_name (str, optional): Specific folder name. Default is an empty string.
             author (bool, optional): Whether to include author information for each file. Default is False.
+            verbose (bool, optional): Print the folder contents. Default is True.
 
         Returns:
             list: A list of dictionaries containing metadata for each file, including:
@@ -114,8 +221,10 @@ class Sharepoint():
                 - time_created (str): Creation time in "YYYY-MM-DD HH:MM:SS" format.
                 - time_last_modified (str): Last modification time in "YYYY-MM-DD HH:MM:SS" format.
                 - author (str, optional): Author's email if `author=True`.
-                - editor (str): Editor ID if available.
+                - editor (str): Email of the user who last modified the file if `author=True`, else the editor ID if available.
                 - uniqueId (str): Unique identifier for the file.
+                - size (int): Size in bytes.
+                - etag (str): ETag of the current version of the file.
 
         Raises:
             Exception: If the specified folder cannot be accessed.
@@ -132,52 +241,145 @@ class Sharepoint():
             # Get the folder by the server-relative URL
             root_folder = self.conn.web.get_folder_by_server_relative_url(target_folder_url)
             
-            # Expand the folder to include files and subfolders
-            root_folder.expand(["Files", "Folders"]).get().execute_query()  # No way to include author here
-            print(f'Archivos presentes en la carpeta "{folder_name}":')
-            print(f"Total de archivos encontrados: {len(root_folder.files)}")
+            # Expand the folder to include files and subfolders (and the author/editor of every file in the same query)
+            expand = ["Files", "Folders"]
+            if author:
+                expand += ["Files/Author", "Files/ModifiedBy"]
+            root_folder.expand(expand).get().execute_query()
+            if verbose:
+                print(f'Archivos presentes en la carpeta "{folder_name}":')
+                print(f"Total de archivos encontrados: {len(root_folder.files)}")
         except Exception as e:
-            print(f"No se encontró la carpeta con el path {target_folder_url}")
+            if verbose:
+                print(f"No se encontró la carpeta con el path {target_folder_url}")
             return None
 
         # Iterate over the files and retrieve metadata
         for file in root_folder.files:
-            # Access fields
-            list_item = file.listItemAllFields
-            editor = getattr(list_item, "EditorId", None)  # Editor ID or None if not present
-            time_created = file.time_created  # Directly access if it's a datetime object
-            time_modified = file.time_last_modified  # Directly access if it's a datetime object
-
-            # Format times as strings
-            time_created = time_created.strftime("%Y-%m-%d %H:%M:%S") if time_created else None
-            time_modified = time_modified.strftime("%Y-%m-%d %H:%M:%S") if time_modified else None
-
-            # Retrieve author information if requested
-            author_data = None
-            if author:
-                try:
-                    file.context.load(file, ["Author"])
-                    file.context.execute_query()
-                    author_data = file.author.email if hasattr(file.author, "email") else "Unknown"
-                except Exception as e:
-                    print(f"Error retrieving author information for file {file.name}: {e}")
-            
-            file_metadata.append({
-                "name": file.name,
-                "server_relative_url": file.serverRelativeUrl,
-                "time_created": time_created,
-                "time_last_modified": time_modified,
-                "author": author_data,
-                "editor": editor,
-                "uniqueId": file.unique_id,
-            })
-            print(f' - {file.name}')  # Print only the name of each file
+            file_metadata.append(self._file_metadata(file, author))
+            if verbose:
+                print(f' - {file.name}')  # Print only the name of each file
 
         return file_metadata
     
+    @staticmethod
+    def _file_metadata(file: File, author = False, list_item = None) -> dict:
+        """Metadata of a loaded file, as returned by list_files and walk_files (`list_item` defaults to its listItemAllFields)."""
+        # Access fields
+        list_item = list_item if list_item is not None else file.listItemAllFields
+        editor = getattr(list_item, "properties", {}).get("EditorId")  # Editor ID or None if not present
+        time_created = file.time_created  # Directly access if it's a datetime object
+        time_modified = file.time_last_modified  # Directly access if it's a datetime object
+
+        # Format times as strings
+        time_created = time_created.strftime("%Y-%m-%d %H:%M:%S") if time_created else None
+        time_modified = time_modified.strftime("%Y-%m-%d %H:%M:%S") if time_modified else None
+
+        # Author information (already loaded with the folder)
+        author_data = None
+        if author:
+            author_data = file.author.email or "Unknown"
+            editor = file.modified_by.email or editor
+
+        return {
+            "name": file.name,
+            "server_relative_url": file.serverRelativeUrl,
+            "time_created": time_created,
+            "time_last_modified": time_modified,
+            "author": author_data,
+            "editor": editor,
+            "uniqueId": file.unique_id,
+            "size": file.length,
+            "etag": file.properties.get("ETag"),
+        }
+
+    def _list_folder(self, folder_url: str, page_size: int = SHAREPOINT_PAGE_SIZE, author = False) -> tuple[list[dict], list[str]]:
+        """
+        Lists the files and the subfolders of a single folder. The files are read as items of the document
+        library filtered by folder, page by page: unlike Folder/Files, the items endpoint always returns the
+        nextLink ($skiptoken) of the next page, so every page is a single request and no page is missed.
+
+        Returns:
+            tuple: (file metadata, server-relative URLs of the subfolders)
+        """
+        library_url = "/".join(folder_url.rstrip("/").split("/")[:4])  # /sites/<sitio>/<biblioteca>
+        expand = ["File", "File/Author", "File/ModifiedBy"] if author else ["File"]
+        items = self.conn.web.get_list(library_url).items
+        folder_ref = folder_url.rstrip("/").replace("'", "''")  # Comillas escapadas para el $filter de OData
+        items.filter(f"FileDirRef eq '{folder_ref}' and FSObjType eq 0").expand(expand)
+        items.paged(page_size).get()  # Las páginas siguientes (nextLink con $skiptoken) se piden al iterar
+        subfolders = self.conn.web.get_folder_by_server_relative_url(folder_url).folders.get()
+        self._execute_query()
+
+        file_metadata = [self._file_metadata(item.file, author, item) for item in items]
+        subfolder_urls = [
+            subfolder.serverRelativeUrl for subfolder in subfolders
+            # La carpeta "Forms" de la raíz de una biblioteca es del sistema
+            if not (subfolder.name == "Forms" and folder_url.rstrip("/").count("/") == 3)
+        ]
+        return file_metadata, subfolder_urls
+
+    def walk_files(self, custom_folder_path="", folder_name="", max_workers: int = SHAREPOINT_MAX_WORKERS,
+                   page_size: int = SHAREPOINT_PAGE_SIZE, author = False):
+        """
+        Recursively walks a folder tree and yields the metadata of every file as soon as its folder is listed.
+        Subfolders are listed ahead of time by a bounded pool of workers (each with its own ClientContext over
+        the authenticated context of this session), while only a limited number of listed folders is kept in
+        memory waiting to be consumed.
+
+        Args:
+            custom_folder_path (str, optional): Custom folder path relative to the root. Default is an empty string.
+            folder_name (str, optional): Specific folder name. Default is an empty string.
+            max_workers (int, optional): Folders listed simultaneously. Defaults to SHAREPOINT_MAX_WORKERS.
+            page_size (int, optional): Files requested per page ($top). Defaults to SHAREPOINT_PAGE_SIZE.
+            author (bool, optional): Include author and editor emails (expanded in the same request).
+
+        Yields:
+            dict: File metadata with the same keys as list_files.
+        """
+        if not self.conn and not self.auth():
+            return
+
+        workers = threading.local()
+
+        def list_folder(folder_url):
+            try:
+                return self._thread_session(workers)._list_folder(folder_url, page_size, author)
+            except Exception as e:
+                print(f"No se pudo listar la carpeta {folder_url}: {e}")
+                return [], []
+
+        folders = deque([self._select_folder(custom_folder_path, folder_name)])  # Carpetas por listar
+        listing = deque()  # Listados en curso o en espera de ser consumidos (como máximo 2 por worker)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while folders or listing:
+                    while folders and len(listing) < 2 * max_workers:
+                        listing.append(executor.submit(list_folder, folders.popleft()))
+                    file_metadata, subfolder_urls = listing.popleft().result()
+                    folders.extend(subfolder_urls)
+                    yield from file_metadata
+            finally:
+                for future in listing:
+                    future.cancel()
+
+    def _folder_key(self, path: str) -> str:
+        return self._select_folder(path.strip("/")).lower()  # Las URLs de SharePoint no distinguen mayúsculas
+
+    def forget_folder(self, path: str):
+        """Removes a folder and its subfolders from the cache of existing folders (e.g. after a "not found" error)."""
+        key = self._folder_key(path)
+        with self._folders_lock:
+            self._known_folders.difference_update(
+                [folder for folder in self._known_folders if folder == key or folder.startswith(f"{key}/")]
+            )
+
     def ensure_folders_exist(self, path: str):
         """
-        Ensures all folders in the given path exist on SharePoint.
+        Ensures all folders in the given path exist on SharePoint. Folders already known to exist in this
+        session are not checked again: only the missing part of the path is created, in a single batch request.
+        The shared lock only guards the folder cache; the request runs outside of it, so workers creating
+        other folders are not blocked. A worker that needs a folder another one is creating waits for it.
 
         Args:
             path (str): The folder path to create (e.g., "Parent/Child/Grandchild").
@@ -185,32 +387,60 @@ class Sharepoint():
         Returns:
             str: "created" if any folder was created, "exists" if the entire path already existed.
         """
+        folder_path = path.strip("/")  # Remove any leading/trailing slashes
+        folder_names = folder_path.split("/")  # Split the path into individual folder names
+        prefixes = ["/".join(folder_names[:index]) for index in range(1, len(folder_names) + 1)]
+        keys = [self._folder_key(prefix) for prefix in prefixes]
+
+        while True:
+            with self._folders_lock:
+                # Prefijo más largo que ya se sabe que existe
+                known = next((index for index in range(len(keys), 0, -1) if keys[index - 1] in self._known_folders), 0)
+                if known == len(keys):
+                    return "exists"
+                in_flight = next((self._folders_in_flight[key] for key in keys[known:] if key in self._folders_in_flight), None)
+                if in_flight is None:
+                    creating = threading.Event()
+                    for key in keys[known:]:
+                        self._folders_in_flight[key] = creating
+                    break
+            in_flight.wait()  # Otro worker está creando parte de la ruta: se vuelve a revisar cuando termine
+
+        status = None
         try:
-            folder_path = path.strip("/")  # Remove any leading/trailing slashes
-            folder_names = folder_path.split("/")  # Split the path into individual folder names
-
-            # Start at the root of the document library
-            parent_folder = self.conn.web.folders.get_by_url(folder_names[0])
-            self.conn.load(parent_folder)
-            self.conn.execute_query()
-
-            # Traverse and create folders incrementally
-            for folder_name in folder_names[1:]:
-                sub_folder = parent_folder.folders.add(folder_name)
-                self.conn.execute_query()
-                parent_folder = sub_folder  # Move to the newly created/ensured folder
-
-            return "created"
+            if known:
+                parent_folder = self.conn.web.get_folder_by_server_relative_path(self._select_folder(prefixes[known - 1]))
+            else:
+                # Start at the root of the document library
+                parent_folder = self.conn.web.folders.get_by_url(folder_names[0])
+                known = 1
+                if len(folder_names) == 1:
+                    self.conn.load(parent_folder)
+
+            # Create the missing folders in one request
+            for folder_name in folder_names[known:]:
+                parent_folder = parent_folder.folders.add(folder_name)
+            self._execute_query(batch=True)
+            status = "created"
 
         except Exception as e:
             # Handle the case where folders already exist
-            if "already exists" in str(e).lower():
-                return "exists"
-            print(f"Failed to ensure folders exist for path '{path}'. Error: {e}")
-            raise
-
-    
-    def upload_file(self, file_name: str, custom_folder_path="", create_folder = False):
+            if "already exists" not in str(e).lower():
+                print(f"Failed to ensure folders exist for path '{path}'. Error: {e}")
+                raise
+            status = "exists"
+
+        finally:
+            with self._folders_lock:
+                if status is not None:
+                    self._known_folders.update(keys)
+                for key in keys:
+                    if self._folders_in_flight.get(key) is creating:
+                        del self._folders_in_flight[key]
+            creating.set()
+        return status
+
+    def upload_file(self, file_name: str, custom_folder_path="", create_folder = False, local_path: str = None):
         """
         Uploads a file to SharePoint. Optionally, a folder can be created with the same name as the file.
         Needs server-relative path (from /sites/)
@@ -221,13 +451,16 @@ class Sharepoint():
                 (e.g., "Tendencias/Tendencias Nacionales"). Default is the root folder from env.
             create_folder (bool, optional): If True, creates a folder with the same name as the file 
                 (if it doesn't exist) before uploading. Default is False.
+            local_path (str, optional): Local path of the file (e.g. from the staging folder of an email).
+                Default is UPLOAD_PATH/file_name.
         
         Returns:
             bool: True if the upload was successful, otherwise raises an exception.
+
+        Files larger than SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD are uploaded in chunks (see _upload_in_chunks).
         """
-        file_path = os.path.join(UPLOAD_PATH, file_name)
-        with open(file_path, "rb") as file:
-            content = file.read()  # Read binary content of the file       
+        file_path = local_path or os.path.join(UPLOAD_PATH, file_name)
+        file_size = os.path.getsize(file_path)
 
     # Construir la URL del folder en SharePoint
         try:
@@ -245,26 +478,267 @@ class Sharepoint():
                 print(f"ERROR al crear/verificar la carpeta '{custom_folder_path}': {e}")
                 return False
 
-        # Subir el archivo al folder de SharePoint
-        try:
+        # Subir el archivo al folder de SharePoint. Si la carpeta ya se verificó en esta sesión no se vuelve a
+        # cargar; si resulta que ya no existe, se invalida la caché y se reintenta una vez
+        for attempt in range(2):
             target_folder = self.conn.web.get_folder_by_server_relative_path(target_folder_url)
-            self.conn.load(target_folder)
-            self.conn.execute_query()
-        except Exception as e:
-            print(f"ERROR al acceder a la carpeta de destino '{target_folder_url}': {e}")
-            return False
+            folder_known = target_folder_url.lower() in self._known_folders
+            if not folder_known:
+                try:
+                    self.conn.load(target_folder)
+                    self._execute_query()
+                    with self._folders_lock:
+                        self._known_folders.add(target_folder_url.lower())
+                except Exception as e:
+                    print(f"ERROR al acceder a la carpeta de destino '{target_folder_url}': {e}")
+                    return False
 
-        try:
-            upload_status = target_folder.upload_file(file_name, content).execute_query()
-            if upload_status:
-                logging.info(f" - Archivo '{file_name}' subido exitosamente a '{self.SHAREPOINT_URL_BASE}{target_folder_url}'.")
-                return True
-            else:
-                logging.error(f"ERROR desconocido al subir el archivo '{file_name}' a '{target_folder_url}'.")
+            try:
+                if file_size > max(SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD, SHAREPOINT_CHUNK_SIZE):
+                    upload_status = self._upload_in_chunks(target_folder, file_name, file_path)
+                else:
+                    with open(file_path, "rb") as file:
+                        content = file.read()  # Read binary content of the file
+                    upload_status = target_folder.upload_file(file_name, content)
+                    self._execute_query()
+                if upload_status:
+                    logging.info(f" - Archivo '{file_name}' subido exitosamente a '{self.SHAREPOINT_URL_BASE}{target_folder_url}'.")
+                    self._remember_upload(f"{target_folder_url}/{file_name}", file_path, upload_status)
+                    return True
+                else:
+                    logging.error(f"ERROR desconocido al subir el archivo '{file_name}' a '{target_folder_url}'.")
+                    return False
+            except Exception as e:
+                if folder_known and attempt == 0 and self._is_not_found(e):
+                    logging.warning(f" La carpeta '{target_folder_url}' ya no existe en SharePoint: se vuelve a verificar")
+                    self.conn.clear()
+                    self.forget_folder(custom_folder_path)
+                    if create_folder and custom_folder_path:
+                        try:
+                            self.ensure_folders_exist(custom_folder_path)
+                        except Exception as e:
+                            print(f"ERROR al crear/verificar la carpeta '{custom_folder_path}': {e}")
+                            return False
+                    continue
+                logging.error(f"ERROR al subir el archivo '{file_name}' a la carpeta '{target_folder_url}': {e}")
                 return False
+
+
+    def _upload_in_chunks(self, target_folder, file_name: str, file_path: str, chunk_size: int = SHAREPOINT_CHUNK_SIZE,
+                          max_retries: int = SHAREPOINT_MAX_RETRIES):
+        """
+        Uploads a large file through a SharePoint upload session (StartUpload / ContinueUpload / FinishUpload).
+        Chunks are read from disk one at a time; if a chunk fails it is sent again from the last offset
+        acknowledged by the server instead of restarting the whole file.
+        The chunks go straight to `file_name`. If it already exists, its content only changes when FinishUpload
+        commits the session: it keeps its version history, Author and Created, and a failed upload cancels the
+        session and leaves it as it was. A new file is created empty first and deleted if the upload fails.
+
+        Returns:
+            File: The uploaded file. Raises the last error if a chunk keeps failing after `max_retries` attempts.
+        """
+        file_size = os.path.getsize(file_path)
+        upload_id = str(uuid.uuid4())
+
+        # Si el archivo ya existe se sube sobre él (nueva versión); si no, se crea vacío para recibir las partes
+        uploaded_file = target_folder.files.get_by_url(file_name)
+        self.conn.load(uploaded_file)
+        try:
+            self._execute_query()
+            created = False
         except Exception as e:
-            logging.error(f"ERROR al subir el archivo '{file_name}' a la carpeta '{target_folder_url}': {e}")
+            self.conn.clear()
+            if not self._is_not_found(e):
+                raise
+            uploaded_file = target_folder.files.add(file_name, None, True)
+            self._execute_query()
+            created = True
+
+        offset = 0  # Último offset confirmado por el servidor
+        failures = 0
+        with open(file_path, "rb") as file:
+            while offset < file_size:
+                file.seek(offset)
+                chunk = file.read(chunk_size)
+                is_last = offset + len(chunk) >= file_size
+                try:
+                    if is_last:
+                        uploaded_file.finish_upload(upload_id, offset, chunk)
+                    elif offset == 0:
+                        result = uploaded_file.start_upload(upload_id, chunk)
+                    else:
+                        result = uploaded_file.continue_upload(upload_id, offset, chunk)
+                    self._execute_query()
+                except Exception as e:
+                    failures += 1
+                    self.conn.clear()
+                    if failures > max_retries:
+                        logging.error(f"ERROR al subir '{file_name}' por partes ({offset}/{file_size} bytes): {e}")
+                        self._cancel_chunked_upload(uploaded_file, upload_id, delete=created)
+                        raise
+                    logging.warning(f" Falló la parte de '{file_name}' en el byte {offset}: se reanuda desde ahí ({e})")
+                    time.sleep(min(2 ** failures, 30))
+                    continue
+
+                failures = 0
+                offset = file_size if is_last else (result.value or offset + len(chunk))
+                logging.debug(f" '{file_name}': {offset}/{file_size} bytes subidos")
+
+        return uploaded_file  # FinishUpload devuelve las propiedades del archivo (ETag incluido, ver _remember_upload)
+
+    def _cancel_chunked_upload(self, uploaded_file, upload_id: str = None, delete = False):
+        """Cancels the upload session of a failed chunked upload (if it started) and deletes the file if the upload created it."""
+        if upload_id:
+            try:
+                uploaded_file.cancel_upload(upload_id)
+                self.conn.execute_query()
+            except Exception:
+                self.conn.clear()  # La sesión ya pudo haber expirado
+        if delete:
+            try:
+                uploaded_file.delete_object()
+                self.conn.execute_query()
+            except Exception as e:
+                self.conn.clear()
+                logging.warning(f" No se pudo borrar el archivo incompleto '{uploaded_file.serverRelativeUrl}': {e}")
+
+    def load_sync_state(self, state_path=SHAREPOINT_SYNC_STATE_PATH) -> dict:
+        """Loads the hashes and ETags of previous uploads (see upload_attachments with sync=True)."""
+        self._sync_state = {}
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as file:
+                    self._sync_state = json.load(file)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"- No se pudo leer el estado de sincronización de SharePoint ({e}); se subirán todos los archivos")
+        return self._sync_state
+
+    def save_sync_state(self, state_path=SHAREPOINT_SYNC_STATE_PATH):
+        """Persists the sync state (written to a temp file and then replaced)."""
+        if self._sync_state is None:
+            return
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        tmp_path = f"{state_path}.tmp"
+        with self._sync_lock, open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._sync_state, file, indent=2)
+        os.replace(tmp_path, state_path)
+
+    @staticmethod
+    def _file_sha256(file_path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def _remember_upload(self, server_relative_url: str, file_path: str, uploaded_file):
+        # Solo se registra en modo sync (ver upload_attachments)
+        if self._sync_state is None:
+            return
+        properties = getattr(uploaded_file, "properties", {})
+        entry = {
+            "sha256": self._file_sha256(file_path),
+            "size": os.path.getsize(file_path),
+            "etag": properties.get("ETag"),
+        }
+        with self._sync_lock:
+            self._sync_state[server_relative_url.lower()] = entry
+
+    def _is_unchanged(self, remote_file: dict, file_path: str, content_hash: str = None) -> bool:
+        """True if the remote file is still the version uploaded from a local file with the same content."""
+        entry = self._sync_state.get(remote_file["server_relative_url"].lower()) if self._sync_state else None
+        if not entry or not os.path.exists(file_path):
+            return False
+        if remote_file.get("size") != os.path.getsize(file_path) or remote_file.get("etag") != entry.get("etag"):
             return False
+        return entry.get("sha256") == (content_hash or self._file_sha256(file_path))
+
+    def upload_attachments(self, attachment_logs: list[AttachmentLog], folder_for, max_workers: int = SHAREPOINT_MAX_WORKERS,
+                           create_folder = True, sync = False, save_state = True) -> list[dict]:
+        """
+        Uploads a batch of attachments in parallel. All workers share the authenticated context of this
+        session (a single login) and each one uses its own ClientContext; throttled requests are retried
+        after the Retry-After indicated by SharePoint. Entries with the same target folder and name are
+        uploaded only once.
+
+        Args:
+            attachment_logs (list[AttachmentLog]): Attachments to upload (new_name, local_path and content_hash are used).
+            folder_for (callable): Receives an AttachmentLog and returns its SharePoint folder path
+                (as `custom_folder_path` in upload_file), or None to skip it.
+            max_workers (int, optional): Maximum number of simultaneous uploads. Defaults to SHAREPOINT_MAX_WORKERS.
+            create_folder (bool, optional): Create the target folders if needed. Defaults to True.
+            sync (bool, optional): List the target folders first and skip the files whose remote copy has the same
+                size, ETag and content hash as the last upload from this machine (SHAREPOINT_SYNC_STATE_PATH).
+                Defaults to False.
+            save_state (bool, optional): Persist the sync state at the end. A caller that uploads several batches
+                can pass False and call `save_sync_state` once when it finishes. Defaults to True.
+
+        Returns:
+            list[dict]: One status per entry, in the same order, with the keys file, folder, uploaded, skipped and error.
+                Skipped files count as uploaded.
+        """
+        if not self.conn and not self.auth():
+            return [{"file": log.new_name, "folder": None, "uploaded": False, "skipped": False, "error": "Sin conexión a SharePoint"}
+                    for log in attachment_logs]
+
+        statuses = []
+        uploads = {}  # (carpeta, nombre) -> AttachmentLog a subir
+        for attachment_log in attachment_logs:
+            folder = folder_for(attachment_log)
+            statuses.append({"file": attachment_log.new_name, "folder": folder, "uploaded": False, "skipped": False, "error": None})
+            if folder is None:
+                statuses[-1]["error"] = "Sin carpeta de destino"
+            else:
+                uploads.setdefault((folder, attachment_log.new_name), attachment_log)
+
+        workers = threading.local()
+
+        def list_folder(folder):
+            files = self._thread_session(workers).list_files(folder, verbose=False) or []
+            return {file["name"].lower(): file for file in files}
+
+        def upload(item):
+            (folder, file_name), attachment_log = item
+            try:
+                return self._thread_session(workers).upload_file(file_name, folder, create_folder=create_folder,
+                                                            local_path=attachment_log.local_path), None
+            except Exception as e:
+                logging.error(f"ERROR al subir el archivo '{file_name}' a la carpeta '{folder}': {e}")
+                return False, str(e)
+
+        if sync and self._sync_state is None:
+            self.load_sync_state()
+
+        results = {}
+        skipped = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if sync:
+                # Un listado por carpeta de destino; se omiten los archivos que no cambiaron desde la última subida
+                folders = list({folder for folder, _ in uploads})
+                remote_files = dict(zip(folders, executor.map(list_folder, folders)))
+                for (folder, file_name), attachment_log in uploads.items():
+                    remote_file = remote_files[folder].get(file_name.lower())
+                    local_path = attachment_log.local_path or os.path.join(UPLOAD_PATH, file_name)
+                    if remote_file and self._is_unchanged(remote_file, local_path, attachment_log.content_hash):
+                        results[(folder, file_name)] = (True, None)
+                        skipped.add((folder, file_name))
+
+            pending = [item for item in uploads.items() if item[0] not in skipped]
+            results.update(zip([key for key, _ in pending], executor.map(upload, pending)))
+
+        for status in statuses:
+            if status["folder"] is not None:
+                uploaded, error = results[(status["folder"], status["file"])]
+                status["uploaded"] = bool(uploaded)
+                status["skipped"] = (status["folder"], status["file"]) in skipped
+                status["error"] = error if uploaded else (error or "No se pudo subir el archivo")
+
+        if sync:
+            if save_state:
+                self.save_sync_state()
+            print(f"- {len(skipped)} archivos sin cambios en SharePoint (omitidos)")
+        print(f"- {sum(bool(uploaded) for key, (uploaded, _) in results.items() if key not in skipped)}/{len(pending)} archivos subidos a SharePoint")
+        return statuses
 
 
     # def allocate_files_from_folder(self, dictionary, personal):
@@ -304,9 +778,42 @@ class Sharepoint():
     #     print(f"Total de archivos subidos: {len(uploaded_files)}")
     #     return uploaded_files
         
+    def _stream_to_disk(self, file_url: str, local_file_path: str, time_last_modified: str = None,
+                        chunk_size: int = SHAREPOINT_DOWNLOAD_CHUNK_SIZE):
+        """
+        Streams a file to disk in chunks (written to a ".part" file that replaces the target when complete).
+        If `time_last_modified` is given ("YYYY-MM-DD HH:MM:SS", as in list_files) it is set as the local mtime.
+        """
+        remote_file = self.conn.web.get_file_by_server_relative_url(file_url)
+        tmp_path = f"{local_file_path}.part"
+        try:
+            with open(tmp_path, "wb") as local_file:
+                remote_file.download_session(local_file, chunk_size=chunk_size)
+                self._execute_query()
+            os.replace(tmp_path, local_file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if time_last_modified:
+            mtime = self._remote_timestamp(time_last_modified)
+            os.utime(local_file_path, (mtime, mtime))
+
+    @staticmethod
+    def _remote_timestamp(time_last_modified: str) -> float:
+        return datetime.strptime(time_last_modified, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+    def _is_downloaded(self, file_meta: dict, local_file_path: str) -> bool:
+        """True if the local copy has the same size and modified time as the remote file."""
+        if not os.path.exists(local_file_path) or not file_meta.get("time_last_modified"):
+            return False
+        local_stat = os.stat(local_file_path)
+        return (local_stat.st_size == file_meta.get("size")
+                and int(local_stat.st_mtime) == int(self._remote_timestamp(file_meta["time_last_modified"])))
+
     def download_file(self, file_url: str, file_name: str):
         """
-        Descarga un archivo específico de SharePoint.
+        Descarga un archivo específico de SharePoint (por partes, sin cargarlo completo en memoria).
 
         Args:
             file_url (str): URL completa del archivo en SharePoint.
@@ -316,15 +823,11 @@ class Sharepoint():
             str: Ruta local del archivo descargado.
         """
         try:
-            # Descargar el archivo
-            file = File.open_binary(self.conn, file_url)
-
             # Crear la ruta local para guardar el archivo
             local_file_path = os.path.join(DOWNLOAD_PATH, file_name)
 
             # Escribir el contenido en el archivo local
-            with open(local_file_path, 'wb') as local_file:
-                local_file.write(file.content)
+            self._stream_to_disk(file_url, local_file_path)
 
             print(f"Archivo descargado con éxito: {local_file_path}")
             return local_file_path
@@ -346,25 +849,26 @@ class Sharepoint():
             print(f"Error al descargar el archivo '{file_name}': {e}")
         return local_file_path
     
-    def download_files_from_folder(self, custom_folder_path="", folder_name="", extension=""):
+    def download_files_from_folder(self, custom_folder_path="", folder_name="", extension="", max_workers: int = SHAREPOINT_MAX_WORKERS):
         """
-        Descarga todos los archivos de una carpeta específica de SharePoint.
+        Descarga todos los archivos de una carpeta específica de SharePoint. Los archivos se descargan en
+        paralelo y por partes; se omiten los que ya están en local con el mismo tamaño y fecha de modificación.
         
         Args:
             custom_folder_path (str, optional): Ruta personalizada de la carpeta.
             folder_name (str, optional): Nombre de la subcarpeta dentro de la carpeta personalizada.
-            personal (bool, optional): Indica si la carpeta es personal o de un sitio de equipo.
             extension (str, optional): Filtra los archivos por extensión (e.g., '.txt', '.csv'). 
                 Si está vacío, descarga todos los archivos.
+            max_workers (int, optional): Descargas simultáneas. Defaults to SHAREPOINT_MAX_WORKERS.
 
         Returns:
-            list: Lista de rutas locales de los archivos descargados.
+            list: Lista de rutas locales de los archivos descargados (o ya actualizados).
         """
         # Crear la URL de la carpeta de destino
         target_folder_url = self._select_folder(custom_folder_path, folder_name)
 
         # Listar los archivos de la carpeta
-        files_metadata = self.list_files(custom_folder_path, folder_name)
+        files_metadata = self.list_files(custom_folder_path, folder_name, verbose=False)
         if not files_metadata:
             print(f"No se encontraron archivos en la carpeta: {target_folder_url}")
             return []
@@ -373,37 +877,36 @@ class Sharepoint():
         if not os.path.exists(DOWNLOAD_PATH):
             os.makedirs(DOWNLOAD_PATH)
 
-        downloaded_files = []
-
-        # Descargar cada archivo
+        # Filtrar por extensión y omitir los archivos que ya están actualizados antes de descargar
+        up_to_date = []
+        pending = []
         for file_meta in files_metadata:
-            file_name = file_meta["name"]
-
-            # Filtrar por extensión si se especifica
-            if extension and not file_name.endswith(extension):
+            if extension and not file_meta["name"].endswith(extension):
                 continue
+            local_file_path = os.path.join(DOWNLOAD_PATH, file_meta["name"])
+            if self._is_downloaded(file_meta, local_file_path):
+                up_to_date.append(local_file_path)
+            else:
+                pending.append((file_meta, local_file_path))
 
-            # Construir la URL completa del archivo en SharePoint
-            file_url = file_meta["server_relative_url"]
+        workers = threading.local()
 
+        def download(item):
+            file_meta, local_file_path = item
             try:
-                # Descargar el archivo
-                file = File.open_binary(self.conn, file_url)
-
-                # Crear la ruta local para guardar el archivo
-                local_file_path = os.path.join(DOWNLOAD_PATH, file_name)
-
-                # Escribir el contenido en el archivo local
-                with open(local_file_path, 'wb') as local_file:
-                    local_file.write(file.content)
-
+                self._thread_session(workers)._stream_to_disk(file_meta["server_relative_url"], local_file_path,
+                                                              file_meta["time_last_modified"])
                 print(f"Archivo descargado con éxito: {local_file_path}")
-                downloaded_files.append(local_file_path)
+                return local_file_path
             except Exception as e:
-                print(f"No se pudo descargar el archivo {file_name}: {e}")
-        print(f'Number of files downloaded: {len(downloaded_files)}')
+                print(f"No se pudo descargar el archivo {file_meta['name']}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloaded_files = [path for path in executor.map(download, pending) if path]
 
-        return downloaded_files
+        print(f'Number of files downloaded: {len(downloaded_files)} ({len(up_to_date)} ya estaban actualizados)')
+        return up_to_date + downloaded_files
 
 
 #sharepoint_session = Sharepoint(SHAREPOINT_URL_SITE, SHAREPOINT_FOLDER)
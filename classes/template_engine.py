@@ -0,0 +1,104 @@
+import os
+import html
+import threading
+from string import Formatter
+
+
+class Markup(str):
+    """String that is already safe HTML: it is inserted as is, without escaping."""
+
+
+class CompiledTemplate:
+    def __init__(self, text: str, autoescape: bool = True, collapse_whitespace: bool = False):
+        """
+        Template with the same placeholder syntax as `str.format` ({name}, {name:spec}, {{ and }}),
+        parsed once into its static segments and slots so that rendering is only a join.
+
+        Args:
+            text (str): Template text.
+            autoescape (bool, optional): HTML-escape every value that is not Markup. Defaults to True.
+            collapse_whitespace (bool, optional): Collapse runs of whitespace of the template into one
+                space (what send_emails_with_template used to do on every call). Defaults to False.
+        """
+        if collapse_whitespace:
+            text = " ".join(text.split())
+        self.autoescape = autoescape
+        self.segments = []  # Textos estáticos: siempre hay uno más que slots
+        self.slots = []     # (nombre, conversión, formato) de cada marcador
+        pending = ""
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            pending += literal
+            if field_name is None:
+                continue
+            if not field_name.isidentifier():
+                raise ValueError(f"Marcador no soportado en la plantilla: '{{{field_name}}}'")
+            self.segments.append(pending)
+            self.slots.append((field_name, conversion, format_spec))
+            pending = ""
+        self.segments.append(pending)
+
+    @property
+    def placeholders(self) -> list[str]:
+        """Names of the placeholders, in order of first appearance."""
+        return list(dict.fromkeys(name for name, _conversion, _spec in self.slots))
+
+    def _value(self, value, conversion, format_spec) -> str:
+        if conversion == "r":
+            value = repr(value)
+        elif conversion == "s":
+            value = str(value)
+        elif conversion == "a":
+            value = ascii(value)
+        text = format(value, format_spec) if format_spec else str(value)
+        if self.autoescape and not isinstance(value, Markup):
+            return html.escape(text)
+        return text
+
+    def render(self, **values) -> str:
+        """
+        Fills the slots with `values`. Missing values raise KeyError, like `str.format`.
+
+        Returns:
+            str: Rendered text (Markup if the template escapes its values, so it can be nested in another one).
+        """
+        parts = [self.segments[0]]
+        for (name, conversion, format_spec), segment in zip(self.slots, self.segments[1:]):
+            parts.append(self._value(values[name], conversion, format_spec))
+            parts.append(segment)
+        rendered = "".join(parts)
+        return Markup(rendered) if self.autoescape else rendered
+
+
+_cache = {}  # (ruta absoluta, autoescape, collapse_whitespace) -> (mtime_ns, tamaño, CompiledTemplate)
+_cache_lock = threading.Lock()
+
+
+def load_template(template_path: str, autoescape: bool = None, collapse_whitespace: bool = False) -> CompiledTemplate:
+    """
+    Returns the compiled template of a file. The file is read and parsed once; later calls only
+    stat it and reuse the compiled version until its modification time or size changes.
+
+    Args:
+        template_path (str): Path of the template.
+        autoescape (bool, optional): HTML-escape values. Defaults to True for .html/.htm files.
+        collapse_whitespace (bool, optional): See CompiledTemplate. Defaults to False.
+
+    Returns:
+        CompiledTemplate
+    """
+    path = os.path.abspath(template_path)
+    if autoescape is None:
+        autoescape = path.lower().endswith((".html", ".htm"))
+    stat = os.stat(path)  # FileNotFoundError si no existe
+    key = (path, autoescape, collapse_whitespace)
+
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    with open(path, "r", encoding="utf-8") as file:
+        template = CompiledTemplate(file.read(), autoescape, collapse_whitespace)
+    with _cache_lock:
+        _cache[key] = (stat.st_mtime_ns, stat.st_size, template)
+    return template
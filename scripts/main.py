@@ -2,18 +2,24 @@
 import os
 import re
 import json
+import asyncio
+from functools import lru_cache
 from shutil import move
 from dotenv import load_dotenv
 from pydantic import EmailStr
-from correos_automaticos.classes.outlook_manager import OutlookRetriever, OutlookSender
-from correos_automaticos.classes.file_manager import FileManager
+from correos_automaticos.classes.outlook_manager import OutlookRetriever, OutlookSender, SyncCheckpoint
+from correos_automaticos.classes.file_manager import FileManager, RubroClassifier
 from correos_automaticos.classes.sharepoint_manager import Sharepoint
 from pprint import pprint
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from icecream import ic
 import logging
 from correos_automaticos.classes.models import EmailData, AttachmentLog
-from excel_automation.classes.core.excel_auto_chart import ExcelAutoChart
+from correos_automaticos.classes.notifications import DigestOutbox, MessageOutbox
+from correos_automaticos.classes.attachment_journal import AttachmentJournal
+from correos_automaticos.classes.attachment_store import AttachmentStore
+from correos_automaticos.classes.ledger import ProcessingLedger
 
 
 # -------------------------------------------------------------
@@ -32,13 +38,9 @@ SUBJECT_FILTER = "Sistematizar"
 
 # Diccionario para clasificar códigos de fichas
 ruta_json_1 = os.path.join(script_dir, "..", "..", 'datasets', "rubros_subrubros.json")
-with open(ruta_json_1, "r", encoding='utf-8') as file:
-    rubros_subrubros = json.load(file)
 
 # Diccionario para renombrar archivos a partir de "Título largo"
 ruta_json_2 = os.path.join(script_dir, "..", "..", 'datasets', "info_obs.json")
-with open(ruta_json_2, "r", encoding='utf-8') as file:
-    info_obs = json.load(file)
 
 # Configuración del logging para guardar en el archivo con ruta personalizada
 log_file_path = os.path.join(script_dir, "correos_log.txt")
@@ -55,48 +57,86 @@ logging.basicConfig(
 # --------------------------------------------------------------
 # ------------- 1. Definir funciones subordinadas --------------
 # --------------------------------------------------------------
-def construct_file_path(file_name: str, regex_dict: dict = rubros_subrubros) -> str:
+# Los datasets se leen la primera vez que se usan (y no al importar este módulo)
+@lru_cache(maxsize=None)
+def cargar_rubros_subrubros() -> dict:
+    with open(ruta_json_1, "r", encoding='utf-8') as file:
+        return json.load(file)
+
+
+@lru_cache(maxsize=None)
+def cargar_info_obs() -> dict:
+    with open(ruta_json_2, "r", encoding='utf-8') as file:
+        return json.load(file)
+
+
+@lru_cache(maxsize=None)
+def clasificador_rubros() -> RubroClassifier:
+    """Índice de clasificación precompilado (se construye una sola vez y reporta patrones superpuestos o inalcanzables)."""
+    return RubroClassifier(cargar_rubros_subrubros(), known_codes=cargar_info_obs().keys())
+
+
+def construct_file_path(file_name: str, classifier: RubroClassifier = None) -> str:
     """
-    Clasifica una ficha según su nombre a partir del diccionario rubros_subrubros.
+    Clasifica una ficha según su nombre a partir del índice construido con rubros_subrubros.
 
     Args:
         file_name (str): El nombre del archivo a clasificar.
-        diccionario (dict): Diccionario que define las categorías y sus patrones regex.
+        classifier (RubroClassifier, optional): Índice de patrones regex por categoría. Defaults to clasificador_rubros().
 
     Returns:
         str: El path de clasificación en formato 'rubro/subrubro' o 'rubro/subrubro/departamento' si es territorial. 
     """
     patron = file_name.split(" ")[0]  # Se asume que el patrón o código está antes del espacio
-    
-    for rubro, subdict in regex_dict.items():
-        for subrubro, regex in subdict.items():
-            
-            # Caso 1: nivel simple (nacional, global)
-            if isinstance(regex, str) and re.match(regex, patron, re.IGNORECASE):  # Añadí re.IGNORECASE para no diferenciar entre mayúsculas y minúsculas
-                return f'{rubro}/{subrubro}'
-            
-            # Caso 2: nivel complejo (es territorial)
-            if isinstance(regex, dict):
-                for departamento, true_regex in regex.items():
-                    if isinstance(true_regex, str) and re.match(true_regex, patron, re.IGNORECASE):
-                        return f'{rubro}/{subrubro}/{departamento}'
-
-    print(f"  No se encontró coincidencia para: {file_name}")
-    return ""
-
-
-def construct_user_attachments(emails_data: list[EmailData], renamed_files_map: list)-> dict[EmailStr, AttachmentLog]:
+
+    path = (classifier or clasificador_rubros()).classify(patron)
+    if not path:
+        print(f"  No se encontró coincidencia para: {file_name}")
+    return path
+
+
+def index_renamed_files(renamed_files_map: list, files_index: dict = None) -> dict:
+    """
+    Indexa las entradas de rename_files para resolver cada adjunto en tiempo constante.
+
+    Args:
+        renamed_files_map (list): Entradas obtenidas de rename_files (ver renombrar_correo).
+        files_index (dict, optional): Índice a extender (p.ej. el acumulado del pipeline). Si es None, se crea uno nuevo.
+
+    Returns:
+        dict: {"by_file": {(msg_id, original_name): entrada}, "by_name": {original_name: entrada},
+            "by_hash": {content_hash: (msg_id, original_name)}}
+    """
+    if files_index is None:
+        files_index = {"by_file": {}, "by_name": {}, "by_hash": {}}
+
+    for file_dict in renamed_files_map:
+        original_name = file_dict.get('original_name', '')
+        files_index["by_file"].setdefault((file_dict.get('msg_id'), original_name), file_dict)
+        files_index["by_name"].setdefault(original_name, file_dict)
+        # Adjuntos con el mismo contenido (hash) se descargan una sola vez: todos se resuelven
+        # al correo y nombre original del archivo que sí se guardó y renombró
+        if file_dict.get('content_hash'):
+            files_index["by_hash"].setdefault(file_dict['content_hash'], (file_dict.get('msg_id'), original_name))
+    return files_index
+
+
+def construct_user_attachments(emails_data: list[EmailData], renamed_files_map: list, files_index: dict = None)-> dict[EmailStr, AttachmentLog]:
     """
     Reconstructs email_data dict to another dict suitable for sending confirmation emails to users based on uploaded attachments
 
     Args:
         email_data (dict): Dict obtained from get_emails.
-        renamed_files_map (dict): Dict obtained from rename_files
+        renamed_files_map (dict): Dict obtained from rename_files (per email, see renombrar_correo).
+        files_index (dict, optional): Index of earlier entries (see index_renamed_files), e.g. the one kept by the
+            pipeline across emails. It is extended in place with `renamed_files_map`.
 
     Returns:
         dict: A dictionary with senders as keys, attachments as subkeys, and details as values.
     """
     user_attachments_log = {}
+    files_index = index_renamed_files(renamed_files_map, files_index)
+    file_paths = {}  # new_name -> clasificación, calculada una sola vez por nombre
 
     # Iterar sobre los valores en email_data
     for email_data in emails_data:
@@ -105,30 +145,38 @@ def construct_user_attachments(emails_data: list[EmailData], renamed_files_map:
         # Inicializar diccionario para el remitente si no existe
         if sender not in user_attachments_log:
             user_attachments_log[sender] = []
-        
-        # Obtener lista de adjuntos
-        attachments = email_data.attachments
 
         # Iterar sobre los nombres originales de los archivos adjuntos
-        for old_file_name in attachments:
+        for old_file_name in email_data.attachments:
+            content_hash = email_data.attachment_hashes.get(old_file_name)
+            stored_file = files_index["by_hash"].get(content_hash, (email_data.msg_id, old_file_name))
 
             # Obtener el nuevo nombre del archivo del mapa de renombrados
-            for file_dict in renamed_files_map:
-                original_name = file_dict.get('original_name', '')
-                if original_name == old_file_name:
-                    new_file_name = file_dict.get('new_name')
-                
-                    # Construir la entrada del archivo
-                    attachment_log = AttachmentLog(
-                        original_name = old_file_name,
-                        new_name= new_file_name,
-                        author = sender,
-                        path = construct_file_path(new_file_name)
-                    )
-                    user_attachments_log[sender].append(attachment_log)
-                    break
-            else:
+            file_dict = files_index["by_file"].get(stored_file)
+            if file_dict is None:
+                # Entradas sin msg_id (p.ej. un mapa de rename_files sobre toda la carpeta): se busca solo por nombre
+                file_dict = files_index["by_name"].get(stored_file[1])
+                if file_dict is not None and file_dict.get('msg_id') is not None:
+                    file_dict = None
+            if file_dict is None:
                 logging.info(f"File {old_file_name} not found in renamed_files_map for sender {sender}")  # Depuración
+                continue
+
+            new_file_name = file_dict.get('new_name')
+            if new_file_name not in file_paths:
+                file_paths[new_file_name] = construct_file_path(new_file_name)
+
+            # Construir la entrada del archivo
+            attachment_log = AttachmentLog(
+                original_name = old_file_name,
+                new_name= new_file_name,
+                author = sender,
+                msg_id = email_data.msg_id,
+                content_hash = content_hash,
+                local_path = file_dict.get('new_path'),
+                path = file_paths[new_file_name]
+            )
+            user_attachments_log[sender].append(attachment_log)
 
     return user_attachments_log
 
@@ -140,135 +188,373 @@ def construct_user_attachments(emails_data: list[EmailData], renamed_files_map:
 # ------------- 2. Definir funciones principales --------------
 # -------------------------------------------------------------
 ### OutlookRetriever
-def obtener_archivos(start_date: str):
+def obtener_archivos(start_date: str, incremental: bool = True, ledger: ProcessingLedger = None, checkpoint: SyncCheckpoint = None):
     """_summary_
 
     Args:
-        start_date (str, optional): _description_. 
+        start_date (str, optional): Fecha desde la que se buscan correos en la primera sincronización
+            (o cuando cambia el UIDVALIDITY del buzón).
+        incremental (bool): Si es True, solo se descargan los correos posteriores al último UID procesado.
+        ledger (ProcessingLedger, optional): Registro de procesamiento; los correos ya procesados no se descargan.
+        checkpoint (SyncCheckpoint, optional): Checkpoint que el llamador avanza recién cuando los correos
+            terminaron de procesarse (ver registrar_correos_completos).
 
     Returns:
         email_data (dict)
     """
     outlook_session = OutlookRetriever()
     outlook_session._auth()
-    email_data = outlook_session.get_emails(start_date=start_date, subject_filter=SUBJECT_FILTER)
-    outlook_session.download_attachments(email_data)
+    # Un solo pase: cada correo se descarga una vez y sus adjuntos se guardan al parsearlo
+    email_data = outlook_session.get_emails(start_date=start_date, subject_filter=SUBJECT_FILTER, download=True, incremental=incremental,
+                                            ledger=ledger, checkpoint=checkpoint)
     return email_data
 
 
 ### FileManager
-def renombrar_y_clasificar(search_directory = DOWNLOAD_PATH, email_data = {}):
+def renombrar_correo(email_data: EmailData, search_directory = DOWNLOAD_PATH, ledger: ProcessingLedger = None) -> list[dict]:
+    """
+    Renombra y clasifica los adjuntos de un solo correo dentro de su carpeta (search_directory/<UID>),
+    por lo que varios correos pueden procesarse en paralelo sin pisarse los archivos. Si el registro
+    (ledger) ya tiene los adjuntos renombrados del correo y siguen en disco, se reutilizan.
+
+    Returns:
+        list[dict]: renamed_files_map del correo, con su msg_id y content_hash en cada entrada.
+    """
+    if ledger is not None:
+        previous = ledger.renamed_files(email_data.msg_id)
+        if previous and all(file_dict["new_path"] and os.path.exists(file_dict["new_path"]) for file_dict in previous):
+            return previous
+
+    message_directory = os.path.join(search_directory, email_data.msg_id)
+    if not os.path.isdir(message_directory):
+        return []
+    renamed_files_map = FileManager(search_directory=message_directory).rename_files(cargar_info_obs())
+    for file_dict in renamed_files_map:
+        file_dict["msg_id"] = email_data.msg_id
+        file_dict["content_hash"] = email_data.attachment_hashes.get(file_dict["original_name"])
+    return renamed_files_map
+
+
+def renombrar_y_clasificar(search_directory = DOWNLOAD_PATH, email_data = [], max_workers: int = 4, ledger: ProcessingLedger = None):
     """_summary_
 
     Args:
-        search_directory (str): Path, please change it from DOWNLOAD_PATH.
-        dict_to_rename (dict): Defaults to info_obs.
-        email_data (dict): 
+        search_directory (str): Carpeta con una subcarpeta por correo (DOWNLOAD_PATH/<UID>).
+        email_data (list[EmailData]): Correos obtenidos con obtener_archivos.
+        max_workers (int): Número de correos que se renombran en paralelo.
+        ledger (ProcessingLedger, optional): Registro donde se guardan los correos y adjuntos renombrados (los
+            correos quedan procesados recién cuando se suben sus archivos, ver registrar_correos_completos).
 
     Returns:
         user_attachments_final (dict): Diccionario con senders como keys, attachments como subkeys y los paths como valores.
     """
-    file_manager = FileManager(search_directory=search_directory)
-    renamed_files_map = file_manager.rename_files(info_obs)
-    #lista_nombres_archivos = FileManager(ruta_renombrados).list_files()
+    renamed_files_map = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for message_files_map in executor.map(lambda single_email: renombrar_correo(single_email, search_directory, ledger), email_data):
+            renamed_files_map.extend(message_files_map)
     user_attachments_log = construct_user_attachments(email_data, renamed_files_map)
+    if ledger is not None:
+        ledger.record_processed(email_data, user_attachments_log)
     return user_attachments_log
 
 
 # TODO: Update to pydantic
 ### Sharepoint
-def upload_files_to_sharepoint(user_attachments_log: dict[str, AttachmentLog]):
-    sharepoint_tendencias = Sharepoint(SHAREPOINT_URL, SHAREPOINT_FOLDER_TENDENCIAS, connect_on_creation=False)
-    sharepoint_ryo = Sharepoint(SHAREPOINT_URL, SHAREPOINT_FOLDER_RYO, connect_on_creation=False)
+def crear_sesiones_sharepoint() -> dict[str, Sharepoint]:
+    """Sesiones (sin autenticar todavía) de las bibliotecas de Tendencias y de Riesgos y oportunidades."""
+    return {
+        "tendencias": Sharepoint(SHAREPOINT_URL, SHAREPOINT_FOLDER_TENDENCIAS, connect_on_creation=False),
+        "ryo": Sharepoint(SHAREPOINT_URL, SHAREPOINT_FOLDER_RYO, connect_on_creation=False),
+    }
+
+
+def carpeta_sharepoint(attachment_details: AttachmentLog):
+    """
+    Determina en qué SharePoint y en qué carpeta se sube un archivo a partir de su clasificación.
 
+    Returns:
+        tuple | None: (llave de la sesión en crear_sesiones_sharepoint, custom_folder_path), o None si la ruta no es válida.
+    """
+    path_folders = attachment_details.path.split("/")
+    new_file_name = attachment_details.new_name
+
+    # Determinar en qué SharePoint subir el archivo
+    if path_folders[0].upper() == "TENDENCIAS":
+        session_key = "tendencias"
+        custom_folder_path = f'{SHAREPOINT_FOLDER}/AOI Tendencias/{"/".join(path_folders[1:])}'
+    elif path_folders[0].upper() in ("RIESGOS", "OPORTUNIDADES"):
+        session_key = "ryo"
+        custom_folder_path = f'{SHAREPOINT_FOLDER}/AOI Riesgos y oportunidades/{"/".join(path_folders[1:])}'
+    else:
+        logging.error(f"Check for correct path {path_folders} for {new_file_name}")
+        return None
+
+    # Construir la ruta de la carpeta según la condición
+    if len(path_folders) == 2: # Nacional o global
+        custom_folder_path = f'{custom_folder_path}/{os.path.splitext(new_file_name)[0]}'
+    elif len(path_folders) == 3: # Territorial
+        custom_folder_path = custom_folder_path
+    else:
+        logging.error(f"Check for path length: {new_file_name}")
+        return None
+    return session_key, custom_folder_path
+
+
+def upload_files_to_sharepoint(user_attachments_log: dict[str, AttachmentLog], sharepoint_sessions: dict = None, upload_results: dict = None,
+                               max_workers: int = 4, sync: bool = True, ledger: ProcessingLedger = None, save_state: bool = True):
+    """
+    Sube a SharePoint los archivos de user_attachments_log y actualiza `sharepoint_uploaded`.
+
+    Args:
+        user_attachments_log (dict[str, list[AttachmentLog]]): Logs por remitente.
+        sharepoint_sessions (dict, optional): Sesiones de crear_sesiones_sharepoint para reutilizarlas entre llamadas.
+        upload_results (dict, optional): Estados de subidas previas, para no subir dos veces el mismo archivo entre llamadas.
+        max_workers (int, optional): Subidas simultáneas por sesión (ver Sharepoint.upload_attachments).
+        sync (bool, optional): No volver a subir archivos que no cambiaron desde la última subida; se marcan como subidos.
+        ledger (ProcessingLedger, optional): Registro de procesamiento: los archivos cuyo contenido ya se subió a la
+            misma ruta se marcan como subidos sin consultar SharePoint, y se registra el resultado de cada subida.
+        save_state (bool, optional): Guardar el estado de sincronización de cada sesión al terminar. Con False
+            (p.ej. varias llamadas con las mismas `sharepoint_sessions`) el llamador lo guarda una vez al final.
+    """
+    sharepoint_sessions = sharepoint_sessions or crear_sesiones_sharepoint()
+    if upload_results is None:
+        upload_results = {}  # (carpeta, nombre) -> estado; el mismo archivo enviado por varios remitentes se sube una vez
+
+    candidates = []  # (sesión, carpeta, AttachmentLog)
     for logs in user_attachments_log.values():
         for attachment_details in logs:
             attachment_details: AttachmentLog
-            attachment_details.sharepoint_uploaded = False
-
-            path_folders = attachment_details.path.split("/")
-            new_file_name = attachment_details.new_name
-
-            # Determinar en qué SharePoint subir el archivo
-            if path_folders[0].upper() == "TENDENCIAS":
-                if not sharepoint_tendencias.conn:
-                    sharepoint_tendencias.auth()
-                sharepoint_session = sharepoint_tendencias
-                custom_folder_path = f'{SHAREPOINT_FOLDER}/AOI Tendencias/{"/".join(path_folders[1:])}'
-            elif path_folders[0].upper() in ("RIESGOS", "OPORTUNIDADES"):
-                if not sharepoint_ryo.conn:
-                    sharepoint_ryo.auth()
-                sharepoint_session = sharepoint_ryo
-                custom_folder_path = f'{SHAREPOINT_FOLDER}/AOI Riesgos y oportunidades/{"/".join(path_folders[1:])}'
-            else:
-                logging.ERROR(f"Check for correct path {path_folders} for {new_file_name}")
+            destino = carpeta_sharepoint(attachment_details)
+            if destino is None:
+                attachment_details.sharepoint_uploaded = None  # Sin carpeta de destino válida: no se intenta subir
                 continue
+            attachment_details.sharepoint_uploaded = False
+            session_key, custom_folder_path = destino
 
-            # Construir la ruta de la carpeta según la condición
-            if len(path_folders) == 2: # Nacional o global
-                custom_folder_path = f'{custom_folder_path}/{os.path.splitext(new_file_name)[0]}'
-            elif len(path_folders) == 3: # Territorial
-                custom_folder_path = custom_folder_path
-            else:
-                logging.ERROR(f"Check for path length: {new_file_name}")
+            upload_key = (custom_folder_path, attachment_details.new_name)
+            if upload_key in upload_results:
+                attachment_details.sharepoint_uploaded = upload_results[upload_key]
                 continue
-
-            try:
-                # Subir archivo a SharePoint
-                sharepoint_session.upload_file(new_file_name, custom_folder_path, create_folder=True)
-                # Actualizar estado en el log
-                attachment_details.sharepoint_uploaded = True
-            except Exception as e:
-                logging.ERROR(f"Error {e} while saving: {new_file_name}")
+            candidates.append((session_key, custom_folder_path, attachment_details))
+
+    # Una sola consulta al registro para todos los archivos: lo que ya se subió con el mismo contenido no se vuelve a subir
+    already_uploaded = set()
+    if ledger is not None:
+        already_uploaded = ledger.uploaded_files([(attachment_details.content_hash, f"{folder}/{attachment_details.new_name}")
+                                                  for _session_key, folder, attachment_details in candidates])
+
+    pending = defaultdict(list)  # sesión -> AttachmentLogs por subir
+    for session_key, custom_folder_path, attachment_details in candidates:
+        if (attachment_details.content_hash, f"{custom_folder_path}/{attachment_details.new_name}") in already_uploaded:
+            attachment_details.sharepoint_uploaded = True
+            upload_results[(custom_folder_path, attachment_details.new_name)] = True
+            continue
+        pending[session_key].append(attachment_details)
+
+    # Subir en bloque por sesión (desde la carpeta del correo de origen de cada archivo)
+    for session_key, logs in pending.items():
+        statuses = sharepoint_sessions[session_key].upload_attachments(
+            logs, folder_for=lambda log: carpeta_sharepoint(log)[1], max_workers=max_workers, sync=sync, save_state=save_state
+        )
+        for attachment_details, status in zip(logs, statuses):
+            attachment_details.sharepoint_uploaded = status["uploaded"]
+            upload_results[(status["folder"], status["file"])] = status["uploaded"]
+        if ledger is not None:
+            ledger.record_uploads([(attachment_details, f'{status["folder"]}/{status["file"]}')
+                                   for attachment_details, status in zip(logs, statuses) if status["folder"]])
 
     return user_attachments_log
 
 ### TODO: Missing: sent_date, rubro, subrubro (to divide them), extension (doc, excel, other)
 def save_log(user_attachments_log: dict[str, AttachmentLog], create_excel: bool = False):
-    """Save the attachment log to a file by appending new data with indentation.
+    """Save the attachment log by appending only the new entries to the JSONL log (see AttachmentJournal).
+    `AttachmentJournal().to_json_array()` rebuilds the old logs/attachment_log.json when it is needed.
     
     Args:
         user_attachments_log (dict[str, list[AttachmentLog]]): Mapping of sender emails to attachment logs.
         create_excel (bool, optional): Placeholder for future functionality.
     """
-    json_path = os.path.join(script_dir, "..", "logs", "attachment_log.json")
-    structured_log = []
+    if create_excel:
+        # Dependencia opcional: solo se importa cuando se pide el reporte en Excel
+        from excel_automation.classes.core.excel_auto_chart import ExcelAutoChart
+    AttachmentJournal().append(
+        attachment_details.model_dump()
+        for logs in user_attachments_log.values()
+        for attachment_details in logs
+    )
 
-    for logs in user_attachments_log.values():
-        for attachment_details in logs:
-            entry = attachment_details.model_dump()
-            structured_log.append(entry)
 
-    if os.path.exists(json_path):
-        try:
-            with open(json_path, mode = "r", encoding="utf-8") as file:
-                existing_log = json.load(file)
-        except json.JSONDecodeError:
-            existing_log = []
+### OutlookSender
+def send_confirmation_emails(user_attachments_log, digest: bool = True, force: bool = False):
+    """
+    Notifica a cada remitente los archivos subidos. En modo resumen (digest) los archivos se acumulan en
+    la bandeja local entre ejecuciones y solo se envían los resúmenes que ya vencieron o se llenaron.
+
+    Args:
+        user_attachments_log (dict): Logs por remitente.
+        digest (bool, optional): Usar la bandeja de resúmenes (DigestOutbox). Defaults to True.
+        force (bool, optional): Enviar todos los resúmenes pendientes sin esperar. Defaults to False.
+    """
+    outlook_sender_session = OutlookSender()
+    message_outbox = MessageOutbox()  # Todo correo se guarda antes de enviarse; los fallidos se reintentan después
+    if digest:
+        outbox = DigestOutbox()
+        print(f"- {outbox.add(user_attachments_log)} archivos agregados a la bandeja de resúmenes")
+        results = outbox.flush(outlook_sender_session, force=force, message_outbox=message_outbox)
     else:
-        existing_log = []
-        
-    existing_log.extend(structured_log)
+        message_outbox.enqueue_notifications(outlook_sender_session, user_attachments_log, "sharepoint_success.html")
+        results = message_outbox.drain(outlook_sender_session)
+    outlook_sender_session.logout()
 
-    with open(json_path, mode = "w", encoding="utf-8") as file:
-        json.dump(existing_log, file, indent=2, ensure_ascii=False)
+    failed = [result for result in results if not result["sent"]]
+    print(f"- Confirmaciones enviadas: {len(results) - len(failed)}/{len(results)}")
+    for result in failed:
+        retry = "se reintentará" if result["status"] == "pending" else "no se reintentará"
+        logging.error(f"No se pudo enviar la confirmación a {result['recipient']} ({retry}): {result['error']}")
+    return results
 
 
-### OutlookSender
-def send_confirmation_emails(user_attachments_log):
-    outlook_sender_session = OutlookSender()
-    outlook_sender_session.send_emails_with_template(user_attachments_log, "sharepoint_success.html")
-    outlook_sender_session.logout()
+def correos_completos(emails_data: list[EmailData], user_attachments_log: dict[str, list[AttachmentLog]]) -> list[str]:
+    """
+    UIDs de los correos que terminaron de procesarse: ninguno de sus adjuntos quedó con la subida fallida
+    (los que no tienen carpeta de destino válida no se pueden subir y no bloquean al correo).
+    """
+    fallidos = {attachment_details.msg_id for logs in user_attachments_log.values() for attachment_details in logs
+                if attachment_details.sharepoint_uploaded is False}
+    return [email_data.msg_id for email_data in emails_data if email_data.msg_id not in fallidos]
+
+
+def registrar_correos_completos(emails_data: list[EmailData], user_attachments_log: dict[str, list[AttachmentLog]],
+                                checkpoint: SyncCheckpoint = None, ledger: ProcessingLedger = None):
+    """
+    Marca en el checkpoint de la bandeja y en el registro (ledger) los correos que terminaron de procesarse (ver
+    correos_completos). Los demás quedan pendientes y se vuelven a buscar en la siguiente ejecución, donde se
+    reutilizan sus adjuntos renombrados y solo se suben los archivos que faltan.
+    """
+    completos = correos_completos(emails_data, user_attachments_log)
+    if ledger is not None:
+        ledger.mark_processed(completos)
+    if checkpoint is not None:
+        checkpoint.done(*completos)
+    if len(completos) < len(emails_data):
+        logging.error(f"{len(emails_data) - len(completos)} correos con subidas fallidas; se reintentarán en la siguiente ejecución")
+    return completos
+
+
+def merge_user_attachments(target: dict, user_attachments_log: dict) -> dict:
+    """Agrega los logs por remitente de `user_attachments_log` a `target`."""
+    for sender, logs in user_attachments_log.items():
+        target.setdefault(sender, []).extend(logs)
+    return target
+
+
+### Pipeline asíncrono
+async def pipeline_async(start_date: str, incremental: bool = True, queue_size: int = 4, ledger: ProcessingLedger = None,
+                         upload_batch_size: int = 20):
+    """
+    Ejecuta las etapas de main como un pipeline: mientras el correo N+1 se descarga, el correo N se
+    renombra y los anteriores se suben a SharePoint. Las etapas se comunican con colas acotadas
+    y las librerías bloqueantes (IMAP, archivos, SharePoint) corren en el executor por defecto.
+    La etapa de subida toma a la vez todos los correos renombrados que esperan en su cola (hasta
+    `upload_batch_size`) y los sube en un solo lote: cada carpeta de destino se lista una vez por lote y
+    el estado de sincronización de SharePoint se guarda una sola vez al final.
+    Con un `ledger`, cada etapa consulta y actualiza el registro de procesamiento. El checkpoint de la
+    bandeja solo avanza sobre los correos cuyos archivos terminaron de subirse.
+
+    Returns:
+        dict: user_attachments_log de todos los correos procesados.
+    """
+    loop = asyncio.get_running_loop()
+    downloaded = asyncio.Queue(maxsize=queue_size)
+    renamed = asyncio.Queue(maxsize=max(queue_size, upload_batch_size))
+    user_attachments_log = {}
+    checkpoint = SyncCheckpoint() if incremental else None
+
+    def download_stage():
+        # Corre en un hilo: cada correo se pasa a la cola en cuanto termina su descarga
+        try:
+            outlook_session = OutlookRetriever()
+            outlook_session._auth()
+            for email_data in outlook_session.iter_emails(start_date=start_date, subject_filter=SUBJECT_FILTER,
+                                                          download=True, incremental=incremental, ledger=ledger,
+                                                          checkpoint=checkpoint):
+                asyncio.run_coroutine_threadsafe(downloaded.put(email_data), loop).result()
+        except Exception as e:
+            logging.error(f"Error al obtener los correos: {e}")
+        finally:
+            asyncio.run_coroutine_threadsafe(downloaded.put(None), loop).result()
+
+    async def rename_stage():
+        files_index = index_renamed_files([])  # Acumulado, para resolver adjuntos duplicados de correos anteriores
+        try:
+            while (email_data := await downloaded.get()) is not None:
+                try:
+                    message_files_map = await loop.run_in_executor(None, renombrar_correo, email_data, DOWNLOAD_PATH, ledger)
+                    message_log = construct_user_attachments([email_data], message_files_map, files_index)
+                    if ledger is not None:
+                        await loop.run_in_executor(None, ledger.record_processed, [email_data], message_log)
+                    await renamed.put((email_data, message_log))
+                except Exception as e:
+                    logging.error(f"Error al renombrar los adjuntos del correo {email_data.msg_id}: {e}")
+        finally:
+            await renamed.put(None)
+
+    async def upload_stage():
+        sharepoint_sessions = crear_sesiones_sharepoint()
+        upload_results = {}
+        finished = False
+        try:
+            while not finished:
+                # Se espera el primer correo y se suman los que ya están en la cola
+                batch = [await renamed.get()]
+                while batch[-1] is not None and not renamed.empty() and len(batch) < upload_batch_size:
+                    batch.append(renamed.get_nowait())
+                if batch[-1] is None:
+                    finished = True
+                    batch.pop()
+                if not batch:
+                    continue
+
+                emails_batch = [email_data for email_data, _ in batch]
+                batch_log = {}
+                for _, message_log in batch:
+                    merge_user_attachments(batch_log, message_log)
+                try:
+                    await loop.run_in_executor(None, lambda: upload_files_to_sharepoint(batch_log, sharepoint_sessions, upload_results,
+                                                                                        ledger=ledger, save_state=False))
+                    registrar_correos_completos(emails_batch, batch_log, checkpoint, ledger)
+                except Exception as e:
+                    logging.error(f"Error al subir archivos a SharePoint: {e}")
+                merge_user_attachments(user_attachments_log, batch_log)
+        finally:
+            for sharepoint_session in sharepoint_sessions.values():
+                await loop.run_in_executor(None, sharepoint_session.save_sync_state)
+
+    await asyncio.gather(loop.run_in_executor(None, download_stage), rename_stage(), upload_stage())
+    if checkpoint is not None:
+        checkpoint.save()
+
+    # El log se guarda una sola vez al final para no reescribir el archivo por cada correo
+    await loop.run_in_executor(None, save_log, user_attachments_log)
+    return user_attachments_log
 
 
 # -------------------------------------------------------------
 # ------------------------- 3. MAIN ---------------------------
 # -------------------------------------------------------------
-def main(start_date: str):
-    email_data = obtener_archivos(start_date)                                    # OutlookRetriever
-    user_attachments_log = renombrar_y_clasificar(DOWNLOAD_PATH, email_data)     # FileManager
-    user_attachments_log = upload_files_to_sharepoint(user_attachments_log)       # Sharepoint
-    save_log(user_attachments_log)
+def main(start_date: str, pipeline: bool = False):
+    ledger = ProcessingLedger()  # Registro consultable de correos, adjuntos y subidas ya procesados
+    AttachmentStore().prune()  # Objetos sin uso en ATTACHMENT_STORE_RETENTION_DAYS y temporales de descargas interrumpidas
+    if pipeline:
+        user_attachments_log = asyncio.run(pipeline_async(start_date, ledger=ledger))            # Outlook -> FileManager -> Sharepoint
+    else:
+        checkpoint = SyncCheckpoint()  # Solo avanza cuando los archivos de cada correo terminaron de subirse
+        email_data = obtener_archivos(start_date, ledger=ledger, checkpoint=checkpoint)             # OutlookRetriever
+        user_attachments_log = renombrar_y_clasificar(DOWNLOAD_PATH, email_data, ledger=ledger)     # FileManager
+        user_attachments_log = upload_files_to_sharepoint(user_attachments_log, ledger=ledger)       # Sharepoint
+        save_log(user_attachments_log)
+        registrar_correos_completos(email_data, user_attachments_log, checkpoint, ledger)
+        checkpoint.save()
     #send_confirmation_emails(user_attachments_log)                               # OutlookSender
     #ic(email_data)
     # for sender, attachment_logs in user_attachments_log.items():
@@ -0,0 +1,54 @@
+"""
+Benchmark of OutlookRetriever.get_emails over FakeIMAP (no network): compares one UID FETCH per email
+(batch_size=1, as before the batched fetch) with batches over compressed message sets.
+
+    python tests/benchmark_get_emails.py [n_emails] [latency_ms]
+
+Every IMAP command sleeps `latency_ms` (5 by default) to stand in for the round trip to Exchange;
+with 0 the numbers only measure the parsing cost.
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conftest  # noqa: F401,E402  (registra el paquete correos_automaticos)
+
+from correos_automaticos.classes import outlook_manager  # noqa: E402
+from correos_automaticos.classes.attachment_store import AttachmentStore  # noqa: E402
+from fakes import FakeIMAP, make_message  # noqa: E402
+
+
+class CountingIMAP(FakeIMAP):
+    def __init__(self, messages, latency: float):
+        super().__init__(messages)
+        self.latency = latency
+        self.round_trips = 0
+
+    def uid(self, command, *args):
+        self.round_trips += 1
+        time.sleep(self.latency)
+        return super().uid(command, *args)
+
+
+def run(n_emails: int, batch_size: int, latency: float) -> tuple[float, int]:
+    messages = {1000 + k: make_message(f"Sistematizar fichas {k}", "ana@ceplan.gob.pe", [(f"T{k}.xlsx", b"ficha")])
+                for k in range(n_emails)}
+    with tempfile.TemporaryDirectory() as tmp:
+        outlook_manager.DOWNLOAD_PATH = os.path.join(tmp, "descargas")
+        retriever = outlook_manager.OutlookRetriever(AttachmentStore(os.path.join(tmp, "store")))
+        retriever.mail = CountingIMAP(messages, latency)
+        start = time.perf_counter()
+        emails = retriever.get_emails(subject_filter="Sistematizar", batch_size=batch_size, max_workers=1)
+        elapsed = time.perf_counter() - start
+    assert len(emails) == n_emails
+    return elapsed, retriever.mail.round_trips
+
+
+if __name__ == "__main__":
+    n_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000
+    for label, batch_size in (("un FETCH por correo", 1), (f"lotes de {outlook_manager.FETCH_BATCH_SIZE}", outlook_manager.FETCH_BATCH_SIZE)):
+        elapsed, round_trips = run(n_emails, batch_size, latency)
+        print(f"{label:>22}: {n_emails / elapsed:8.1f} correos/s, {round_trips} comandos IMAP")
@@ -0,0 +1,16 @@
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# El repositorio es el paquete `correos_automaticos`; si no está instalado se importa desde esta copia
+try:
+    import correos_automaticos  # noqa: F401
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+        "correos_automaticos", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["correos_automaticos"] = module
+    spec.loader.exec_module(module)
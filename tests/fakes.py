@@ -0,0 +1,135 @@
+import re
+from email.message import EmailMessage
+
+
+def make_message(subject: str, sender: str, attachments: list[tuple[str, bytes]]) -> EmailMessage:
+    """Email with a text body and one application/octet-stream part (base64) per attachment."""
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = "Consulta Técnica <consultatecnica@ceplan.gob.pe>"
+    message["Date"] = "Mon, 9 Dec 2024 10:00:00 -0500"
+    message.set_content("Adjunto las fichas")
+    for name, content in attachments:
+        message.add_attachment(content, maintype="application", subtype="octet-stream", filename=name)
+    return message
+
+
+def _quote(value) -> bytes:
+    if value is None:
+        return b"NIL"
+    value = value if isinstance(value, bytes) else value.encode()
+    return b'"' + value.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+
+class FakeIMAP:
+    """
+    In-memory IMAP server with the subset of imaplib.IMAP4 used by OutlookRetriever: SELECT (UIDVALIDITY
+    and UIDNEXT), UID SEARCH (SUBJECT, UID n:*) and UID FETCH of ENVELOPE, BODYSTRUCTURE and BODY.PEEK[<part>].
+    `fail_fetch` holds the UIDs whose attachment FETCH answers NO.
+    """
+
+    def __init__(self, messages: dict[int, EmailMessage], uidvalidity: int = 7):
+        self.messages = messages
+        self.uidvalidity = uidvalidity
+        self.literal = None
+        self.fail_fetch = set()
+
+    def login(self, *args):
+        return "OK", [b""]
+
+    def logout(self):
+        return "BYE", [b""]
+
+    def select(self, folder="INBOX", readonly=False):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        if code == "UIDVALIDITY":
+            return code, [str(self.uidvalidity).encode()]
+        if code == "UIDNEXT":
+            return code, [str(max(self.messages) + 1).encode()]
+        return code, [None]
+
+    def _search(self, criteria) -> list[int]:
+        uids = sorted(self.messages)
+        text = " ".join(item if isinstance(item, str) else item.decode() for item in criteria)
+        if self.literal is not None:
+            subject, self.literal = self.literal.decode(), None
+        else:
+            match = re.search(r'SUBJECT "([^"]*)"', text)
+            subject = match.group(1) if match else None
+        match = re.search(r"UID (\d+):\*", text)
+        if match:
+            uids = [uid for uid in uids if uid >= int(match.group(1))] or uids[-1:]  # "n:*" incluye siempre el último
+        if subject:
+            uids = [uid for uid in uids if subject.lower() in str(self.messages[uid]["Subject"]).lower()]
+        return uids
+
+    def _expand(self, message_set: str) -> list[int]:
+        uids = []
+        for piece in message_set.split(","):
+            if ":" in piece:
+                start, end = piece.split(":")
+                end = max(self.messages) if end == "*" else int(end)
+                uids += [uid for uid in sorted(self.messages) if int(start) <= uid <= end]
+            else:
+                uids.append(int(piece))
+        return [uid for uid in uids if uid in self.messages]
+
+    def _bodystructure(self, message: EmailMessage) -> bytes:
+        parts = []
+        for part in message.iter_parts():
+            file_name = part.get_filename()
+            disposition = b'("attachment" ("filename" ' + _quote(file_name) + b"))" if file_name else b"NIL"
+            size = len(part.get_payload().encode())
+            encoding = _quote(part.get("Content-Transfer-Encoding", "7bit"))
+            if part.get_content_maintype() == "text":
+                parts.append(b'("text" "plain" ("charset" "utf-8") NIL NIL ' + encoding + b" %d 1 NIL %s NIL NIL)" % (size, disposition))
+            else:
+                parts.append(b'("application" "octet-stream" NIL NIL NIL ' + encoding + b" %d NIL %s NIL NIL)" % (size, disposition))
+        return b"(" + b"".join(parts) + b' "mixed" NIL NIL NIL NIL)'
+
+    def _envelope(self, message: EmailMessage) -> bytes:
+        mailbox, host = message["From"].split("@")
+        return (b"(" + _quote(message["Date"]) + b" " + _quote(message["Subject"]) + b" ((NIL NIL " + _quote(mailbox)
+                + b" " + _quote(host) + b')) NIL NIL ((NIL NIL "consultatecnica" "ceplan.gob.pe")) NIL NIL NIL NIL)')
+
+    def _fetch(self, uids: list[int], items: str) -> list:
+        data = []
+        sequence = sorted(self.messages)
+        for uid in uids:
+            message = self.messages[uid]
+            head = b"%d (UID %d" % (sequence.index(uid) + 1, uid)
+            if "ENVELOPE" in items:
+                head += b" ENVELOPE " + self._envelope(message)
+            if "BODYSTRUCTURE" in items:
+                head += b" BODYSTRUCTURE " + self._bodystructure(message)
+            sections = list(re.finditer(r"BODY\.PEEK\[([\d.]+)\](?:<(\d+)\.(\d+)>)?", items))
+            if not sections:
+                data.append(head + b")")
+                continue
+            parts = list(message.iter_parts())
+            for index, section in enumerate(sections):
+                payload = parts[int(section.group(1)) - 1].get_payload().encode()
+                label = b"BODY[%s]" % section.group(1).encode()
+                if section.group(2):
+                    offset, length = int(section.group(2)), int(section.group(3))
+                    payload = payload[offset:offset + length]
+                    label += b"<%d>" % offset
+                data.append(((head + b" " if index == 0 else b" ") + label + b" {%d}" % len(payload), payload))
+            data.append(b")")
+        return data
+
+    def uid(self, command, *args):
+        if command.upper() == "SEARCH":
+            args = list(args)
+            if args and args[0] == "CHARSET":
+                args = args[2:]
+            return "OK", [b" ".join(str(uid).encode() for uid in self._search(args))]
+        message_set, items = args
+        message_set = message_set.decode() if isinstance(message_set, bytes) else message_set
+        uids = self._expand(message_set)
+        if "BODY.PEEK" in items and self.fail_fetch.intersection(uids):
+            return "NO", [b"FETCH failed"]
+        return "OK", self._fetch(uids, items)
@@ -0,0 +1,55 @@
+import json
+
+from correos_automaticos.classes.attachment_journal import AttachmentJournal
+
+
+def _journal(tmp_path, **kwargs) -> AttachmentJournal:
+    return AttachmentJournal(str(tmp_path / "attachment_log.jsonl"), legacy_path=str(tmp_path / "attachment_log.json"), **kwargs)
+
+
+def test_append_and_read(tmp_path):
+    journal = _journal(tmp_path)
+    assert journal.append([]) == 0
+    assert journal.append([{"new_name": "t1.xlsx"}, {"new_name": "ñandú.docx"}]) == 2
+    assert journal.append([{"new_name": "t2.xlsx"}]) == 1
+    assert [record["new_name"] for record in journal] == ["t1.xlsx", "ñandú.docx", "t2.xlsx"]
+
+
+def test_rotation_keeps_the_newest_segments(tmp_path):
+    journal = _journal(tmp_path, max_bytes=1, max_segments=2)
+    for index in range(4):
+        journal.append([{"index": index}])
+    segments = journal.segments()
+    assert len(segments) == 3  # 2 segmentos rotados + el actual
+    assert segments[-1] == journal.log_path
+    assert [record["index"] for record in journal] == [1, 2, 3]
+
+
+def test_torn_last_line_is_skipped_and_not_glued_to_new_records(tmp_path):
+    journal = _journal(tmp_path)
+    journal.append([{"index": 0}])
+    with open(journal.log_path, "a", encoding="utf-8") as file:
+        file.write('{"index": 1, "new_na')  # Corte abrupto a mitad de una escritura
+
+    assert [record["index"] for record in journal] == [0]
+    journal.append([{"index": 2}])
+    assert [record["index"] for record in journal] == [0, 2]
+
+
+def test_legacy_json_array_is_imported_once(tmp_path):
+    legacy = tmp_path / "attachment_log.json"
+    legacy.write_text(json.dumps([{"index": 0}, {"index": 1}]), encoding="utf-8")
+
+    journal = _journal(tmp_path)
+    assert [record["index"] for record in journal] == [0, 1]
+    journal.append([{"index": 2}])
+    assert [record["index"] for record in _journal(tmp_path)] == [0, 1, 2]  # No se vuelve a importar
+
+    exported = tmp_path / "export.json"
+    assert journal.to_json_array(str(exported)) == 3
+    assert json.loads(exported.read_text(encoding="utf-8")) == [{"index": 0}, {"index": 1}, {"index": 2}]
+
+
+def test_unreadable_legacy_log_is_ignored(tmp_path):
+    (tmp_path / "attachment_log.json").write_text("[{roto", encoding="utf-8")
+    assert list(_journal(tmp_path)) == []
@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+from correos_automaticos.classes import attachment_store
+from correos_automaticos.classes.attachment_store import AttachmentStore
+
+
+def _commit(store: AttachmentStore, content: bytes, target_path: str):
+    writer = store.open_temp()
+    writer.write(content)
+    return store.commit(writer, target_path)
+
+
+@pytest.fixture
+def staging(tmp_path):
+    for uid in ("1001", "1002"):
+        os.makedirs(tmp_path / "descargas" / uid)
+    return tmp_path / "descargas"
+
+
+def test_same_content_is_materialized_once_per_session(tmp_path, staging):
+    store = AttachmentStore(str(tmp_path / "store"))
+
+    sha256, duplicate = _commit(store, b"ficha T1", str(staging / "1001" / "T1.xlsx"))
+    again, second_duplicate = _commit(store, b"ficha T1", str(staging / "1002" / "T1 (reenvio).xlsx"))
+
+    assert (again, duplicate, second_duplicate) == (sha256, False, True)
+    assert store.materialized_path(sha256) == str(staging / "1001" / "T1.xlsx")
+    assert not os.path.exists(staging / "1002" / "T1 (reenvio).xlsx")
+    assert os.listdir(tmp_path / "store" / "tmp") == []
+
+
+def test_staged_file_is_a_hard_link_to_the_object(tmp_path, staging):
+    store = AttachmentStore(str(tmp_path / "store"))
+    sha256, _ = _commit(store, b"ficha T1", str(staging / "1001" / "T1.xlsx"))
+
+    assert os.path.samefile(staging / "1001" / "T1.xlsx", store.blob_path(sha256))
+
+
+@pytest.mark.parametrize("hard_links", [True, False])
+def test_rerun_does_not_rewrite_staged_content(tmp_path, staging, monkeypatch, hard_links):
+    if not hard_links:
+        def no_link(*args):
+            raise OSError("sistema de archivos sin hard links")
+        monkeypatch.setattr(attachment_store.os, "link", no_link)
+    target = str(staging / "1001" / "T1.xlsx")
+    _commit(AttachmentStore(str(tmp_path / "store")), b"ficha T1", target)
+
+    def materialize(*args):
+        raise AssertionError("el archivo ya tenía el contenido")
+    monkeypatch.setattr(AttachmentStore, "_materialize", staticmethod(materialize))
+    # Nueva ejecución: otra instancia, sin el registro en memoria de la anterior
+    _sha256, duplicate = _commit(AttachmentStore(str(tmp_path / "store")), b"ficha T1", target)
+
+    assert not duplicate
+    with open(target, "rb") as file:
+        assert file.read() == b"ficha T1"
+
+
+def test_changed_staged_file_is_replaced(tmp_path, staging):
+    target = str(staging / "1001" / "T1.xlsx")
+    with open(target, "wb") as file:
+        file.write(b"version anterior")
+
+    sha256, _ = _commit(AttachmentStore(str(tmp_path / "store")), b"ficha T1", target)
+
+    assert os.path.samefile(target, AttachmentStore(str(tmp_path / "store")).blob_path(sha256))
+
+
+def test_prune_runs_only_when_called(tmp_path, staging):
+    store = AttachmentStore(str(tmp_path / "store"), retention_days=30)
+    sha256, _ = _commit(store, b"ficha T1", str(staging / "1001" / "T1.xlsx"))
+    old = time.time() - 31 * 24 * 60 * 60
+    os.utime(store.blob_path(sha256), (old, old))
+
+    store = AttachmentStore(str(tmp_path / "store"), retention_days=30)
+    assert os.path.exists(store.blob_path(sha256))  # Abrir el almacén no borra nada
+
+    assert store.prune() == 1
+    assert not os.path.exists(store.blob_path(sha256))
+    assert os.path.exists(staging / "1001" / "T1.xlsx")  # El hard link conserva el contenido
@@ -0,0 +1,65 @@
+import pytest
+
+from correos_automaticos.classes.file_manager import RubroClassifier
+
+REGEX_DICT = {
+    "Tendencias": {
+        "Tendencias Nacionales": r"t(\d+)$",
+        "Tendencias Globales": r"tg\d+$",
+        "Tendencias Territoriales": {"Lima": r"tt\d+_lima$", "Cusco": r"tt\d+_(cusco|cuzco)$", "Notas": 3},  # Los valores que no son texto se ignoran
+    },
+    "Riesgos": {
+        "Riesgos Nacionales": r"r\d+(_madre)?$",
+        "Riesgos Globales": r"r(g|\d+_g)\d*$",
+        "Riesgos Repetidos": r"r\d+(_madre)?$",  # Duplicado: nunca se alcanza
+    },
+    "Oportunidades": {"Oportunidades": r"o\d+"},  # Sin $: también coincide con 'o12_extra'
+}
+
+CODES = ["t80", "T80", "t80x", "tg3", "tt1_lima", "tt12_cusco", "tt2_cuzco", "tt3_arequipa", "r23", "r23_madre",
+         "rg", "r1_g", "r1_g2", "o12", "o12_extra", "x1", "", "tt1_LIMA"]
+
+
+def _sequential(classifier: RubroClassifier, code: str) -> str:
+    for path, pattern in zip(classifier.paths, classifier.patterns):
+        if pattern.match(code):
+            return path
+    return ""
+
+
+def test_combined_regex_matches_sequential_matching():
+    classifier = RubroClassifier(REGEX_DICT)
+    assert classifier._combined is not None
+    for code in CODES:
+        assert classifier.classify(code) == _sequential(classifier, code), code
+
+
+def test_classify_paths():
+    classifier = RubroClassifier(REGEX_DICT)
+    assert classifier.classify("T80") == "Tendencias/Tendencias Nacionales"
+    assert classifier.classify("tt12_cusco") == "Tendencias/Tendencias Territoriales/Cusco"
+    assert classifier.classify("r23_madre") == "Riesgos/Riesgos Nacionales"
+    assert classifier.classify("x1") == ""
+
+
+def test_backreferences_fall_back_to_sequential_matching():
+    classifier = RubroClassifier({"A": {"Doble": r"(\w)\1\d+", "Simple": r"\w\d+"}})
+    assert classifier._combined is None
+    assert classifier.classify("aa1") == "A/Doble"
+    assert classifier.classify("ab1") == ""
+    assert classifier.classify("b1") == "A/Simple"
+
+
+def test_report():
+    classifier = RubroClassifier(REGEX_DICT)
+    report = classifier.report(known_codes=["t1", "r2", "o3", "rg"])
+    assert report["duplicados"] == ["Riesgos/Riesgos Repetidos"]
+    assert "Tendencias/Tendencias Globales" in report["inalcanzables"]
+    assert "Riesgos/Riesgos Repetidos" not in report["inalcanzables"]
+
+
+@pytest.mark.parametrize("regex", [r"t(\d+", r"[a-"])
+def test_invalid_patterns_are_skipped(regex):
+    classifier = RubroClassifier({"A": {"Rota": regex, "Buena": r"b\d+"}})
+    assert classifier.paths == ["A/Buena"]
+    assert classifier.classify("b1") == "A/Buena"
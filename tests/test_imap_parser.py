@@ -0,0 +1,83 @@
+import io
+import base64
+import quopri
+
+import pytest
+
+from correos_automaticos.classes.imap_parser import (
+    PartDecoder, _tokenize_bytes, find_attachment_parts, parse_envelope, parse_fetch_response,
+)
+
+
+def test_tokenize_bytes():
+    tokens = list(_tokenize_bytes(b'12 (UID 1001 FLAGS (\\Seen) NIL "a \\"b\\" c" BODY[HEADER.FIELDS (SUBJECT)] {5}'))
+    assert tokens == ["12", "(", "UID", "1001", "FLAGS", "(", "\\Seen", ")", None, b'a "b" c',
+                      "BODY[HEADER.FIELDS (SUBJECT)]", "{5}"]
+
+
+def test_parse_fetch_response_with_literals():
+    msg_data = [
+        (b"1 (UID 1001 BODY[2] {5}", b"hello"),
+        b")",
+        b'2 (UID 1002 ENVELOPE ("Mon, 9 Dec 2024" "Asunto" NIL NIL NIL NIL NIL NIL NIL NIL))',
+    ]
+    first, second = parse_fetch_response(msg_data)
+    assert first == {"SEQ": "1", "UID": "1001", "BODY[2]": b"hello"}
+    assert second["UID"] == "1002" and second["ENVELOPE"][1] == b"Asunto"
+
+
+def test_parse_envelope():
+    envelope = [b"Mon, 9 Dec 2024 10:00:00 -0500", b"=?utf-8?q?Sistematizaci=C3=B3n?=",
+                [[b"Ana P\xc3\xa9rez", None, b"ana", b"ceplan.gob.pe"]], None, None,
+                [[None, None, b"ct", b"ceplan.gob.pe"], [b"Luis", None, b"luis", b"ceplan.gob.pe"]],
+                None, None, None, b"<id@x>"]
+    assert parse_envelope(envelope) == {
+        "date": "Mon, 9 Dec 2024 10:00:00 -0500",
+        "subject": "=?utf-8?q?Sistematizaci=C3=B3n?=",  # Se decodifica después (OutlookRetriever.decode_text)
+        "from_name": "Ana Pérez",
+        "from_email": "ana@ceplan.gob.pe",
+        "to": "ct@ceplan.gob.pe, Luis <luis@ceplan.gob.pe>",
+    }
+
+
+def test_find_attachment_parts():
+    bodystructure = [
+        [b"text", b"plain", [b"charset", b"utf-8"], None, None, b"7bit", "10", "1", None, None, None, None],
+        [b"application", b"pdf", [b"name", b"ficha.pdf"], None, None, b"base64", "120", None,
+         [b"attachment", [b"filename", b"ficha.pdf"]], None, None],
+        [b"application", b"octet-stream", None, None, None, b"base64", "80", None,
+         [b"attachment", [b"filename*0*", b"utf-8''T1%20Poblaci", b"filename*1*", b"%C3%B3n.xlsx"]], None, None],
+        b"mixed",
+    ]
+    assert find_attachment_parts(bodystructure) == [
+        {"part": "2", "filename": "ficha.pdf", "encoding": "base64", "size": 120},
+        {"part": "3", "filename": "T1 Población.xlsx", "encoding": "base64", "size": 80},
+    ]
+
+
+def _decode_in_chunks(encoding: str, encoded: bytes, chunk_size: int) -> bytes:
+    output = io.BytesIO()
+    decoder = PartDecoder(encoding, output)
+    for start in range(0, len(encoded), chunk_size):
+        decoder.write(encoded[start:start + chunk_size])
+    decoder.close()
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 7, 76, 77, 1000])
+def test_part_decoder_base64_chunk_boundaries(chunk_size):
+    payload = bytes(range(256)) * 3 + b"fin"
+    encoded = base64.encodebytes(payload).replace(b"\n", b"\r\n")  # Líneas de 76 caracteres, como en MIME
+    assert _decode_in_chunks("base64", encoded, chunk_size) == payload
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 13, 76, 1000])
+def test_part_decoder_quoted_printable_chunk_boundaries(chunk_size):
+    payload = ("Población, Educación = ñandú " * 20 + "\nlínea final sin salto").encode("utf-8")
+    encoded = quopri.encodestring(payload)  # =XX y saltos suaves (=\n) repartidos entre los bloques
+    assert b"=\n" in encoded
+    assert _decode_in_chunks("quoted-printable", encoded, chunk_size) == payload
+
+
+def test_part_decoder_passes_other_encodings_through():
+    assert _decode_in_chunks("7bit", b"texto plano", 3) == b"texto plano"
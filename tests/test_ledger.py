@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from correos_automaticos.classes.ledger import ProcessingLedger
+from correos_automaticos.classes.models import AttachmentLog, EmailData
+
+
+def _email(msg_id):
+    return EmailData(msg_id=msg_id, from_name="Ana", from_email="ana@ceplan.gob.pe", sent="", to="consulta@ceplan.gob.pe",
+                     subject="Sistematizar", body="", attachments=["T1.xlsx"], attachment_hashes={"T1.xlsx": f"hash{msg_id}"})
+
+
+def _log(msg_id, uploaded=None):
+    return AttachmentLog(new_name="t1 - ficha.xlsx", original_name="T1.xlsx", path="Tendencias/Tendencias Nacionales",
+                         author="ana@ceplan.gob.pe", msg_id=msg_id, content_hash=f"hash{msg_id}",
+                         local_path=f"/descargas/{msg_id}/t1 - ficha.xlsx", sharepoint_uploaded=uploaded)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = ProcessingLedger(str(tmp_path / "ledger.sqlite3"))
+    yield ledger
+    ledger.close()
+
+
+def test_email_is_processed_only_after_its_uploads(ledger):
+    ledger.record_processed([_email("1001")], {"ana@ceplan.gob.pe": [_log("1001")]})
+    assert ledger.processed_emails(["1001"]) == set()  # Renombrado, pero sin subir
+
+    ledger.record_uploads([(_log("1001", uploaded=False), "Tendencias/Tendencias Nacionales/t1 - ficha.xlsx")])
+    assert ledger.processed_emails(["1001"]) == set()
+    assert ledger.renamed_files("1001")[0]["new_path"] == "/descargas/1001/t1 - ficha.xlsx"
+
+    ledger.mark_processed(["1001"])
+    assert ledger.processed_emails(["1001", "1002"]) == {"1001"}
+
+
+def test_uploads_are_kept_when_the_email_is_renamed_again(ledger):
+    sharepoint_path = "Tendencias/Tendencias Nacionales/t1 - ficha.xlsx"
+    ledger.record_processed([_email("1001")], {"ana@ceplan.gob.pe": [_log("1001")]})
+    ledger.record_uploads([(_log("1001", uploaded=True), sharepoint_path)])
+    ledger.record_processed([_email("1001")], {"ana@ceplan.gob.pe": [_log("1001")]})
+
+    assert ledger.uploaded("hash1001", sharepoint_path)
+    assert not ledger.uploaded("hash1001", "Riesgos/t1 - ficha.xlsx")
+    assert ledger.uploaded_files([("hash1001", sharepoint_path), ("otro", sharepoint_path), (None, sharepoint_path)]) == {
+        ("hash1001", sharepoint_path)}
+    assert [row["status"] for row in ledger.attachments_by_sender("ana@ceplan.gob.pe")] == ["uploaded"]
+    assert ledger.attachments_by_sender("ana@ceplan.gob.pe", status="upload_failed") == []
+
+
+def test_lookups_larger_than_one_chunk(ledger):
+    emails = [_email(str(msg_id)) for msg_id in range(1200)]
+    ledger.record_processed(emails, {})
+    ledger.mark_processed([email.msg_id for email in emails[::2]])
+    assert len(ledger.processed_emails(range(1200))) == 600
+
+
+def test_each_thread_uses_its_own_connection(ledger):
+    ledger.record_processed([_email("1001")], {"ana@ceplan.gob.pe": [_log("1001")]})
+    results = []
+
+    def read():
+        results.append((ledger._connection(), ledger.renamed_files("1001")))
+        ledger.close()
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    connection, renamed = results[0]
+    assert connection is not ledger._connection()
+    assert [file_dict["new_name"] for file_dict in renamed] == ["t1 - ficha.xlsx"]
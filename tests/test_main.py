@@ -0,0 +1,221 @@
+"""
+End-to-end tests of scripts/main.py over fakes: FakeIMAP as the mailbox, and Sharepoint with upload_file and
+list_files patched (no network). Datasets, download folder, checkpoint, ledger and logs live in tmp_path.
+"""
+import asyncio
+from functools import partial
+
+import pytest
+from office365.sharepoint.client_context import ClientContext
+
+from correos_automaticos.classes import outlook_manager
+from correos_automaticos.classes.attachment_journal import AttachmentJournal
+from correos_automaticos.classes.attachment_store import AttachmentStore
+from correos_automaticos.classes.file_manager import RubroClassifier
+from correos_automaticos.classes.ledger import ProcessingLedger
+from correos_automaticos.classes.models import EmailData
+from correos_automaticos.classes.outlook_manager import OutlookRetriever, SyncCheckpoint
+from correos_automaticos.classes.sharepoint_manager import Sharepoint
+from correos_automaticos.scripts import main
+from fakes import FakeIMAP, make_message
+
+INFO_OBS = {f"t{k}": {"titulo_largo": f"Tendencia {k}"} for k in range(1, 6)}
+RUBROS = {"Tendencias": {"Tendencias Nacionales": r"t\d+"}}
+FOLDER = "Documentos compartidos/AOI Tendencias/Tendencias Nacionales"
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    download_path = str(tmp_path / "descargas")
+    monkeypatch.setattr(outlook_manager, "DOWNLOAD_PATH", download_path)
+    monkeypatch.setattr(main, "DOWNLOAD_PATH", download_path)
+    monkeypatch.setattr(main, "cargar_info_obs", lambda: INFO_OBS)
+    monkeypatch.setattr(main, "clasificador_rubros", lambda: RubroClassifier(RUBROS))
+
+    mailbox = FakeIMAP({
+        1001: make_message("Sistematizar fichas", "ana@ceplan.gob.pe", [("T1.xlsx", b"ficha 1")]),
+        1002: make_message("Sistematizar fichas", "luis@ceplan.gob.pe", [("T2.xlsx", b"ficha 2"), ("T3.docx", b"ficha 3")]),
+        1003: make_message("Sistematizar fichas", "ana@ceplan.gob.pe", [("T4.xlsx", b"ficha 4")]),
+    })
+    store = AttachmentStore(str(tmp_path / "store"))
+
+    class Retriever(OutlookRetriever):
+        def __init__(self):
+            super().__init__(store)
+
+        def _auth(self):
+            self.mail = mailbox
+
+        @staticmethod
+        def _connect():
+            connection = FakeIMAP(mailbox.messages)  # Conexiones del pool de descargas
+            connection.fail_fetch = mailbox.fail_fetch
+            return connection
+
+    monkeypatch.setattr(main, "OutlookRetriever", Retriever)
+    monkeypatch.setattr(main, "SyncCheckpoint", partial(SyncCheckpoint, state_path=str(tmp_path / "imap_sync_state.json")))
+    monkeypatch.setattr(main, "AttachmentStore", partial(AttachmentStore, str(tmp_path / "store")))
+    monkeypatch.setattr(main, "AttachmentJournal", partial(AttachmentJournal, str(tmp_path / "attachment_log.jsonl"),
+                                                           legacy_path=str(tmp_path / "attachment_log.json")))
+
+    remote = {"files": {}, "fail": set(), "attempts": [], "listings": [], "state_saves": 0}
+
+    def auth(self):
+        self.conn = ClientContext(self.SHAREPOINT_URL_SITE)
+        return self.conn
+
+    def upload_file(self, file_name, custom_folder_path="", create_folder=False, local_path=None):
+        remote["attempts"].append(file_name)
+        if file_name in remote["fail"]:
+            return False
+        with open(local_path, "rb") as file:
+            remote["files"][f"{custom_folder_path}/{file_name}"] = file.read()
+        return True
+
+    def list_files(self, custom_folder_path="", folder_name="", author=False, verbose=True):
+        remote["listings"].append(custom_folder_path)
+        return []
+
+    save_sync_state = Sharepoint.save_sync_state
+
+    def save_state(self, state_path=str(tmp_path / "sharepoint_sync_state.json")):
+        if self._sync_state is not None:
+            remote["state_saves"] += 1
+        save_sync_state(self, state_path)
+
+    monkeypatch.setattr(Sharepoint, "auth", auth)
+    monkeypatch.setattr(Sharepoint, "upload_file", upload_file)
+    monkeypatch.setattr(Sharepoint, "list_files", list_files)
+    monkeypatch.setattr(Sharepoint, "load_sync_state", lambda self, state_path=None: setattr(self, "_sync_state", {}) or {})
+    monkeypatch.setattr(Sharepoint, "save_sync_state", save_state)
+
+    ledger = ProcessingLedger(str(tmp_path / "ledger.sqlite3"))
+    monkeypatch.setattr(main, "ProcessingLedger", lambda: ledger)
+    yield {"mailbox": mailbox, "remote": remote, "ledger": ledger, "tmp_path": tmp_path}
+    ledger.close()
+
+
+def _uploaded(remote) -> list[str]:
+    return sorted(path.rsplit("/", 1)[1] for path in remote["files"])
+
+
+def test_main_is_sequential_by_default(env, monkeypatch):
+    async def pipeline(*args, **kwargs):
+        raise AssertionError("el pipeline es opcional")
+    monkeypatch.setattr(main, "pipeline_async", pipeline)
+
+    main.main("5-Dec-2024")
+
+    assert _uploaded(env["remote"]) == ["t1 - Tendencia 1.xlsx", "t2 - Tendencia 2.xlsx", "t3 - Tendencia 3.docx", "t4 - Tendencia 4.xlsx"]
+    assert env["ledger"].processed_emails(["1001", "1002", "1003"]) == {"1001", "1002", "1003"}
+
+
+def test_pipeline_uploads_in_batches_and_saves_the_sync_state_once(env):
+    user_attachments_log = asyncio.run(main.pipeline_async("5-Dec-2024", ledger=env["ledger"]))
+
+    remote = env["remote"]
+    assert _uploaded(remote) == ["t1 - Tendencia 1.xlsx", "t2 - Tendencia 2.xlsx", "t3 - Tendencia 3.docx", "t4 - Tendencia 4.xlsx"]
+    assert all(log.sharepoint_uploaded for logs in user_attachments_log.values() for log in logs)
+    assert remote["state_saves"] == 1  # Una vez al final, no por cada correo
+    assert len(remote["listings"]) == len(set(remote["listings"])) == 4  # Cada carpeta de destino se lista una vez
+    assert env["ledger"].processed_emails(["1001", "1002", "1003"]) == {"1001", "1002", "1003"}
+
+
+def _email_data(msg_id: str, sender: str, attachment_hashes: dict) -> EmailData:
+    return EmailData(msg_id=msg_id, from_name="", from_email=sender, sent=None, to="consultatecnica@ceplan.gob.pe",
+                     subject="Sistematizar fichas", body="", attachments=list(attachment_hashes), attachment_hashes=attachment_hashes)
+
+
+def _renamed(msg_id: str, original_name: str, new_name: str, content_hash: str) -> dict:
+    return {"original_name": original_name, "new_name": new_name, "new_path": f"/descargas/{msg_id}/clasificados/{new_name}",
+            "msg_id": msg_id, "content_hash": content_hash}
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    monkeypatch.setattr(main, "clasificador_rubros", lambda: RubroClassifier(RUBROS))
+
+
+def test_same_attachment_name_in_several_emails_resolves_per_email(classifier):
+    emails = [_email_data("1001", "ana@ceplan.gob.pe", {"T1.xlsx": "h1"}),
+              _email_data("1002", "luis@ceplan.gob.pe", {"T1.xlsx": "h2"})]
+    renamed = [_renamed("1001", "T1.xlsx", "t1 - Tendencia 1.xlsx", "h1"),
+               _renamed("1002", "T1.xlsx", "t1 - Tendencia 1.xlsx", "h2")]
+
+    user_attachments_log = main.construct_user_attachments(emails, renamed)
+
+    ana, = user_attachments_log["ana@ceplan.gob.pe"]
+    luis, = user_attachments_log["luis@ceplan.gob.pe"]
+    assert (ana.msg_id, ana.local_path) == ("1001", "/descargas/1001/clasificados/t1 - Tendencia 1.xlsx")
+    assert (luis.msg_id, luis.local_path) == ("1002", "/descargas/1002/clasificados/t1 - Tendencia 1.xlsx")
+    assert ana.path == luis.path == "Tendencias/Tendencias Nacionales"
+
+
+def test_deduplicated_attachment_resolves_by_hash_across_calls(classifier):
+    files_index = main.index_renamed_files([])
+    first = _email_data("1001", "ana@ceplan.gob.pe", {"T1.xlsx": "h1"})
+    main.construct_user_attachments([first], [_renamed("1001", "T1.xlsx", "t1 - Tendencia 1.xlsx", "h1")], files_index)
+
+    # El mismo contenido reenviado con otro nombre no se volvió a guardar: no tiene entrada propia
+    resent = _email_data("1002", "luis@ceplan.gob.pe", {"T1 (copia).xlsx": "h1", "T9.xlsx": "h9"})
+    user_attachments_log = main.construct_user_attachments([resent], [], files_index)
+
+    log, = user_attachments_log["luis@ceplan.gob.pe"]  # T9.xlsx no se renombró: se omite
+    assert (log.original_name, log.new_name, log.msg_id) == ("T1 (copia).xlsx", "t1 - Tendencia 1.xlsx", "1002")
+    assert log.local_path == "/descargas/1001/clasificados/t1 - Tendencia 1.xlsx"
+    assert files_index["by_hash"] == {"h1": ("1001", "T1.xlsx")}
+
+
+def test_entries_without_msg_id_are_looked_up_by_name(classifier):
+    renamed = [{"original_name": "T2.xlsx", "new_name": "t2 - Tendencia 2.xlsx", "new_path": "/clasificados/t2 - Tendencia 2.xlsx"}]
+
+    user_attachments_log = main.construct_user_attachments([_email_data("1001", "ana@ceplan.gob.pe", {"T2.xlsx": "h2"})], renamed)
+
+    assert [log.new_name for log in user_attachments_log["ana@ceplan.gob.pe"]] == ["t2 - Tendencia 2.xlsx"]
+
+
+@pytest.fixture
+def runs(env, monkeypatch):
+    """Runs main.main (sequential) and records the UIDs fetched by each run."""
+    fetched = []
+    obtener_archivos = main.obtener_archivos
+
+    def record_fetched(*args, **kwargs):
+        emails_data = obtener_archivos(*args, **kwargs)
+        fetched.append([email_data.msg_id for email_data in emails_data])
+        return emails_data
+
+    monkeypatch.setattr(main, "obtener_archivos", record_fetched)
+
+    def run() -> list[str]:
+        main.main("5-Dec-2024")
+        return fetched[-1]
+    return run
+
+
+def test_failed_upload_is_retried_on_the_next_run(env, runs):
+    remote, ledger = env["remote"], env["ledger"]
+    remote["fail"] = {"t3 - Tendencia 3.docx"}
+
+    assert runs() == ["1001", "1002", "1003"]
+    assert "t3 - Tendencia 3.docx" not in _uploaded(remote)
+    assert ledger.processed_emails(["1001", "1002", "1003"]) == {"1001", "1003"}
+
+    remote["fail"] = set()
+    remote["attempts"].clear()
+    assert runs() == ["1002"]  # Solo el correo incompleto se vuelve a buscar
+    assert remote["attempts"] == ["t3 - Tendencia 3.docx"]  # t2 ya estaba subido
+    assert _uploaded(remote) == ["t1 - Tendencia 1.xlsx", "t2 - Tendencia 2.xlsx", "t3 - Tendencia 3.docx", "t4 - Tendencia 4.xlsx"]
+    assert ledger.processed_emails(["1001", "1002", "1003"]) == {"1001", "1002", "1003"}
+
+    assert runs() == []
+
+
+def test_failed_download_is_retried_on_the_next_run(env, runs):
+    env["mailbox"].fail_fetch.add(1002)
+    assert runs() == ["1001", "1003"]
+    assert env["ledger"].processed_emails(["1001", "1002", "1003"]) == {"1001", "1003"}
+
+    env["mailbox"].fail_fetch.clear()
+    assert runs() == ["1002"]
+    assert _uploaded(env["remote"]) == ["t1 - Tendencia 1.xlsx", "t2 - Tendencia 2.xlsx", "t3 - Tendencia 3.docx", "t4 - Tendencia 4.xlsx"]
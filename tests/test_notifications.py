@@ -0,0 +1,204 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from correos_automaticos.classes import notifications
+from correos_automaticos.classes.models import AttachmentLog
+from correos_automaticos.classes.notifications import DigestOutbox, MessageOutbox
+
+
+class FakeSender:
+    """OutlookSender stand-in: renders one message per recipient and fails for the recipients in `fail_for`."""
+
+    def __init__(self, fail_for=()):
+        self.fail_for = set(fail_for)
+        self.sent = []
+
+    def render_notifications(self, user_attachments_log, template_name):
+        return [{"recipient": recipient, "subject": "Archivos recibidos", "body_type": "html",
+                 "body": ", ".join(entry["new_name"] for entry in entries)}
+                for recipient, entries in user_attachments_log.items()]
+
+    def send_batch(self, messages, sender_name="Outlook Bot"):
+        results = []
+        for message in messages:
+            sent = message["recipient"] not in self.fail_for
+            if sent:
+                self.sent.append(message)
+            results.append({"recipient": message["recipient"], "sent": sent, "attempts": 1,
+                            "error": None if sent else "550 rechazado"})
+        return results
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(notifications, "time", clock)
+    return clock
+
+
+def _message(recipient, key=None):
+    return {"recipient": recipient, "subject": "Archivos recibidos", "body": f"Hola {recipient}",
+            "idempotency_key": key or f"key-{recipient}"}
+
+
+def _log(name, author="ana@ceplan.gob.pe"):
+    return AttachmentLog(new_name=name, original_name=name.upper(), path="Tendencias/Tendencias Nacionales",
+                         author=author, content_hash=f"hash-{name}")
+
+
+# --- MessageOutbox ---
+def test_enqueue_ignores_messages_already_in_the_outbox(tmp_path):
+    outbox = MessageOutbox(str(tmp_path / "outbox.sqlite3"))
+    outbox.enqueue([_message("a@x.pe"), _message("b@x.pe")])
+    outbox.enqueue([_message("a@x.pe")])
+    assert outbox.counts() == {"pending": 2}
+
+
+def test_claimed_messages_are_not_claimed_twice(tmp_path):
+    outbox = MessageOutbox(str(tmp_path / "outbox.sqlite3"))
+    outbox.enqueue([_message(f"{index}@x.pe") for index in range(3)])
+    first, second = outbox._claim_due(2), outbox._claim_due(2)
+    assert len(first) == 2 and len(second) == 1
+    assert {row["recipient"] for row in first} | {row["recipient"] for row in second} == {"0@x.pe", "1@x.pe", "2@x.pe"}
+    assert outbox.counts() == {"sending": 3}
+
+
+def test_failed_deliveries_back_off_until_max_attempts(tmp_path, clock):
+    outbox = MessageOutbox(str(tmp_path / "outbox.sqlite3"), max_attempts=3)
+    outbox.enqueue([_message("a@x.pe"), _message("b@x.pe")])
+    sender = FakeSender(fail_for={"a@x.pe"})
+
+    records = outbox.drain(sender)
+    assert {record["recipient"]: record["status"] for record in records} == {"a@x.pe": "pending", "b@x.pe": "sent"}
+    assert outbox.next_attempt_at() == clock.now + notifications.OUTBOX_BACKOFF_BASE
+    assert outbox.drain(sender) == []  # Todavía no toca reintentar
+
+    start = clock.now
+    records = outbox.drain(sender, wait=True)  # Espera los reintentos programados: 1x y 2x la espera base
+    assert [(record["attempts"], record["status"]) for record in records] == [(2, "pending"), (3, "failed")]
+    assert clock.now - start == notifications.OUTBOX_BACKOFF_BASE * 3
+    assert outbox.counts() == {"sent": 1, "failed": 1}
+    assert outbox.next_attempt_at() is None
+
+
+def test_interrupted_send_is_not_resent_on_restart(tmp_path, clock):
+    db_path = str(tmp_path / "outbox.sqlite3")
+    outbox = MessageOutbox(db_path)
+    outbox.enqueue([_message("a@x.pe"), _message("b@x.pe")])
+    outbox._claim_due(1)  # El proceso se cae con el mensaje de a@x.pe en 'sending'
+
+    clock.now += notifications.OUTBOX_CLAIM_LEASE
+    restarted = MessageOutbox(db_path)
+    sender = FakeSender()
+    restarted.drain(sender)
+
+    assert [message["recipient"] for message in sender.sent] == ["b@x.pe"]
+    assert restarted.counts() == {"sent": 1, "unknown": 1}
+
+    assert restarted.requeue_unknown(["a@x.pe"]) == 1
+    restarted.drain(sender)
+    assert [message["recipient"] for message in sender.sent] == ["b@x.pe", "a@x.pe"]
+    assert restarted.counts() == {"sent": 2}
+
+
+def test_messages_claimed_by_a_live_instance_are_left_alone(tmp_path, clock):
+    db_path = str(tmp_path / "outbox.sqlite3")
+    outbox = MessageOutbox(db_path)
+    outbox.enqueue([_message("a@x.pe"), _message("b@x.pe")])
+    claimed = outbox._claim_due(1)  # Esta instancia está enviando a a@x.pe
+
+    other = MessageOutbox(db_path)  # Otra instancia (u otro proceso) abre la misma bandeja mientras tanto
+    sender = FakeSender()
+    other.drain(sender)
+    assert [message["recipient"] for message in sender.sent] == ["b@x.pe"]
+    assert outbox.counts() == {"sending": 1, "sent": 1}
+
+    outbox._record(claimed, [{"recipient": "a@x.pe", "sent": True, "attempts": 1, "error": None}])
+    assert outbox.counts() == {"sent": 2}
+
+
+def test_result_of_a_requeued_message_does_not_overwrite_the_new_claim(tmp_path, clock):
+    db_path = str(tmp_path / "outbox.sqlite3")
+    outbox = MessageOutbox(db_path)
+    outbox.enqueue([_message("a@x.pe")])
+    claimed = outbox._claim_due(1)  # La instancia se cuelga a mitad del envío
+
+    clock.now += notifications.OUTBOX_CLAIM_LEASE
+    other = MessageOutbox(db_path)
+    assert other.requeue_unknown() == 1
+    other._claim_due(1)
+    outbox._record(claimed, [{"recipient": "a@x.pe", "sent": False, "attempts": 1, "error": "timeout"}])
+    assert other.counts() == {"sending": 1}  # El mensaje sigue siendo de la otra instancia
+
+
+def test_outbox_without_claim_columns_is_migrated(tmp_path):
+    db_path = str(tmp_path / "outbox.sqlite3")
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("""CREATE TABLE messages (
+            id INTEGER PRIMARY KEY, idempotency_key TEXT NOT NULL UNIQUE, recipient TEXT NOT NULL,
+            subject TEXT NOT NULL, body TEXT NOT NULL, body_type TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, last_error TEXT,
+            created_at REAL NOT NULL, sent_at REAL)""")
+        connection.execute("""INSERT INTO messages (idempotency_key, recipient, subject, body, body_type, status,
+                              next_attempt_at, created_at) VALUES ('k', 'a@x.pe', 's', 'b', 'plain', 'sending', 0, 0)""")
+    connection.close()
+
+    outbox = MessageOutbox(db_path)
+    assert outbox.counts() == {"unknown": 1}  # Tomado antes de existir el plazo: se da por interrumpido
+    outbox.enqueue([_message("b@x.pe")])
+    assert len(outbox._claim_due(5)) == 1
+
+
+def test_idempotency_key_ignores_order_and_recipient_case():
+    logs = [_log("t1.xlsx"), _log("t2.xlsx")]
+    assert MessageOutbox.idempotency_key("Ana@ceplan.gob.pe", logs) == MessageOutbox.idempotency_key(
+        "ana@ceplan.gob.pe", [log.model_dump() for log in reversed(logs)])
+    assert MessageOutbox.idempotency_key("ana@ceplan.gob.pe", logs[:1]) != MessageOutbox.idempotency_key("ana@ceplan.gob.pe", logs)
+
+
+# --- DigestOutbox ---
+def test_digest_is_due_by_size_age_or_force(tmp_path):
+    outbox = DigestOutbox(str(tmp_path / "digest.json"), interval_minutes=60, max_files=2)
+    assert outbox.add({"ana@ceplan.gob.pe": [_log("t1.xlsx"), _log("t1.xlsx")],
+                       "luis@ceplan.gob.pe": [_log("t2.xlsx", "luis@ceplan.gob.pe")]}) == 2
+    assert outbox.due() == {}
+    assert set(outbox.due(force=True)) == {"ana@ceplan.gob.pe", "luis@ceplan.gob.pe"}
+    assert set(outbox.due(now=datetime.now() + timedelta(minutes=61))) == {"ana@ceplan.gob.pe", "luis@ceplan.gob.pe"}
+
+    outbox.add({"ana@ceplan.gob.pe": [_log("t3.xlsx")]})
+    assert list(outbox.due()) == ["ana@ceplan.gob.pe"]
+    assert len(DigestOutbox(str(tmp_path / "digest.json"))) == 2  # Se conserva entre ejecuciones
+
+
+def test_remove_keeps_entries_queued_meanwhile(tmp_path):
+    outbox = DigestOutbox(str(tmp_path / "digest.json"))
+    outbox.add({"ana@ceplan.gob.pe": [_log("t1.xlsx")]})
+    due = outbox.due(force=True)
+    outbox.add({"ana@ceplan.gob.pe": [_log("t2.xlsx")]})
+    outbox.remove(due)
+    assert [entry["new_name"] for entry in outbox.due(force=True)["ana@ceplan.gob.pe"]] == ["t2.xlsx"]
+
+
+def test_flush_hands_digests_over_to_the_message_outbox(tmp_path):
+    outbox = DigestOutbox(str(tmp_path / "digest.json"), max_files=1)
+    message_outbox = MessageOutbox(str(tmp_path / "outbox.sqlite3"))
+    outbox.add({"ana@ceplan.gob.pe": [_log("t1.xlsx")]})
+    sender = FakeSender(fail_for={"ana@ceplan.gob.pe"})
+
+    records = outbox.flush(sender, message_outbox=message_outbox)
+    assert [record["status"] for record in records] == ["pending"]
+    assert len(outbox) == 0  # El mensaje quedó en la bandeja de salida, que se encarga de reintentarlo
+    assert message_outbox.counts() == {"pending": 1}
@@ -0,0 +1,245 @@
+import imaplib
+import smtplib
+from types import SimpleNamespace
+
+import pytest
+
+from correos_automaticos.classes import outlook_manager
+from correos_automaticos.classes.attachment_store import AttachmentStore
+from correos_automaticos.classes.notifications import MessageOutbox
+from correos_automaticos.classes.outlook_manager import IMAPConnectionPool, OutlookRetriever, OutlookSender, RateLimiter, SyncCheckpoint
+from fakes import FakeIMAP, make_message
+
+
+@pytest.fixture
+def mailbox():
+    return FakeIMAP({
+        1001: make_message("Sistematizar fichas", "ana@ceplan.gob.pe", [("T1.xlsx", b"ficha 1")]),
+        1002: make_message("Sistematización de fichas", "luis@ceplan.gob.pe", [("T2.xlsx", b"ficha 2")]),
+        1003: make_message("Otro asunto", "ana@ceplan.gob.pe", []),
+    })
+
+
+@pytest.fixture
+def retriever(tmp_path, monkeypatch, mailbox):
+    monkeypatch.setattr(outlook_manager, "DOWNLOAD_PATH", str(tmp_path / "descargas"))
+    retriever = OutlookRetriever(AttachmentStore(str(tmp_path / "store")))
+    retriever.mail = mailbox
+    return retriever
+
+
+def test_non_ascii_subject_literal_only_goes_with_its_search(retriever, mailbox):
+    charset, criteria, literal = retriever._build_search_criteria("5-Dec-2024", "Sistematización")
+    assert (charset, criteria, literal) == ("UTF-8", ["SINCE", "5-DEC-2024", "SUBJECT"], "Sistematización".encode("utf-8"))
+    assert mailbox.literal is None  # Construir el criterio no toca la conexión
+
+    assert retriever._search_uids(charset, criteria, literal) == [1002]
+    assert mailbox.literal is None
+    assert retriever._search_uids(None, ["ALL"]) == [1001, 1002, 1003]  # Sin el literal del SEARCH anterior
+
+
+def test_ascii_subject_is_searched_on_the_server(retriever):
+    charset, criteria, literal = retriever._build_search_criteria(None, 'Sistematizar "fichas"')
+    assert charset is None and literal is None
+    assert criteria == ["ALL", "SUBJECT", '"Sistematizar \\"fichas\\""']
+    assert retriever._build_search_criteria("2024-12-05", "Sistematizar") == (None, None, None)
+
+
+def test_get_emails_filters_by_subject(retriever):
+    emails = retriever.get_emails(subject_filter="Sistematizar", max_workers=1)
+    assert [(email.msg_id, email.from_email, email.subject) for email in emails] == [
+        ("1001", "ana@ceplan.gob.pe", "Sistematizar fichas")]
+
+
+def test_invalid_start_date_is_ignored_when_resuming_from_checkpoint(retriever, tmp_path):
+    state_path = str(tmp_path / "imap_sync_state.json")
+    OutlookRetriever.save_sync_state({"uidvalidity": 7, "last_uid": 1001}, state_path=state_path)
+
+    emails = retriever.get_emails("2024-12-05", subject_filter="Sistemati", max_workers=1,
+                                  checkpoint=SyncCheckpoint(state_path=state_path))
+    assert [email.msg_id for email in emails] == ["1002"]
+
+    # Sin checkpoint la fecha sí se usa, y una fecha inválida no busca nada
+    assert retriever.get_emails("2024-12-05", subject_filter="Sistemati", max_workers=1) == []
+
+
+class PoolIMAP(FakeIMAP):
+    def __init__(self):
+        super().__init__({1001: make_message("Sistematizar fichas", "ana@ceplan.gob.pe", [])})
+        self.logged_out = False
+
+    def logout(self):
+        self.logged_out = True
+        return super().logout()
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def pool(opened):
+    def connect():
+        opened.append(PoolIMAP())
+        return opened[-1]
+    return IMAPConnectionPool(connect, size=2)
+
+
+def test_pool_reuses_idle_connections(pool, opened):
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        with pool.connection() as third:
+            pass
+
+    assert second is first and third is not first
+    assert len(opened) == 2
+
+
+def test_pool_replaces_dead_connections(pool, opened):
+    with pytest.raises(imaplib.IMAP4.abort):
+        with pool.connection():
+            raise imaplib.IMAP4.abort("socket error: EOF")
+    with pytest.raises(KeyError):
+        with pool.connection():
+            raise KeyError("UID")  # Un error que no es de conexión no la descarta
+
+    with pool.connection() as connection:
+        pass
+
+    assert opened[0].logged_out
+    assert connection is opened[1] and not connection.logged_out
+
+
+def test_pool_close_waits_for_borrowed_connections(pool, opened):
+    with pool.connection() as borrowed:
+        with pool.connection():
+            pass
+        idle = opened[1]
+        pool.close()
+
+        assert idle.logged_out
+        assert not borrowed.logged_out  # Sigue en uso: no se le cierra la conexión
+
+    assert borrowed.logged_out
+    with pytest.raises(ValueError):
+        with pool.connection():
+            pass
+
+
+class FakeSMTP:
+    """SMTP connection that answers each send_message with the next scripted outcome (an exception or a refused dict)."""
+
+    def __init__(self, outcomes: list, sent: list):
+        self.outcomes = outcomes
+        self.sent = sent
+        self.closed = False
+
+    def starttls(self):
+        pass
+
+    def login(self, *args):
+        pass
+
+    def send_message(self, msg):
+        outcome = self.outcomes.pop(0) if self.outcomes else {}
+        if isinstance(outcome, Exception):
+            raise outcome
+        if not outcome:
+            self.sent.append(msg["To"])
+        return outcome
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    """Patches smtplib.SMTP: each connection shares the scripted `outcomes`; `connections` records them all."""
+    state = {"outcomes": [], "sent": [], "connections": [], "sleeps": []}
+
+    def connect(server, port):
+        connection = FakeSMTP(state["outcomes"], state["sent"])
+        state["connections"].append(connection)
+        return connection
+
+    monkeypatch.setattr(outlook_manager.smtplib, "SMTP", connect)
+    monkeypatch.setattr(outlook_manager, "time", SimpleNamespace(sleep=state["sleeps"].append, monotonic=lambda: 0.0))
+    return state
+
+
+def _messages(*recipients):
+    return [{"recipient": recipient, "subject": "Aviso", "body": "Hola"} for recipient in recipients]
+
+
+def test_send_batch_reconnects_after_disconnect(smtp):
+    smtp["outcomes"] += [smtplib.SMTPServerDisconnected("Connection unexpectedly closed")]
+    sender = OutlookSender(max_per_minute=0)
+    results = sender.send_batch(_messages("ana@ceplan.gob.pe", "luis@ceplan.gob.pe"))
+
+    assert [(result["sent"], result["attempts"]) for result in results] == [(True, 2), (True, 1)]
+    assert smtp["sent"] == ["ana@ceplan.gob.pe", "luis@ceplan.gob.pe"]
+    assert len(smtp["connections"]) == 2 and smtp["connections"][0].closed
+    assert smtp["sleeps"] == [1]
+
+
+def test_send_batch_retries_4xx_and_gives_up_on_5xx(smtp):
+    smtp["outcomes"] += [
+        smtplib.SMTPDataError(421, b"4.7.0 Too many messages"),
+        smtplib.SMTPDataError(432, b"4.3.2 Concurrent connections limit exceeded"),
+        {},
+        smtplib.SMTPDataError(550, b"5.1.1 User unknown"),
+    ]
+    sender = OutlookSender(max_per_minute=0)
+    results = sender.send_batch(_messages("ana@ceplan.gob.pe", "nadie@ceplan.gob.pe"))
+
+    assert results[0]["sent"] and results[0]["attempts"] == 3
+    assert not results[1]["sent"] and results[1]["attempts"] == 1 and "5.1.1" in results[1]["error"]
+    assert smtp["sleeps"] == [1, 2]  # Espera exponencial solo en los errores temporales
+
+
+def test_send_batch_stops_after_max_retries(smtp):
+    smtp["outcomes"] += [smtplib.SMTPServerDisconnected("closed")] * 3
+    results = OutlookSender(max_per_minute=0).send_batch(_messages("ana@ceplan.gob.pe"), max_retries=2)
+    assert not results[0]["sent"] and results[0]["attempts"] == 3 and smtp["sent"] == []
+
+
+def test_send_emails_with_template_goes_through_the_outbox(smtp, tmp_path):
+    outbox = MessageOutbox(str(tmp_path / "outbox.sqlite3"))
+    log = {"ana@ceplan.gob.pe": [{"original_name": "T1.xlsx", "new_name": "t1.xlsx", "path": "Tendencias"}],
+           "nadie@ceplan.gob.pe": [{"original_name": "T2.xlsx", "new_name": "t2.xlsx", "path": "Tendencias"}]}
+    smtp["outcomes"] += [{}, smtplib.SMTPDataError(550, b"5.1.1 User unknown")]
+    sender = OutlookSender(max_per_minute=0)
+
+    results = sender.send_emails_with_template(log, "sharepoint_success.html", message_outbox=outbox)
+    assert [(result["recipient"], result["status"]) for result in results] == [
+        ("ana@ceplan.gob.pe", "sent"), ("nadie@ceplan.gob.pe", "pending")]
+    assert sender.send_emails_with_template(log, "sharepoint_success.html", message_outbox=outbox) == []
+    assert smtp["sent"] == ["ana@ceplan.gob.pe"]  # Ya notificado: no se reenvía; el fallido espera su reintento
+    assert outbox.counts() == {"sent": 1, "pending": 1}
+
+
+def test_rate_limiter_spaces_out_calls(monkeypatch):
+    clock = {"now": 100.0}
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock["now"] += seconds
+
+    monkeypatch.setattr(outlook_manager, "time", SimpleNamespace(sleep=sleep, monotonic=lambda: clock["now"]))
+    limiter = RateLimiter(30)
+    for _ in range(3):
+        limiter.wait()
+    assert sleeps == [2.0, 2.0]  # 30 por minuto: uno cada 2 s, el primero sin esperar
+
+    clock["now"] += 10  # Tras una pausa larga no se acumulan turnos atrasados
+    limiter.wait()
+    assert sleeps == [2.0, 2.0]
+
+    RateLimiter(0).wait()  # Desactivado
+    assert sleeps == [2.0, 2.0]
@@ -0,0 +1,115 @@
+import sys
+import time
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from office365.runtime.http.request_options import RequestOptions
+
+from correos_automaticos.classes.sharepoint_auth import SHAREPOINT_TOKEN_TTL, CachedSamlTokenProvider, TokenCache
+
+SITE_URL = "https://example.sharepoint.com/sites/DNPE"
+
+TOKEN_RESPONSE = """<S:Envelope xmlns:S="http://www.w3.org/2003/05/soap-envelope"
+ xmlns:wst="http://schemas.xmlsoap.org/ws/2005/02/trust"
+ xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+ xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">
+<S:Body><wst:RequestSecurityTokenResponse>
+<wst:Lifetime><wsu:Created>{created}</wsu:Created><wsu:Expires>{expires}</wsu:Expires></wst:Lifetime>
+<wst:RequestedSecurityToken><wsse:BinarySecurityToken Id="Compact0">t=token</wsse:BinarySecurityToken></wst:RequestedSecurityToken>
+</wst:RequestSecurityTokenResponse></S:Body></S:Envelope>"""
+
+
+def _provider(tmp_path, monkeypatch):
+    provider = CachedSamlTokenProvider(SITE_URL, "user@example.pe", "secret", TokenCache(str(tmp_path / "tokens.json")))
+    logins = []
+
+    def get_authentication_cookie():
+        logins.append(1)
+        return {"FedAuth": f"token{len(logins)}", "rtFa": "rt"}
+
+    monkeypatch.setattr(provider, "get_authentication_cookie", get_authentication_cookie)
+    return provider, logins
+
+
+def test_cookies_are_reused_from_memory_and_disk(tmp_path, monkeypatch):
+    provider, logins = _provider(tmp_path, monkeypatch)
+    request = RequestOptions(SITE_URL)
+    provider.authenticate_request(request)
+    provider.authenticate_request(request)
+    assert request.headers["Cookie"] == "FedAuth=token1; rtFa=rt"
+
+    other, other_logins = _provider(tmp_path, monkeypatch)
+    other.authenticate_request(RequestOptions(SITE_URL))
+    assert logins == [1] and other_logins == []
+
+
+def test_authenticate_request_with_concurrent_invalidate(tmp_path, monkeypatch):
+    provider, _logins = _provider(tmp_path, monkeypatch)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Cambios de hilo frecuentes para que invalidate() caiga entre la autenticación y la lectura
+    errors = []
+    stop = threading.Event()
+
+    def invalidate():
+        while not stop.is_set():
+            provider.invalidate()
+
+    def authenticate():
+        try:
+            for _ in range(200):
+                request = RequestOptions(SITE_URL)
+                provider.authenticate_request(request)
+                assert request.headers["Cookie"].startswith("FedAuth=token")
+        except Exception as e:
+            errors.append(e)
+
+    invalidator = threading.Thread(target=invalidate)
+    invalidator.start()
+    workers = [threading.Thread(target=authenticate) for _ in range(4)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        stop.set()
+        invalidator.join()
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+
+def _sts_provider(tmp_path, monkeypatch, response: str):
+    """Provider whose sign-in goes through the real parsing of a canned STS response."""
+    provider = CachedSamlTokenProvider(SITE_URL, "user@example.pe", "secret", TokenCache(str(tmp_path / "tokens.json")))
+
+    def get_authentication_cookie():
+        token = provider._process_service_token_response(SimpleNamespace(content=response.encode()))
+        return {"FedAuth": token, "rtFa": "rt"}
+
+    monkeypatch.setattr(provider, "get_authentication_cookie", get_authentication_cookie)
+    return provider
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def test_expiry_is_taken_from_the_token_response(tmp_path, monkeypatch):
+    expires = int(time.time()) + 8 * 3600
+    response = TOKEN_RESPONSE.format(created=_iso(time.time()), expires=_iso(expires))
+    provider = _sts_provider(tmp_path, monkeypatch, response)
+    request = RequestOptions(SITE_URL)
+    provider.authenticate_request(request)
+
+    assert request.headers["Cookie"] == "FedAuth=t=token; rtFa=rt"
+    assert provider._expires_at == expires
+    assert provider.cache.get(provider.cache_key)["expires_at"] == expires
+
+
+def test_expiry_falls_back_to_the_ttl(tmp_path, monkeypatch):
+    response = TOKEN_RESPONSE.replace("<wst:Lifetime><wsu:Created>{created}</wsu:Created><wsu:Expires>{expires}</wsu:Expires></wst:Lifetime>", "")
+    provider = _sts_provider(tmp_path, monkeypatch, response)
+    before = time.time()
+    provider.authenticate_request(RequestOptions(SITE_URL))
+    assert before + SHAREPOINT_TOKEN_TTL <= provider._expires_at <= time.time() + SHAREPOINT_TOKEN_TTL
@@ -0,0 +1,471 @@
+import os
+import re
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+import pytest
+import requests
+from office365.runtime.client_request import ClientRequest
+from office365.sharepoint.client_context import ClientContext
+from office365.sharepoint.webs.web import Web
+from requests.exceptions import RequestException
+
+from correos_automaticos.classes import sharepoint_manager
+from correos_automaticos.classes.models import AttachmentLog
+from correos_automaticos.classes.sharepoint_manager import Sharepoint
+
+SITE_URL = "https://example.sharepoint.com/sites/DNPE"
+FOLDER_URL = "/sites/DNPE/Documentos compartidos/Fichas"
+
+
+def _response(results, next_url=None):
+    body = {"d": {"results": results}}
+    if next_url:
+        body["d"]["__next"] = next_url
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json;odata=verbose"
+    response._content = json.dumps(body).encode()
+    return response
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    """Folder with 7 files, served as list items of the library by a fake REST endpoint with $skiptoken paging."""
+    server = {"files": [f"f{k}.xlsx" for k in range(7)], "requests": []}
+
+    def execute_request_direct(self, request):
+        self.beforeExecute.notify(request)
+        url = unquote(request.url)
+        server["requests"].append(url)
+        if url.endswith("/Folders"):
+            return _response([])
+        assert f"FileDirRef eq '{FOLDER_URL}'" in url
+        top = int(re.search(r"\$top=(\d+)", url).group(1))
+        last_id = int(re.search(r"p_ID=(\d+)", url).group(1)) if "$skiptoken" in url else 0
+        page = [{"Id": index + 1, "EditorId": 12,
+                 "File": {"Name": name, "ServerRelativeUrl": f"{FOLDER_URL}/{name}", "Length": "5"}}
+                for index, name in enumerate(server["files"]) if index + 1 > last_id][:top]
+        next_url = None
+        if page and page[-1]["Id"] < len(server["files"]):
+            # Como SharePoint: el nextLink conserva $filter, $expand y $top y agrega el $skiptoken de la página
+            query = re.sub(r"&\$skiptoken=Paged=TRUE&p_ID=\d+", "", url)
+            next_url = f"{query}&$skiptoken=Paged%3DTRUE%26p_ID%3D{page[-1]['Id']}"
+        return _response(page, next_url)
+
+    monkeypatch.setattr(ClientRequest, "execute_request_direct", execute_request_direct)
+    return server
+
+
+@pytest.fixture
+def sharepoint():
+    sp = Sharepoint(SITE_URL, "Documentos compartidos", connect_on_creation=False)
+    sp.conn = ClientContext(SITE_URL)
+    sp.conn.authentication_context.authenticate_request = lambda request: None
+    return sp
+
+
+def test_list_folder_follows_skiptoken_pages(fake_server, sharepoint):
+    files, subfolders = sharepoint._list_folder(FOLDER_URL, page_size=3)
+
+    assert [file["name"] for file in files] == fake_server["files"]
+    assert [(file["size"], file["editor"]) for file in files[:1]] == [(5, 12)]
+    assert subfolders == []
+    assert sum("/items" in url for url in fake_server["requests"]) == 3  # 3 + 3 + 1, sin volver a listar
+
+
+def test_walk_files_pages_by_default(fake_server, sharepoint):
+    files = list(sharepoint.walk_files("Documentos compartidos/Fichas", max_workers=1))
+
+    assert [file["name"] for file in files] == fake_server["files"]
+    item_requests = [url for url in fake_server["requests"] if "/items" in url]
+    assert len(item_requests) == 1 and f"$top={sharepoint_manager.SHAREPOINT_PAGE_SIZE}" in item_requests[0]
+
+
+@pytest.fixture
+def scripted_server(monkeypatch):
+    """Answers every request with the next status of `statuses` (200 once the script runs out) and records the URLs
+    (except the contextinfo requests for the form digest)."""
+    server = {"statuses": [], "requests": [], "sleeps": []}
+
+    def execute_request_direct(self, request):
+        self.beforeExecute.notify(request)
+        if request.url.lower().endswith("/contextinfo"):
+            return _response([])  # Digest de los POST: no cuenta como solicitud del guion
+        server["requests"].append(unquote(request.url))
+        status, headers = server["statuses"].pop(0) if server["statuses"] else (200, {})
+        response = _response([])
+        response._content = json.dumps({"d": {"Name": "carpeta"}}).encode()
+        response.status_code = status
+        response.headers.update(headers)
+        response.url = request.url
+        response.raise_for_status()
+        return response
+
+    monkeypatch.setattr(ClientRequest, "execute_request_direct", execute_request_direct)
+    monkeypatch.setattr(sharepoint_manager.time, "sleep", server["sleeps"].append)
+    return server
+
+
+class FakeTokenProvider:
+    def __init__(self):
+        self.invalidations = 0
+
+    def invalidate(self):
+        self.invalidations += 1
+
+
+def _queue_folders(sharepoint, *names):
+    for name in names:
+        sharepoint.conn.web.get_folder_by_server_relative_url(f"{FOLDER_URL}/{name}").get()
+
+
+def test_throttled_query_waits_retry_after_and_keeps_its_place(scripted_server, sharepoint):
+    scripted_server["statuses"] = [(429, {"Retry-After": "7"}), (503, {})]
+    _queue_folders(sharepoint, "A", "B", "C")
+
+    sharepoint._execute_query()
+
+    folders = [re.search(r"Fichas/(\w)", url).group(1) for url in scripted_server["requests"]]
+    assert folders == ["A", "A", "A", "B", "C"]  # La consulta limitada se repite antes que las siguientes
+    assert scripted_server["sleeps"] == [7, sharepoint_manager.SHAREPOINT_DEFAULT_RETRY_AFTER]
+
+
+def test_throttling_gives_up_after_max_retries(scripted_server, sharepoint):
+    scripted_server["statuses"] = [(429, {"Retry-After": "1"})] * 3
+    _queue_folders(sharepoint, "A")
+
+    with pytest.raises(RequestException):
+        sharepoint._execute_query(max_retries=2)
+    assert len(scripted_server["requests"]) == 3
+
+
+def test_expired_session_is_authenticated_again_once(scripted_server, sharepoint):
+    provider = sharepoint.conn.authentication_context.token_provider = FakeTokenProvider()
+    scripted_server["statuses"] = [(200, {}), (401, {})]
+    _queue_folders(sharepoint, "A", "B")
+
+    sharepoint._execute_query()
+
+    assert provider.invalidations == 1 and scripted_server["sleeps"] == []
+    assert [re.search(r"Fichas/(\w)", url).group(1) for url in scripted_server["requests"]] == ["A", "B", "B"]
+
+    scripted_server["statuses"] = [(403, {}), (403, {})]
+    _queue_folders(sharepoint, "C")
+    with pytest.raises(RequestException):
+        sharepoint._execute_query()
+    assert provider.invalidations == 2  # Una vez por llamada: un 403 persistente no es una sesión vencida
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploads = {"attempts": [], "fail": set(), "remote": []}
+
+    def upload_file(self, file_name, custom_folder_path="", create_folder=False, local_path=None):
+        uploads["attempts"].append(f"{custom_folder_path}/{file_name}")
+        return file_name not in uploads["fail"]
+
+    monkeypatch.setattr(Sharepoint, "upload_file", upload_file)
+    monkeypatch.setattr(Sharepoint, "list_files", lambda self, folder, verbose=True: uploads["remote"])
+    return uploads
+
+
+def _attachment(tmp_path, name: str, content: bytes = b"ficha", folder: str = "Fichas") -> AttachmentLog:
+    local_path = tmp_path / name
+    local_path.write_bytes(content)
+    return AttachmentLog(new_name=name, original_name=name, path=folder, author="ana@ceplan.gob.pe", local_path=str(local_path))
+
+
+def test_upload_attachments_reports_one_status_per_entry(uploads, sharepoint, tmp_path):
+    uploads["fail"] = {"t2.xlsx"}
+    logs = [_attachment(tmp_path, "t1.xlsx"), _attachment(tmp_path, "t2.xlsx"), _attachment(tmp_path, "t1.xlsx"),
+            _attachment(tmp_path, "t3.xlsx", folder="")]
+
+    statuses = sharepoint.upload_attachments(logs, folder_for=lambda log: log.path or None, max_workers=2)
+
+    assert [(status["file"], status["uploaded"]) for status in statuses] == [
+        ("t1.xlsx", True), ("t2.xlsx", False), ("t1.xlsx", True), ("t3.xlsx", False)]
+    assert statuses[3]["error"] == "Sin carpeta de destino"
+    assert sorted(uploads["attempts"]) == ["Fichas/t1.xlsx", "Fichas/t2.xlsx"]  # El mismo destino se sube una vez
+
+
+def test_upload_attachments_sync_skips_unchanged_files(uploads, sharepoint, tmp_path):
+    log = _attachment(tmp_path, "t1.xlsx", b"ficha 1")
+    sharepoint._sync_state = {f"{FOLDER_URL}/t1.xlsx".lower(): {
+        "sha256": Sharepoint._file_sha256(log.local_path), "size": 7, "etag": '"{A1},3"'}}
+    uploads["remote"] = [{"name": "t1.xlsx", "server_relative_url": f"{FOLDER_URL}/t1.xlsx", "size": 7, "etag": '"{A1},3"'}]
+
+    statuses = sharepoint.upload_attachments([log], folder_for=lambda log: log.path, sync=True, save_state=False)
+    assert statuses[0]["skipped"] and statuses[0]["uploaded"] and uploads["attempts"] == []
+
+    uploads["remote"][0]["etag"] = '"{A1},4"'  # Alguien editó el archivo en SharePoint
+    statuses = sharepoint.upload_attachments([log], folder_for=lambda log: log.path, sync=True, save_state=False)
+    assert not statuses[0]["skipped"] and uploads["attempts"] == ["Fichas/t1.xlsx"]
+
+
+def test_two_workers_creating_the_same_folders_send_one_request(sharepoint, monkeypatch):
+    entered, release = threading.Event(), threading.Event()
+    requests_sent = []
+
+    def execute_query(self, max_retries=None, batch=False):
+        requests_sent.append(batch)
+        entered.set()
+        release.wait(5)
+        self.conn.clear()
+
+    monkeypatch.setattr(Sharepoint, "_execute_query", execute_query)
+    workers = [sharepoint._worker_session(), sharepoint._worker_session()]
+    results = {}
+
+    def create(index):
+        results[index] = workers[index].ensure_folders_exist("Fichas/Tendencias/T1")
+
+    first = threading.Thread(target=create, args=(0,))
+    first.start()
+    assert entered.wait(5)
+    second = threading.Thread(target=create, args=(1,))
+    second.start()
+    time.sleep(0.1)  # El segundo worker espera la creación en curso en lugar de repetirla
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert results == {0: "created", 1: "exists"}
+    assert requests_sent == [True]
+    assert sharepoint.ensure_folders_exist("Fichas/Tendencias/T1") == "exists" and requests_sent == [True]
+
+
+def test_upload_to_a_cached_folder_that_was_deleted_checks_it_again(scripted_server, sharepoint, tmp_path):
+    local_path = tmp_path / "t1.xlsx"
+    local_path.write_bytes(b"ficha 1")
+    sharepoint._known_folders.update({sharepoint._folder_key("Fichas"), sharepoint._folder_key("Fichas/T1")})  # Ya verificadas
+    scripted_server["statuses"] = [(404, {})]  # La carpeta se borró en SharePoint después de la verificación
+
+    assert sharepoint.upload_file("t1.xlsx", "Fichas/T1", local_path=str(local_path))
+
+    methods = ["upload" if "Files/add" in url else "carpeta" for url in scripted_server["requests"]]
+    assert methods == ["upload", "carpeta", "upload"]
+    assert sharepoint._folder_key("Fichas/T1") in sharepoint._known_folders
+    assert sharepoint._folder_key("Fichas") in sharepoint._known_folders  # forget_folder no toca a las carpetas padre
+
+
+class UploadServer:
+    """
+    Folder of a fake SharePoint with upload sessions: the content of a file only changes on FinishUpload, and
+    ContinueUpload accepts at most `accept` bytes and answers with the offset it confirmed.
+    """
+
+    def __init__(self, files: dict):
+        self.files = {name: {"content": content, "version": 1, "author": "ana@ceplan.gob.pe"} for name, content in files.items()}
+        self.sessions = {}
+        self.queue = []
+        self.fail = set()     # Número de operaciones (1, 2, ...) que fallan
+        self.accept = None
+        self.operations = []  # (operación, offset)
+
+    def run(self, operation, offset, action):
+        self.operations.append((operation, offset))
+        if len(self.operations) in self.fail:
+            raise RuntimeError(f"{operation} falló")
+        return action()
+
+    # ClientContext
+    def add_query(self, query):
+        self.queue.append(query)
+
+    def load(self, file):
+        def action():
+            if file.name not in self.files:
+                raise RuntimeError("File Not Found.")
+        self.queue.append(lambda: self.run("load", None, action))
+
+    def clear(self):
+        self.queue = []
+
+    def execute_query(self):
+        queue, self.queue = self.queue, []
+        for query in queue:
+            query()
+
+
+class Result:
+    value = None
+
+
+class UploadFile:
+    def __init__(self, server: UploadServer, name: str):
+        self.server, self.name = server, name
+        self.serverRelativeUrl = f"{FOLDER_URL}/{name}"
+        self.properties = {}
+
+    def _chunk(self, operation, upload_id, offset, chunk):
+        result = Result()
+
+        def action():
+            session = self.server.sessions.setdefault(upload_id, b"") if operation == "start" else self.server.sessions[upload_id]
+            assert offset == len(session), "el offset debe ser el último confirmado por el servidor"
+            accepted = chunk[:self.server.accept] if self.server.accept else chunk
+            self.server.sessions[upload_id] = session + accepted
+            result.value = len(self.server.sessions[upload_id])
+        self.server.queue.append(lambda: self.server.run(operation, offset, action))
+        return result
+
+    def start_upload(self, upload_id, chunk):
+        return self._chunk("start", upload_id, 0, chunk)
+
+    def continue_upload(self, upload_id, offset, chunk):
+        return self._chunk("continue", upload_id, offset, chunk)
+
+    def finish_upload(self, upload_id, offset, chunk):
+        def action():
+            assert offset == len(self.server.sessions[upload_id])
+            entry = self.server.files[self.name]
+            entry["content"] = self.server.sessions.pop(upload_id) + chunk
+            entry["version"] += 1
+            self.properties["ETag"] = f'"{{A1}},{entry["version"]}"'
+        self.server.queue.append(lambda: self.server.run("finish", offset, action))
+        return self
+
+    def cancel_upload(self, upload_id):
+        self.server.queue.append(lambda: self.server.run("cancel", None, lambda: self.server.sessions.pop(upload_id, None)))
+
+    def delete_object(self):
+        self.server.queue.append(lambda: self.server.run("delete", None, lambda: self.server.files.pop(self.name)))
+
+
+class UploadFiles:
+    def __init__(self, server: UploadServer):
+        self.server = server
+
+    def get_by_url(self, name):
+        return UploadFile(self.server, name)
+
+    def add(self, name, content, overwrite):
+        def action():
+            self.server.files[name] = {"content": b"", "version": 1, "author": "bot@ceplan.gob.pe"}
+        self.server.queue.append(lambda: self.server.run("add", None, action))
+        return UploadFile(self.server, name)
+
+
+class UploadFolder:
+    def __init__(self, server: UploadServer):
+        self.files = UploadFiles(server)
+
+
+@pytest.fixture
+def upload_server(sharepoint, monkeypatch, tmp_path):
+    server = UploadServer({"grande.xlsx": b"version anterior"})
+    sharepoint.conn = server
+    monkeypatch.setattr(sharepoint_manager.time, "sleep", lambda seconds: None)
+    (tmp_path / "grande.xlsx").write_bytes(b"0123456789")
+    return server
+
+
+def test_chunked_upload_replaces_the_content_of_the_existing_file(upload_server, sharepoint, tmp_path):
+    uploaded = sharepoint._upload_in_chunks(UploadFolder(upload_server), "grande.xlsx", str(tmp_path / "grande.xlsx"), chunk_size=4)
+
+    assert upload_server.files == {"grande.xlsx": {"content": b"0123456789", "version": 2, "author": "ana@ceplan.gob.pe"}}
+    assert uploaded.properties["ETag"] == '"{A1},2"'  # Nueva versión del mismo archivo: conserva autor e historial
+    assert [operation for operation, _ in upload_server.operations] == ["load", "start", "continue", "finish"]
+
+
+def test_chunked_upload_resumes_from_the_offset_confirmed_by_the_server(upload_server, sharepoint, tmp_path):
+    upload_server.accept = 3  # El servidor confirma menos bytes de los enviados
+    upload_server.fail = {3}  # Y la segunda parte falla una vez
+
+    sharepoint._upload_in_chunks(UploadFolder(upload_server), "grande.xlsx", str(tmp_path / "grande.xlsx"), chunk_size=4)
+
+    assert upload_server.files["grande.xlsx"]["content"] == b"0123456789"
+    assert upload_server.operations == [("load", None), ("start", 0), ("continue", 3), ("continue", 3), ("finish", 6)]
+
+
+def test_failed_chunked_upload_leaves_the_existing_file_untouched(upload_server, sharepoint, tmp_path):
+    upload_server.fail = {3}
+
+    with pytest.raises(RuntimeError):
+        sharepoint._upload_in_chunks(UploadFolder(upload_server), "grande.xlsx", str(tmp_path / "grande.xlsx"),
+                                     chunk_size=4, max_retries=0)
+
+    assert upload_server.files == {"grande.xlsx": {"content": b"version anterior", "version": 1, "author": "ana@ceplan.gob.pe"}}
+    assert upload_server.sessions == {}  # La sesión de carga se canceló
+    assert upload_server.operations[-1] == ("cancel", None)
+
+
+def test_failed_chunked_upload_of_a_new_file_deletes_it(upload_server, sharepoint, tmp_path):
+    (tmp_path / "nuevo.xlsx").write_bytes(b"0123456789")
+    upload_server.fail = {4}
+
+    with pytest.raises(RuntimeError):
+        sharepoint._upload_in_chunks(UploadFolder(upload_server), "nuevo.xlsx", str(tmp_path / "nuevo.xlsx"),
+                                     chunk_size=4, max_retries=0)
+
+    assert list(upload_server.files) == ["grande.xlsx"]
+    assert [operation for operation, _ in upload_server.operations] == ["load", "add", "start", "continue", "cancel", "delete"]
+
+
+@pytest.fixture
+def remote_files(monkeypatch, tmp_path):
+    """Remote files served by a patched Web.get_file_by_server_relative_url; `downloads` records the URLs downloaded."""
+    remote = {"content": {f"{FOLDER_URL}/t1.xlsx": b"ficha 1", f"{FOLDER_URL}/t2.docx": b"ficha dos"},
+              "modified": "2024-12-09 15:30:00", "downloads": [], "fail": False}
+
+    class RemoteFile:
+        def __init__(self, url):
+            self.url = url
+
+        def download_session(self, file_object, chunk_downloaded=None, chunk_size=1024):
+            remote["downloads"].append(self.url)
+            file_object.write(remote["content"][self.url][:4])
+            if remote["fail"]:
+                raise RequestException("conexión interrumpida")
+            file_object.write(remote["content"][self.url][4:])
+            return self
+
+    monkeypatch.setattr(Web, "get_file_by_server_relative_url", lambda self, url: RemoteFile(url))
+    monkeypatch.setattr(sharepoint_manager, "DOWNLOAD_PATH", str(tmp_path / "descargas"))
+    return remote
+
+
+def test_stream_to_disk_sets_the_remote_mtime(remote_files, sharepoint, tmp_path):
+    local_path = str(tmp_path / "t1.xlsx")
+
+    sharepoint._stream_to_disk(f"{FOLDER_URL}/t1.xlsx", local_path, remote_files["modified"])
+
+    with open(local_path, "rb") as file:
+        assert file.read() == b"ficha 1"
+    assert os.path.getmtime(local_path) == datetime(2024, 12, 9, 15, 30, tzinfo=timezone.utc).timestamp()
+    assert not os.path.exists(f"{local_path}.part")
+
+
+def test_interrupted_download_keeps_the_previous_copy(remote_files, sharepoint, tmp_path):
+    local_path = tmp_path / "t1.xlsx"
+    local_path.write_bytes(b"copia anterior")
+    remote_files["fail"] = True
+
+    with pytest.raises(RequestException):
+        sharepoint._stream_to_disk(f"{FOLDER_URL}/t1.xlsx", str(local_path), remote_files["modified"])
+
+    assert local_path.read_bytes() == b"copia anterior"
+    assert os.listdir(tmp_path) == ["t1.xlsx"]  # Sin el .part
+
+
+def test_download_skips_files_with_the_same_size_and_mtime(remote_files, sharepoint, monkeypatch):
+    def list_files(self, custom_folder_path="", folder_name="", author=False, verbose=True):
+        return [{"name": url.rsplit("/", 1)[1], "server_relative_url": url, "size": len(content),
+                 "time_last_modified": remote_files["modified"]} for url, content in remote_files["content"].items()]
+    monkeypatch.setattr(Sharepoint, "list_files", list_files)
+
+    assert len(sharepoint.download_files_from_folder("Documentos compartidos/Fichas", max_workers=2)) == 2
+    assert len(remote_files["downloads"]) == 2
+
+    remote_files["downloads"].clear()
+    assert len(sharepoint.download_files_from_folder("Documentos compartidos/Fichas", max_workers=2)) == 2
+    assert remote_files["downloads"] == []  # Mismo tamaño y fecha: no se vuelven a descargar
+
+    remote_files["content"][f"{FOLDER_URL}/t2.docx"] = b"ficha 2"  # Mismo tamaño que antes, otra fecha
+    remote_files["modified"] = "2024-12-10 08:00:00"
+    sharepoint.download_files_from_folder("Documentos compartidos/Fichas", max_workers=2)
+    assert sorted(remote_files["downloads"]) == [f"{FOLDER_URL}/t1.xlsx", f"{FOLDER_URL}/t2.docx"]
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from correos_automaticos.classes.template_engine import CompiledTemplate, Markup, load_template
+
+
+def test_render_matches_str_format():
+    text = "Hola {name}, {count:03d} archivos {{literal}} de {name!r}"
+    template = CompiledTemplate(text, autoescape=False)
+    assert template.render(name="Ana", count=7) == text.format(name="Ana", count=7)
+    assert template.placeholders == ["name", "count"]
+
+
+def test_autoescape_and_markup():
+    template = CompiledTemplate("<li>{file}</li>{extra}")
+    rendered = template.render(file='<script>"x"</script> & co', extra=Markup("<b>ok</b>"))
+    assert rendered == "<li>&lt;script&gt;&quot;x&quot;&lt;/script&gt; &amp; co</li><b>ok</b>"
+    assert isinstance(rendered, Markup)
+
+    # Un render escapado puede anidarse en otra plantilla sin escaparse dos veces
+    outer = CompiledTemplate("<ul>{items}</ul>")
+    assert outer.render(items=rendered) == f"<ul>{rendered}</ul>"
+
+
+def test_collapse_whitespace_and_errors():
+    template = CompiledTemplate("<p>\n    {a}\n\n  </p>", collapse_whitespace=True)
+    assert template.render(a=1) == "<p> 1 </p>"
+    with pytest.raises(KeyError):
+        template.render()
+    with pytest.raises(ValueError):
+        CompiledTemplate("{user.name}")
+
+
+def test_load_template_reuses_until_the_file_changes(tmp_path):
+    path = tmp_path / "aviso.html"
+    path.write_text("<p>{a}</p>", encoding="utf-8")
+    first = load_template(str(path))
+    assert load_template(str(path)) is first
+    assert first.autoescape
+
+    path.write_text("<div>{a}</div>", encoding="utf-8")
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 10**9))
+    assert load_template(str(path)).render(a="<x>") == "<div>&lt;x&gt;</div>"